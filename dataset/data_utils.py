@@ -3,6 +3,8 @@ import json
 import math
 import random
 import pickle
+import threading
+from collections import OrderedDict
 from config.config import GOAL_TOKEN, USER_TOKEN, SYSTEM_TOKEN, KNOW_TOKEN, PATH_TOKEN, SEP_TOKEN, PROFILE_TOKEN, \
     CONTEXT_TOKEN, TARGET, TOPIC_TOKEN
 
@@ -60,6 +62,109 @@ def convert_dict_to_str(profile):
     return out_str
 
 
+def tokenize_piece(tokenizer, text, is_last):
+    """
+    function that tokenizes a piece of an input built from a dialogue, with the same neighbours as in the whole input
+    @param tokenizer: a huggingface tokenizer
+    @param text: the piece, e.g. a role token followed by an utterance
+    @param is_last: True if the piece ends the input, otherwise it is followed by a role token
+    @return: a list of token ids
+    """
+    if is_last:
+        return tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
+    # tokenize the piece in front of a role token and drop the ids of the role token
+    return tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text + USER_TOKEN))[:-1]
+
+
+class UtteranceTokenCache:
+    """
+    LRU cache of the token ids of the pieces of the model inputs built from a dialogue.
+    The role tokens are special tokens, and a tokenizer splits its input on the special tokens before tokenizing each
+    segment, so the ids of an input are the concatenation of the ids of its pieces, each piece being tokenized with
+    the same neighbours as in the whole input (a following special token, or the end of the input).
+    """
+
+    def __init__(self, max_size=100000):
+        """
+        constructor for class UtteranceTokenCache
+        @param max_size: the maximum number of cached pieces
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        # whether each tokenizer splits on the role tokens, by id, with a reference to the tokenizer so that its id
+        # is not reused
+        self.supported = {}
+        self.lock = threading.Lock()
+
+    def supports(self, tokenizer):
+        """
+        method that checks if the role tokens are special tokens of the tokenizer
+        @param tokenizer: a huggingface tokenizer
+        @return: True if the inputs of the tokenizer can be assembled from cached pieces
+        """
+        if id(tokenizer) not in self.supported:
+            special_tokens = set(getattr(tokenizer, 'all_special_tokens', []))
+            self.supported[id(tokenizer)] = (tokenizer, USER_TOKEN in special_tokens and SYSTEM_TOKEN in special_tokens)
+        return self.supported[id(tokenizer)][1]
+
+    def piece(self, tokenizer, text, is_last):
+        """
+        method that returns the token ids of a piece of an input
+        @param tokenizer: a huggingface tokenizer
+        @param text: the piece, e.g. a role token followed by an utterance
+        @param is_last: True if the piece ends the input, otherwise it is followed by a role token
+        @return: a list of token ids
+        """
+        key = (id(tokenizer), text, is_last)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        ids = tokenize_piece(tokenizer, text, is_last)
+        with self.lock:
+            self.entries[key] = ids
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return ids
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.supported.clear()
+
+
+# shared by the feature builders, the search converts states that extend each other, so most utterances are cached
+utterance_token_cache = UtteranceTokenCache()
+
+
+def tokenize_with_dialogue(tokenizer, prefix_str, dialogue_context):
+    """
+    function that tokenizes a prefix followed by the dialogue string of a dialogue context, i.e.
+    tokenizer.tokenize(prefix_str + dialogue_str), using the utterance token cache
+    @param tokenizer: a huggingface tokenizer
+    @param prefix_str: the text preceding the dialogue context
+    @param dialogue_context: a list of utterances
+    @return: the list of token ids
+    """
+    roles = {"user": USER_TOKEN, "assistant": SYSTEM_TOKEN}
+    if not utterance_token_cache.supports(tokenizer) or any(utt['role'] not in roles for utt in dialogue_context):
+        # the pieces cannot be separated, tokenize the whole input
+        dialogue_str = ""
+        for utt in dialogue_context:
+            if utt['role'] in roles:
+                dialogue_str += roles[utt['role']]
+            dialogue_str += utt['content']
+        return tokenizer.convert_tokens_to_ids(tokenizer.tokenize(prefix_str + dialogue_str))
+
+    n_utts = len(dialogue_context)
+    # the prefix changes with every call (goal path, knowledge, ...), it is not cached so that it does not evict the
+    # utterances from the cache
+    input_ids = tokenize_piece(tokenizer, prefix_str, n_utts == 0)
+    for i, utt in enumerate(dialogue_context):
+        input_ids.extend(utterance_token_cache.piece(tokenizer, roles[utt['role']] + utt['content'], i == n_utts - 1))
+    return input_ids
+
+
 def convert_example_to_feature_for_goal_prediction(tokenizer, instance, max_sequence_length=512, goal2id=None):
     """
     function that converts an instance (example ) to a sequence of various features
@@ -73,13 +178,6 @@ def convert_example_to_feature_for_goal_prediction(tokenizer, instance, max_sequ
     prev_paths = instance['pre_goals']
     prev_topics = instance['pre_topics']
     target = instance['task_background']['target_topic']
-    dialogue_str = ""
-    for utt in dialogue_context:
-        if utt['role'] == "user":
-            dialogue_str += USER_TOKEN
-        elif utt['role'] == 'assistant':
-            dialogue_str += SYSTEM_TOKEN
-        dialogue_str += utt['content']
 
     path_str = ""
     for goal, topic in list(zip(prev_paths, prev_topics)):
@@ -89,8 +187,9 @@ def convert_example_to_feature_for_goal_prediction(tokenizer, instance, max_sequ
         path_str += topic
         path_str += SEP_TOKEN
 
-    input_str = f"{PATH_TOKEN}: {path_str} {TARGET}: {target} {CONTEXT_TOKEN}: {dialogue_str}"
-    input_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(input_str))
+    # the dialogue context is tokenized utterance by utterance, the truncation is applied on the ids
+    prefix_str = f"{PATH_TOKEN}: {path_str} {TARGET}: {target} {CONTEXT_TOKEN}: "
+    input_ids = tokenize_with_dialogue(tokenizer, prefix_str, dialogue_context)
     input_ids = input_ids[-(max_sequence_length - 2):]
     input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
 
@@ -111,13 +210,6 @@ def convert_example_to_feature_for_response_generation(tokenizer, instance, max_
     @return: an input sequence and its corresponding labels.
     """
     dialogue_context = instance['dialogue_context']
-    dialogue_str = ""
-    for utt in dialogue_context:
-        if utt['role'] == "user":
-            dialogue_str += USER_TOKEN
-        elif utt['role'] == 'assistant':
-            dialogue_str += SYSTEM_TOKEN
-        dialogue_str += utt['content']
 
     if not is_test:
         # ground truth goal for training the model
@@ -139,11 +231,11 @@ def convert_example_to_feature_for_response_generation(tokenizer, instance, max_
     # construct the input sequence for response generation task
     # for durecdial dataset
     if dataset == 'durecdial':
-        input_str = f"{GOAL_TOKEN}: {goal} {TOPIC_TOKEN}: {topic} {KNOW_TOKEN}: {knowledge_str}  {CONTEXT_TOKEN}: {dialogue_str}"
+        prefix_str = f"{GOAL_TOKEN}: {goal} {TOPIC_TOKEN}: {topic} {KNOW_TOKEN}: {knowledge_str}  {CONTEXT_TOKEN}: "
     # for inspired dataset
     elif dataset == 'inspired':
-        input_str = f"{GOAL_TOKEN}: {goal} {TARGET}: {target} {CONTEXT_TOKEN}: {dialogue_str}"
-    input_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(input_str))
+        prefix_str = f"{GOAL_TOKEN}: {goal} {TARGET}: {target} {CONTEXT_TOKEN}: "
+    input_ids = tokenize_with_dialogue(tokenizer, prefix_str, dialogue_context)
     input_ids = input_ids[-(max_sequence_length - 2):]
     input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
 
@@ -168,14 +260,7 @@ def convert_example_to_feature_for_knowledge_generation(tokenizer, instance, max
     @return: an input sequence and its corresponding labels.
     """
     dialogue_context = instance['dialogue_context']
-    dialogue_str = ""
     target = instance['task_background']['target_topic']
-    for utt in dialogue_context:
-        if utt['role'] == "user":
-            dialogue_str += USER_TOKEN
-        elif utt['role'] == 'assistant':
-            dialogue_str += SYSTEM_TOKEN
-        dialogue_str += utt['content']
 
     if not is_test:
         # ground truth goal and topic for training the model
@@ -185,17 +270,10 @@ def convert_example_to_feature_for_knowledge_generation(tokenizer, instance, max
         # predicted goal and topic for the inference step
         goal = instance['pred_goal']
         topic = instance['pred_topic']
-    dialogue_str = ""
-    for utt in dialogue_context:
-        if utt['role'] == "user":
-            dialogue_str += USER_TOKEN
-        elif utt['role'] == 'assistant':
-            dialogue_str += SYSTEM_TOKEN
-        dialogue_str += utt['content']
 
     # construct the input sequence for knowledge generation task
-    input_str = f"{GOAL_TOKEN}: {goal} {TOPIC_TOKEN}: {topic} {TARGET}: {target} {CONTEXT_TOKEN}: {dialogue_str}"
-    input_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(input_str))
+    prefix_str = f"{GOAL_TOKEN}: {goal} {TOPIC_TOKEN}: {topic} {TARGET}: {target} {CONTEXT_TOKEN}: "
+    input_ids = tokenize_with_dialogue(tokenizer, prefix_str, dialogue_context)
     input_ids = input_ids[-(max_sequence_length - 2):]
     input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
 
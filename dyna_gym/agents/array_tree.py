@@ -0,0 +1,171 @@
+"""
+Struct-of-arrays search tree
+
+Alternative backend for the UCT agent, selected with tree_backend='array'. The tree is made of the same
+DecisionNode/ChanceNode objects and goes through the same search loop as the object backend, but the return
+statistics of the ChanceNodes of a decision node (prior, returns, virtual loss) are stored in NumPy arrays owned by
+that decision node, one slot per child. The selection score of all the children of a decision node is then computed
+with one vectorized expression instead of one Python call per child, which pays off on wide nodes such as the
+goal x topic action space of the RTCP policy.
+
+The children of a decision node are only appended (pruning removes the DecisionNodes below a ChanceNode, never
+the ChanceNode itself), so the i-th child of a decision node always owns slot i of its arrays.
+"""
+from math import log
+
+import numpy as np
+
+from dyna_gym.agents import mcts
+
+
+class ChildStatistics:
+    """
+    Return statistics of the children of a decision node, stored in growable arrays
+
+    Args:
+        capacity: initial number of slots, the arrays are doubled when full
+    """
+
+    FIELDS = {
+        'prob': np.float64,
+        'n_returns': np.int64,
+        'sum_returns': np.float64,
+        'max_return': np.float64,
+        'last_return': np.float64,
+        'mean_return': np.float64,
+        'm2_returns': np.float64,
+        'virtual_loss': np.int64,
+    }
+
+    def __init__(self, capacity=4):
+        self.size = 0
+        self.arrays = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.FIELDS.items()}
+
+    def reserve(self, capacity):
+        """
+        Grow the arrays so that they hold at least capacity slots
+        """
+        old_capacity = len(self.arrays['prob'])
+        if capacity <= old_capacity:
+            return
+        capacity = max(capacity, 2 * old_capacity)
+        for name, array in self.arrays.items():
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            self.arrays[name] = grown
+
+    def add(self):
+        """
+        Allocate the slot of a new child and return its index
+        """
+        self.reserve(self.size + 1)
+        index = self.size
+        for array in self.arrays.values():
+            array[index] = 0
+        self.size += 1
+        return index
+
+
+def stat_property(name):
+    """
+    Attribute of an ArrayChanceNode stored in the arrays of its parent, read as a Python scalar
+    """
+    def get(self):
+        return self.parent.child_stats.arrays[name][self.index].item()
+
+    def set(self, value):
+        self.parent.child_stats.arrays[name][self.index] = value
+
+    return property(get, set)
+
+
+class ArrayChanceNode(mcts.ChanceNode):
+    """
+    ChanceNode whose return statistics are stored in the ChildStatistics of its parent
+    """
+
+    def __init__(self, parent, action_and_score):
+        # the slot must exist before ChanceNode.__init__ writes the initial statistics
+        self.parent = parent
+        self.index = parent.child_stats.add()
+        super().__init__(parent, action_and_score)
+
+
+for _name in ChildStatistics.FIELDS:
+    setattr(ArrayChanceNode, _name, stat_property(_name))
+
+
+class ArrayDecisionNode(mcts.DecisionNode):
+    """
+    DecisionNode whose children are ArrayChanceNodes
+    """
+
+    chance_node_class = ArrayChanceNode
+
+    def __init__(self, *args, **kwargs):
+        self.child_stats = ChildStatistics()
+        super().__init__(*args, **kwargs)
+
+    def set_priors(self, possible_actions, action_scores, pool=None):
+        self.child_stats.reserve(len(possible_actions))
+        super().set_priors(possible_actions, action_scores, pool=pool)
+
+
+def selection_scores(ag, node, n_children):
+    """
+    Tree policy scores of the first n_children children of node, the vectorized counterpart of UCT.ucb, UCT.p_ucb
+    and UCT.var_p_ucb. The expressions are evaluated in the same order so that both backends select the same child.
+    """
+    arrays = node.child_stats.arrays
+    virtual_loss = arrays['virtual_loss'][:n_children]
+    value = arrays['last_return'][:n_children] - ag.virtual_loss * virtual_loss
+    n_returns = arrays['n_returns'][:n_children] + virtual_loss
+    exploration = np.sqrt(log(node.visits))
+    if ag.alg == 'uct':
+        return value + ag.ucb_constant * exploration / (1 + n_returns)
+    prob = arrays['prob'][:n_children]
+    if ag.alg == 'var_p_uct':
+        ucb_parameter = log((node.visits + ag.ucb_base + 1) / ag.ucb_base) + ag.ucb_constant
+        return value + ucb_parameter * prob * exploration / (1 + n_returns)
+    # p_uct, and gumbel below the root
+    return value + ag.ucb_constant * prob * exploration / (1 + n_returns)
+
+
+def select_child(ag, children, criterion):
+    """
+    Child of highest tree policy score. Children that are not the slots of an ArrayDecisionNode in order are scored
+    one by one with criterion.
+    """
+    node = children[0].parent
+    n_children = len(children)
+    if not isinstance(node, ArrayDecisionNode) or children is not node.children \
+            or node.child_stats.size != n_children:
+        return max(children, key=criterion)
+    return children[int(np.argmax(selection_scores(ag, node, n_children)))]
+
+
+def to_array_tree(root):
+    """
+    Convert a tree of plain DecisionNode/ChanceNode objects in place, e.g. one read by tree_snapshot.load_tree,
+    to a tree of ArrayDecisionNode/ArrayChanceNode objects, and return its root
+    """
+    seen = set()
+    stack = [root]
+    while len(stack) > 0:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if not isinstance(node, ArrayDecisionNode):
+            node.__class__ = ArrayDecisionNode
+            node.child_stats = ChildStatistics(max(len(node.children), len(node.possible_actions), 1))
+            for chance_node in node.children:
+                # the statistics are moved from the attributes of the node to the arrays of its parent
+                stats = {name: chance_node.__dict__.pop(name) for name in ChildStatistics.FIELDS}
+                chance_node.__class__ = ArrayChanceNode
+                chance_node.index = node.child_stats.add()
+                for name, value in stats.items():
+                    setattr(chance_node, name, value)
+        for chance_node in node.children:
+            stack.extend(chance_node.children)
+    return root
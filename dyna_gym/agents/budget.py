@@ -0,0 +1,158 @@
+"""
+Search budgets
+
+Termination conditions bounding a tree search by wall-clock time and number of environment calls, and the
+allocation of a rollout budget across the turns of a conversation.
+"""
+import math
+import time
+
+
+class SearchBudget:
+    """
+    Termination condition of an anytime search, to be used as the term_cond of mcts_procedure.
+    The condition is checked between rounds of rollouts, not within a round: a search overruns its budget by at most
+    one round, i.e. the duration, transitions and LLM calls of up to parallel_rollouts rollouts.
+    The LLM calls are counted by the environment (env.n_llm_calls): the user simulator calls of the transitions and of
+    the simulations of the default policy, and the LLM-based assessments of the leaves.
+
+    Args:
+        time_budget: wall-clock budget of a search in seconds
+        max_transitions: maximum number of env.transition calls of a search
+        max_llm_calls: maximum number of LLM calls of a search
+    """
+
+    def __init__(self, time_budget=None, max_transitions=None, max_llm_calls=None):
+        self.time_budget = time_budget
+        self.max_transitions = max_transitions
+        self.max_llm_calls = max_llm_calls
+        self.env = None
+        self.start_time = None
+        self.start_transitions = 0
+        self.start_llm_calls = 0
+        self.exhausted_by = None
+
+    def __getstate__(self):
+        # do not copy the environment along with the agent
+        state = self.__dict__.copy()
+        state['env'] = None
+        return state
+
+    def is_bounded(self):
+        return any(limit is not None for limit in [self.time_budget, self.max_transitions, self.max_llm_calls])
+
+    def start(self, env):
+        """
+        Start counting for a new search on env
+        """
+        self.env = env
+        self.start_time = time.time()
+        # the environment counts its own calls, if it does not, only the time budget applies
+        self.start_transitions = getattr(env, 'n_transitions', 0)
+        self.start_llm_calls = getattr(env, 'n_llm_calls', 0)
+        self.exhausted_by = None
+        return self
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def transitions(self):
+        return getattr(self.env, 'n_transitions', 0) - self.start_transitions
+
+    def llm_calls(self):
+        return getattr(self.env, 'n_llm_calls', 0) - self.start_llm_calls
+
+    def __call__(self):
+        """
+        True if the search should stop
+        """
+        if self.time_budget is not None and self.elapsed() >= self.time_budget:
+            self.exhausted_by = 'time'
+        elif self.max_transitions is not None and self.transitions() >= self.max_transitions:
+            self.exhausted_by = 'transitions'
+        elif self.max_llm_calls is not None and self.llm_calls() >= self.max_llm_calls:
+            self.exhausted_by = 'llm_calls'
+        return self.exhausted_by is not None
+
+    def summary(self):
+        return {
+            'elapsed': self.elapsed(),
+            'transitions': self.transitions(),
+            'llm_calls': self.llm_calls(),
+            'exhausted_by': self.exhausted_by,
+        }
+
+
+class RolloutScheduler:
+    """
+    Conversation-level budget manager splitting a total number of rollouts across the turns of a conversation.
+    Each turn gets an equal share of the remaining budget over the remaining turns, scaled by the uncertainty at the
+    root: the normalised entropy of the prior and, if the root already has statistics (reused tree), how close the
+    values of its two best children are.
+
+    Args:
+        total_rollouts: rollout budget of a whole conversation
+        max_turns: maximum number of turns of a conversation
+        min_rollouts: minimum number of rollouts of a turn, as long as the budget allows it
+    """
+
+    def __init__(self, total_rollouts, max_turns, min_rollouts=1):
+        self.total_rollouts = total_rollouts
+        self.max_turns = max_turns
+        self.min_rollouts = min_rollouts
+        self.history = []
+        self.start_conversation()
+
+    def start_conversation(self):
+        self.remaining = self.total_rollouts
+        self.turn = 0
+        self.context_length = None
+
+    def detect_conversation(self, state):
+        """
+        Start a new conversation if the dialogue context of state is not longer than that of the previous turn
+        """
+        if not isinstance(state, dict) or 'dialogue_context' not in state:
+            return
+        context_length = len(state['dialogue_context'])
+        if self.context_length is not None and context_length <= self.context_length:
+            self.start_conversation()
+        self.context_length = context_length
+
+    @staticmethod
+    def uncertainty(root):
+        """
+        Uncertainty of the decision at root, between 0 and 1
+        """
+        priors = [p for p in root.action_scores if p > 0]
+        if len(priors) < 2:
+            return 0.
+        total = sum(priors)
+        entropy = -sum(p / total * math.log(p / total) for p in priors)
+        uncertainty = entropy / math.log(len(priors))
+
+        visited = [child for child in root.children if child.n_returns > 1]
+        if len(visited) >= 2:
+            # a small gap between the two best values relative to the spread of the returns is uncertain
+            means = sorted((child.mean_return for child in visited), reverse=True)
+            spread = math.sqrt(sum(child.return_variance for child in visited) / len(visited))
+            gap = means[0] - means[1]
+            uncertainty = (uncertainty + math.exp(-gap / (spread + 1e-8))) / 2
+        return uncertainty
+
+    def allocate(self, root):
+        """
+        Number of rollouts of the search of the current turn
+        """
+        remaining_turns = max(self.max_turns - self.turn, 1)
+        share = self.remaining / remaining_turns
+        rollouts = int(round(share * (0.5 + self.uncertainty(root))))
+        return max(min(max(rollouts, self.min_rollouts), self.remaining), 0)
+
+    def record(self, rollouts):
+        """
+        Charge the rollouts run by the current turn to the budget and move to the next turn
+        """
+        self.remaining = max(self.remaining - rollouts, 0)
+        self.history.append({'turn': self.turn, 'rollouts': rollouts, 'remaining': self.remaining})
+        self.turn += 1
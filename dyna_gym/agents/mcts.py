@@ -7,182 +7,640 @@ env.action_space
 env.transition(s ,a , is_model_dynamic)
 env.equality_operator(s1, s2)
 """
+import itertools
+import math
 import pickle
 import random
+from concurrent.futures import ThreadPoolExecutor
 from gym import spaces
 from tqdm import tqdm
 import copy
+from functools import partial
 
 from dyna_gym.utils.utils import combinations, multigpu_breakpoint
+from dyna_gym.utils.profiling import profile_phase
 from dyna_gym.envs.utils import compute_reward_based_on_memory, get_llm_based_assessment
+from dyna_gym.envs.dialogue_state import DialogueState
 from dataset.data_utils import save_simulated_results
 
 
 def chance_node_value(node, mode="avg"):
     """
-    Value of a chance node
+    Value of a chance node, computed in constant time from its running return statistics
     """
-    if len(node.sampled_returns) == 0:
+    if node.n_returns == 0:
         return 0
     elif mode == "best":
         # max return (reasonable because the model is deterministic?)
-        return max(node.sampled_returns)
+        return node.max_return
     elif mode == "sample":
         # Use average return
-        return sum(node.sampled_returns) / len(node.sampled_returns)
+        return node.sum_returns / node.n_returns
     elif mode == 'avg':
-        return node.sampled_returns[-1]
+        return node.last_return
     else:
         raise Exception(f"Unknown tree search mode {mode}")
 
 
+def root_is_decided(root, remaining, criterion='visits', z=2., min_visits=5):
+    """
+    Whether the action chosen at the root is settled, so that the search can stop before using its remaining rollouts
+
+    Args:
+        root: the root DecisionNode
+        remaining: number of rollouts left in the budget
+        criterion: 'visits', the most visited child leads every other possible action by more visits than the
+            remaining rollouts, so it cannot be overtaken; 'lcb', the child with the highest mean return has a lower
+            confidence bound above the upper confidence bound of every other child, the children sampled less than
+            min_visits times are not compared
+        z: width of the confidence bounds in standard errors, only used by 'lcb'
+        min_visits: number of returns a child needs to be compared, only used by 'lcb'
+    """
+    if len(root.possible_actions) < 2:
+        return True
+    if criterion == 'visits':
+        # the actions not added yet under progressive widening have no returns besides the initial one
+        visits = [child.n_returns for child in root.children]
+        visits += [1] * (len(root.possible_actions) - len(root.children))
+        visits = sorted(visits, reverse=True)
+        return visits[0] - visits[1] > remaining
+    elif criterion == 'lcb':
+        def bound(node, sign):
+            return node.mean_return + sign * z * math.sqrt(node.return_variance / node.n_returns)
+
+        compared = [child for child in root.children if child.n_returns - 1 >= min_visits]
+        if len(compared) < 2:
+            return False
+        best = decided_child(root, criterion)
+        if best.n_returns - 1 < min_visits:
+            return False
+        return all(bound(best, -1) > bound(child, 1) for child in compared if child is not best)
+    else:
+        raise Exception(f"Unknown early stop criterion {criterion}")
+
+
+def decided_child(root, criterion='visits'):
+    """
+    Child of the root certified by root_is_decided: the most visited child for 'visits', the child with the highest
+    mean return for 'lcb'. None if the root has no children.
+    """
+    if len(root.children) == 0:
+        return None
+    if criterion == 'visits':
+        return max(root.children, key=lambda n: n.n_returns)
+    return max(root.children, key=lambda n: n.mean_return)
+
+
+def prior_action(ag, root):
+    """
+    Action returned when the root has no children to choose from: the possible action of highest prior, or the first
+    action of the action space of the agent if the default policy proposed none
+    """
+    if len(root.possible_actions) > 0:
+        return max(zip(root.possible_actions, root.action_scores), key=lambda pair: pair[1])[0]
+    if len(ag.action_space) > 0:
+        return ag.action_space[0]
+    raise Exception("The default policy proposed no action for the root and the agent has no action space")
+
+
 def mcts_tree_policy(children):
     return random.choice(children)
 
 
-def mcts_procedure(ag, tree_policy, env, done, memory=None, k=10, root=None, term_cond=None, ts_mode="sample",
-                   out_path="memory_reward"):
+class Rollout:
     """
-    Compute the entire MCTS procedure wrt to the selected tree policy.
-    Funciton tree_policy is a function taking an agent + a list of ChanceNodes as argument
-    and returning the one chosen by the tree policy.
+    Book-keeping of a single in-flight rollout: the node it currently points to, the ChanceNodes it went through and
+    the transition rewards collected along the way
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.path = []
+        self.rewards = []
+        # whether the rollout created a new DecisionNode
+        self.expanded = False
+
+
+def map_concurrently(executor, fn, args_list):
+    """
+    Apply fn to every tuple of arguments in args_list, concurrently if an executor is given.
+    Results are returned in the order of args_list.
+    """
+    if executor is None or len(args_list) <= 1:
+        return [fn(*args) for args in args_list]
+    return list(executor.map(lambda args: fn(*args), args_list))
+
+
+def progressive_widening(ag, node):
+    """
+    Add children to a DecisionNode as its visit count grows, if the agent uses progressive widening.
+    The node is allowed ceil(pw_c * visits^pw_alpha) children, the next ones being taken in decreasing prior order.
+    """
+    pw_alpha = getattr(ag, 'pw_alpha', None)
+    if pw_alpha is None:
+        return
+    node.widen(math.ceil(ag.pw_c * node.visits ** pw_alpha), pool=getattr(ag, 'node_pool', None))
+
+
+# entries of the dialogue states that the transitions never change, shared between the states of a tree
+SHARED_STATE_KEYS = ['task_background', 'demonstration']
+
+
+def intern_state(state, reference):
+    """
+    Make the constant entries of a state point to the same objects as those of a reference state, so that the
+    deep copies made for the transitions do not keep one copy of them per node.
+    A persistent state (see dyna_gym.envs.dialogue_state) is not modified, a new state sharing the entries is returned.
+    """
+    if not isinstance(state, dict) or not isinstance(reference, dict):
+        return state
+    shared = {key: reference[key] for key in SHARED_STATE_KEYS
+              if key in state and key in reference and state[key] is not reference[key] and state[key] == reference[key]}
+    if len(shared) == 0:
+        return state
+    if isinstance(state, DialogueState):
+        return state.set(**shared)
+    state.update(shared)
+    return state
+
+
+def new_decision_node(ag, parent, state, is_terminal, id=None, fingerprint=None):
+    """
+    Create a DecisionNode whose priors are computed on its first selection, see evaluate_priors.
+    Its children are added lazily if the agent uses progressive widening.
+    The node object is taken from the node pool of the agent, if any.
+    """
+    if parent is not None:
+        state = intern_state(state, parent.parent.state)
+    progressive = getattr(ag, 'pw_alpha', None) is not None
+    pool = getattr(ag, 'node_pool', None)
+    node_class = getattr(ag, 'decision_node_class', DecisionNode)
+    new_node = node_class if pool is None else partial(pool.decision_node, node_class)
+    return new_node(parent, state, ag.action_space.copy(), is_terminal, default_policy=ag.default_policy, id=id,
+                    fingerprint=fingerprint, progressive=progressive, lazy=True)
+
+
+def evaluate_priors(ag, nodes):
+    """
+    Compute the priors of the DecisionNodes that do not have them yet.
+    The default policy is called once on the whole batch of states if it provides get_top_k_tokens_batch.
+    """
+    # unique nodes, in order
+    nodes = list({id(node): node for node in nodes if not node.has_priors}.values())
+    if len(nodes) == 0:
+        return
+    # under progressive widening, the candidates are the width most-likely actions. The width of an agent without
+    # action space and without a width is 0, its candidates are all the actions proposed by the policy
+    kwargs = {'top_k': ag.width} if getattr(ag, 'pw_alpha', None) is not None and ag.width else {}
+    if hasattr(ag.default_policy, 'get_top_k_tokens_batch'):
+        priors = ag.default_policy.get_top_k_tokens_batch([node.state for node in nodes], **kwargs)
+    else:
+        priors = [ag.default_policy.get_top_k_tokens(node.state, **kwargs) for node in nodes]
+    pool = getattr(ag, 'node_pool', None)
+    for node, (actions, scores) in zip(nodes, priors):
+        node.set_priors(actions, scores, pool=pool)
+
+
+def get_transposition_table(ag, env):
+    """
+    The transposition table of the agent, mapping state fingerprints to DecisionNodes.
+    None if the agent has no table or the environment does not provide state fingerprints.
+    """
+    if getattr(env, 'state_fingerprint', None) is None:
+        return None
+    return getattr(ag, 'transposition_table', None)
+
+
+def run_transitions(ag, env, pending, executor=None):
+    """
+    Transitions of the ChanceNodes selected by a round of rollouts.
+    A ChanceNode holding a prefetched transition uses it instead of calling the environment. The other transitions
+    are grouped by parent DecisionNode and each group is evaluated with one env.transition_batch call if the
+    environment provides it. If the agent expands siblings, the unexpanded siblings of the selected ChanceNodes are
+    added to the groups and their transitions are prefetched for the next rollouts that select them.
+    Rollouts selecting the same unexpanded ChanceNode share its transition: the virtual loss does not always push the
+    concurrent rollouts apart (e.g. when the exploration term dominates the values), and the later rollouts continue
+    below the DecisionNode created by the first one instead of recomputing the same transition.
 
     Args:
         ag: the agent
-        tree_policy: the action selection policy
         env: the gym environment
-        done: whether the current state is terminal
-        root: the root of the tree, reuse the tree if not None, otherwise create a new tree
-        term_cond: termination condition, if not None, the procedure will terminate when term_cond() is True
-        ts_mode: the mode for tree search, can be 'sample', 'best'
+        pending: the Rollouts, each one ending with the selected ChanceNode
+        executor: an optional executor used to run the groups concurrently
+
+    Returns:
+        the (next state, reward, terminal) transition of each rollout
     """
-    # ts_mode = 'avg'
-    reward_his = []
-    decision_node_num = 0
-    if root is not None:
-        # if using existing tree, making sure the root is updated correctly
-        assert root.state == env.state
+    outcomes = [None] * len(pending)
+    # parent DecisionNode -> (parent, ChanceNodes, index of the rollout of each ChanceNode or None for a sibling)
+    groups = {}
+    # unexpanded ChanceNode -> index of the first rollout selecting it, and the (rollout, first rollout) duplicates
+    first = {}
+    duplicates = []
+    for i, rollout in enumerate(pending):
+        chance_node = rollout.path[-1]
+        if len(chance_node.children) == 0:
+            if id(chance_node) in first:
+                duplicates.append((i, first[id(chance_node)]))
+                continue
+            first[id(chance_node)] = i
+        if chance_node.prefetched is not None:
+            outcomes[i] = chance_node.prefetched
+            chance_node.prefetched = None
+            continue
+        parent, chance_nodes, indices = groups.setdefault(id(chance_node.parent), (chance_node.parent, [], []))
+        chance_nodes.append(chance_node)
+        indices.append(i)
+    if getattr(ag, 'expand_siblings', False):
+        for parent, chance_nodes, indices in groups.values():
+            selected = {id(chance_node) for chance_node in chance_nodes}
+            for sibling in parent.children:
+                if id(sibling) not in selected and len(sibling.children) == 0 and sibling.prefetched is None:
+                    chance_nodes.append(sibling)
+                    indices.append(None)
+    groups = list(groups.values())
+
+    if getattr(env, 'transition_batch', None) is not None:
+        group_outcomes = map_concurrently(
+            executor, env.transition_batch,
+            [(copy.deepcopy(parent.state), [chance_node.action for chance_node in chance_nodes], ag.is_model_dynamic)
+             for parent, chance_nodes, _ in groups]
+        )
     else:
-        # create an empty tree
-        root = DecisionNode(None, env.state, ag.action_space.copy(), done, default_policy=ag.default_policy,
-                            id=decision_node_num)
-        decision_node_num += 1
+        flat_outcomes = iter(map_concurrently(
+            executor, env.transition,
+            [(copy.deepcopy(parent.state), chance_node.action, ag.is_model_dynamic)
+             for parent, chance_nodes, _ in groups for chance_node in chance_nodes]
+        ))
+        group_outcomes = [[next(flat_outcomes) for _ in chance_nodes] for _, chance_nodes, _ in groups]
+
+    for (_, chance_nodes, indices), group in zip(groups, group_outcomes):
+        for chance_node, i, outcome in zip(chance_nodes, indices, group):
+            if i is None:
+                chance_node.prefetched = outcome
+            else:
+                outcomes[i] = outcome
+    for i, j in duplicates:
+        outcomes[i] = outcomes[j]
+    return outcomes
 
-    for _ in tqdm(range(ag.rollouts), desc="Rolling out", leave=False):
-        if term_cond is not None and term_cond():
-            break
-        rewards = []  # Rewards collected along the tree for the current rollout
-        node = root  # Current node
-        terminal = done
+
+def select_leaves(ag, tree_policy, env, root, n_rollouts, node_ids, executor=None, root_children=None):
+    """
+    Selection and expansion for a round of n_rollouts rollouts.
+    The rollouts descend the tree level by level, every ChanceNode they go through receives a virtual loss so that
+    concurrent rollouts are pushed towards different branches, and the transitions of all rollouts at the same level
+    are evaluated together.
+
+    Args:
+        ag: the agent
+        tree_policy: the action selection policy
+        env: the gym environment
+        root: the root of the tree
+        n_rollouts: number of rollouts selected in this round
+        node_ids: iterator providing the ids of newly created DecisionNodes
+        executor: an optional executor used to run the transitions of a round concurrently
+        root_children: optional list of n_rollouts ChanceNodes of the root, the i-th rollout goes through the i-th
+            one instead of following the tree policy at the root
+
+    Returns:
+        the list of Rollouts, each one pointing to the DecisionNode it selected
+
+    If the agent has a transposition table, the DecisionNodes are looked up by state fingerprint, so that identical
+    states reached through different ChanceNodes share one node. Rollouts are backpropagated along their own path.
+    """
+    table = get_transposition_table(ag, env)
+    profiler = getattr(ag, 'profiler', None)
+    rollouts = [Rollout(root) for _ in range(n_rollouts)]
+    active = rollouts
+    while len(active) > 0:
+        # the priors of the nodes reached by this round are computed in one batch
+        with profile_phase(profiler, 'priors'):
+            evaluate_priors(ag, [rollout.node for rollout in active if not rollout.node.is_terminal])
 
         # Selection
-        select = True
-        while select:
-            if type(node) == DecisionNode:  # DecisionNode
-                if node.is_terminal:
-                    select = False  # Selected a terminal DecisionNode
+        pending = []
+        with profile_phase(profiler, 'selection'):
+            for i, rollout in enumerate(active):
+                if rollout.node.is_terminal:
+                    # Selected a terminal DecisionNode
+                    continue
+                # Move down the tree, node is now a ChanceNode
+                if root_children is not None and rollout.node is root:
+                    # the rollouts are all at the root on the first level, in order
+                    chance_node = root_children[i]
                 else:
-                    node = tree_policy(node.children)  # Move down the tree, node is now a ChanceNode
+                    progressive_widening(ag, rollout.node)
+                    chance_node = tree_policy(rollout.node.children)
+                chance_node.virtual_loss += 1
+                rollout.path.append(chance_node)
+                pending.append(rollout)
+
+        # Expansion
+        # Given s, a, sample s' ~ p(s'|s,a), also get the reward r(s,a,s') and whether s' is terminal
+        # (one call of the 'transitions' phase runs the transitions of all the rollouts at this level)
+        with profile_phase(profiler, 'transitions'):
+            transitions = run_transitions(ag, env, pending, executor=executor)
+
+        active = []
+        for rollout, (state_p, reward, terminal) in zip(pending, transitions):
+            node = rollout.path[-1]
+            rollout.rewards.append(reward)
+            # find if s' is already in the tree, if so point node to the corresponding DecisionNode
+            # and keep on selecting, otherwise create a new DecisionNode for s' and stop
+            fingerprint = None
+            if table is not None:
+                # O(1) lookup, a state reached by another path is shared by both paths
+                fingerprint = env.state_fingerprint(state_p, node.parent.fingerprint)
+                child = table.get(fingerprint.key)
+                if child is not None and child not in node.children:
+                    node.children.append(child)
             else:
-                # ChanceNode
-                # Expansion
-                # Given s, a, sample s' ~ p(s'|s,a), also get the reward r(s,a,s') and whether s' is terminal
-                state_p, reward, terminal = env.transition(copy.deepcopy(node.parent.state), node.action,
-                                                           ag.is_model_dynamic)
-                rewards.append(reward)
-                new_state = True
-                # print('--------------------------')
-                # find if s' is already in the tree, if so point node to the corresponding DecisionNode (and new_state=False)
-                # if not, create a new DecisionNode for s' and point node to it
-                for i in range(len(node.children)):
-                    if env.equality_operator(node.children[i].state, state_p):
-                        # s' is already in the tree
-                        node = node.children[i]
-                        new_state = False
-                        break
-                # the child node that has not been explored yet
-                if new_state:
-                    # Selected a node for expansion
-                    select = False
-                    # Expansion to create a new DecisionNode
-                    new_node = DecisionNode(node, state_p, ag.action_space.copy(), terminal,
-                                            default_policy=ag.default_policy, id=decision_node_num)
-                    node.children.append(new_node)
-                    decision_node_num += 1
-                    node = node.children[-1]
-
-        # Simulation from the chosen child node
-        # now `rewards` collected all rewards in the ChanceNodes above this node
-        assert (type(node) == DecisionNode)
-        state = node.state
-        current_state = state
-
-        # do not have any default policy
-        # if ag.default_policy is None:
-        # retrieval
-        # the agent estimate the reward based on a memory
-        # it should run this step with a high probability.
-        if memory is not None:
+                child = next((c for c in node.children if env.equality_operator(c.state, state_p)), None)
+            if child is not None:
+                rollout.node = child
+                active.append(rollout)
+            else:
+                # Expansion to create a new DecisionNode
+                new_node = new_decision_node(ag, node, state_p, terminal, id=next(node_ids), fingerprint=fingerprint)
+                node.children.append(new_node)
+                if table is not None:
+                    table[fingerprint.key] = new_node
+                rollout.node = new_node
+                rollout.expanded = True
+    return rollouts
+
+
+def evaluate_leaf(ag, state, is_terminal, rewards, memory=None, k=10, reward_his=None, env=None):
+    """
+    Estimate the value of the state selected by a rollout, either with the memory or by simulating
+    the rest of the conversation with the default policy.
+
+    Args:
+        ag: the agent
+        state: the state of the selected DecisionNode
+        is_terminal: whether the selected DecisionNode is terminal
+        rewards: the transition rewards collected by the rollout
+        env: the environment, its count_llm_calls method (if any) records the LLM calls of the assessment for the
+            search budget. The user simulator calls of the default policy are counted by the policy itself
+    """
+    current_state = state
+    # reward of the last transition
+    reward = rewards[-1] if len(rewards) > 0 else 0
+
+    # do not have any default policy
+    # if ag.default_policy is None:
+    # retrieval
+    # the agent estimate the reward based on a memory
+    # it should run this step with a high probability.
+    profiler = getattr(ag, 'profiler', None)
+    if memory is not None:
+        with profile_phase(profiler, 'memory_retrieval'):
             estimate = compute_reward_based_on_memory(state=state, memory=memory, k=k)
-            # transition reward + state value
-            estimate += reward * (ag.gamma)
+        # transition reward + state value
+        estimate += reward * (ag.gamma)
+        if reward_his is not None:
             reward_his.append(estimate)
-            # if estimate is 0, then we dont have node memory approximation.
-            # estimate = 0
-            # estimate = reward
+        # if estimate is 0, then we dont have node memory approximation.
+        # estimate = 0
+        # estimate = reward
 
-        # simulation step
-        # the agent follow a random/predefined policy to generate a completed conversation
-        else:
-            # rollouts to estimate future reward.
-            if not node.is_terminal:
-                # # follow the default policy to get a terminal state
-                # # only used for vanilla mcts
+    # simulation step
+    # the agent follow a random/predefined policy to generate a completed conversation
+    else:
+        # rollouts to estimate future reward.
+        if not is_terminal:
+            # # follow the default policy to get a terminal state
+            # # only used for vanilla mcts
+            with profile_phase(profiler, 'simulation'):
                 simulated_conversation = ag.default_policy.get_predicted_sequence(state)
 
-                # estimate = env.get_reward(simulated_conversation, state['task_background']['target_topic'],
-                #                           state['task_background']['target_goal'])
+            # estimate = env.get_reward(simulated_conversation, state['task_background']['target_topic'],
+            #                           state['task_background']['target_goal'])
 
-                #llm-based assessment
+            #llm-based assessment
+            with profile_phase(profiler, 'llm_assessment'):
+                if hasattr(env, 'count_llm_calls'):
+                    env.count_llm_calls(1)
                 estimate = get_llm_based_assessment(state['task_background']['target_topic'], simulated_conversation, None, n = 1)
 
 
-                ag.rolled_out_trajectories.append(simulated_conversation)
-                ag.rolled_out_rewards.append(estimate)
+            ag.rolled_out_trajectories.append(simulated_conversation)
+            ag.rolled_out_rewards.append(estimate)
 
-                # intermediate reward = 0
-                estimate = reward * (ag.gamma)
+            # intermediate reward = 0
+            estimate = reward * (ag.gamma)
 
-                # also save this to current nodes for possible visualization
-                # node.info['complete_program'] = simulated_conversation
-                # # save the simulated results
-                # with open(out_path, 'a') as f:
-                #     save_simulated_results(f, state, simulated_conversation)
-            else:
-                # the rewards are defined on terminating actions, the terminal states have no rewards
-                estimate = 0
-
-        if ag.lambda_coeff > 0:
-            assert ag.value_func is not None, "value_func must be provided if lambda_coeff > 0"
-            state_ids = current_state[0]
-            value = ag.value_func(state_ids)
-            estimate = ag.lambda_coeff * value + (1 - ag.lambda_coeff) * estimate
-
-        # Backpropagation
-        node.visits += 1
-        node = node.parent
-        assert (type(node) == ChanceNode)
-        while node:
-            if len(rewards) != 0:
-                estimate = rewards.pop() + ag.gamma * estimate
-            # estimate is the memory base estimation
-            # moving average
-            # node.sampled_returns.append(avg_reward)
-            node.sampled_returns.append(estimate)
-            node.parent.visits += 1
-            node = node.parent.parent
-        # should finish backpro-pagating all the rewards
-        assert len(rewards) == 0
+            # also save this to current nodes for possible visualization
+            # node.info['complete_program'] = simulated_conversation
+            # # save the simulated results
+            # with open(out_path, 'a') as f:
+            #     save_simulated_results(f, state, simulated_conversation)
+        else:
+            # the rewards are defined on terminating actions, the terminal states have no rewards
+            estimate = 0
+
+    if ag.lambda_coeff > 0:
+        assert ag.value_func is not None, "value_func must be provided if lambda_coeff > 0"
+        state_ids = current_state[0]
+        value = ag.value_func(state_ids)
+        estimate = ag.lambda_coeff * value + (1 - ag.lambda_coeff) * estimate
+    return estimate
+
+
+def backpropagate(ag, rollout, estimate):
+    """
+    Backpropagate the estimate of a rollout along the ChanceNodes it went through,
+    releasing the virtual losses taken during selection.
+    """
+    rewards = list(rollout.rewards)
+    rollout.node.visits += 1
+    for node in reversed(rollout.path):
+        if len(rewards) != 0:
+            estimate = rewards.pop() + ag.gamma * estimate
+        # estimate is the memory base estimation
+        node.add_return(estimate)
+        node.virtual_loss -= 1
+        node.parent.visits += 1
+    # should finish backpro-pagating all the rewards
+    assert len(rewards) == 0
+
+
+def reachable_nodes(root):
+    """
+    All the DecisionNodes of a tree, each one once even if it is shared by several ChanceNodes
+    """
+    seen = {id(root): root}
+    stack = [root]
+    while len(stack) > 0:
+        node = stack.pop()
+        for chance_node in node.children:
+            for child in chance_node.children:
+                if id(child) not in seen:
+                    seen[id(child)] = child
+                    stack.append(child)
+    return list(seen.values())
+
+
+def prune_tree(ag, root, target):
+    """
+    Cut the least visited subtrees until the tree has at most target DecisionNodes.
+    The statistics of the ChanceNodes above a cut are kept, the cut DecisionNodes are created again if a rollout
+    reaches them. The cut nodes are released to the node pool of the agent and dropped from its transposition table.
+
+    Args:
+        ag: the agent
+        root: the root of the tree, which is never cut
+        target: maximum number of DecisionNodes after pruning
+
+    Returns:
+        the number of DecisionNodes removed
+    """
+    nodes = reachable_nodes(root)
+    # size of the subtree of each node, counting the shared nodes under their first parent only
+    size = {id(node): 1 for node in nodes}
+    for node in sorted(nodes, key=lambda n: n.depth, reverse=True):
+        if node is not root and id(node.parent.parent) in size:
+            size[id(node.parent.parent)] += size[id(node)]
+
+    # least visited first, deepest first among equally visited nodes
+    n_removed = 0
+    cut = set()
+    for node in sorted(nodes, key=lambda n: (n.visits, -n.depth)):
+        if n_removed >= len(nodes) - target:
+            break
+        if node is root:
+            continue
+        ancestor = node.parent.parent
+        while ancestor is not None and id(ancestor) not in cut:
+            ancestor = ancestor.parent.parent if ancestor.parent is not None else None
+        if ancestor is not None:
+            # already removed with one of its ancestors
+            continue
+        cut.add(id(node))
+        n_removed += size[id(node)]
+
+    for node in nodes:
+        for chance_node in node.children:
+            chance_node.children = [child for child in chance_node.children if id(child) not in cut]
+
+    kept = reachable_nodes(root)
+    kept_ids = {id(node) for node in kept}
+    removed = [node for node in nodes if id(node) not in kept_ids]
+    table = getattr(ag, 'transposition_table', None)
+    if table:
+        for node in removed:
+            if node.fingerprint is not None and table.get(node.fingerprint.key) is node:
+                del table[node.fingerprint.key]
+    pool = getattr(ag, 'node_pool', None)
+    if pool is not None:
+        pool.release(removed)
+    ag.n_nodes = len(kept)
+    return len(removed)
+
+
+def init_root(ag, env, done, root, node_ids):
+    """
+    Create the root of the tree for env.state, or check that a reused root is labelled by env.state
+    """
+    if root is not None:
+        # if using existing tree, making sure the root is updated correctly
+        assert env.equality_operator(root.state, env.state)
+    else:
+        # create an empty tree
+        root = new_decision_node(ag, None, env.state, done, id=next(node_ids))
+
+    table = get_transposition_table(ag, env)
+    if table is not None:
+        if root.fingerprint is None:
+            root.fingerprint = env.state_fingerprint(root.state)
+        table[root.fingerprint.key] = root
+    # the action is chosen among the children of the root, even if no rollout is run
+    evaluate_priors(ag, [root])
+    progressive_widening(ag, root)
+    if getattr(ag, 'max_nodes', None) is not None:
+        ag.n_nodes = len(reachable_nodes(root))
+    return root
+
+
+def run_rollouts(ag, tree_policy, env, root, n_rollouts, node_ids, memory=None, k=10, reward_his=None, executor=None,
+                 root_children=None):
+    """
+    Run a round of n_rollouts rollouts: selection and expansion, simulation and backpropagation, see select_leaves
+    """
+    # Selection and expansion
+    selected = select_leaves(ag, tree_policy, env, root, n_rollouts, node_ids, executor=executor,
+                             root_children=root_children)
+
+    # Simulation from the chosen child nodes
+    # now `rollout.rewards` collected all rewards in the ChanceNodes above the selected node
+    estimates = map_concurrently(executor, evaluate_leaf,
+                                 [(ag, rollout.node.state, rollout.node.is_terminal, rollout.rewards, memory,
+                                   k, reward_his, env) for rollout in selected])
+
+    # Backpropagation
+    with profile_phase(getattr(ag, 'profiler', None), 'backpropagation'):
+        for rollout, estimate in zip(selected, estimates):
+            backpropagate(ag, rollout, estimate)
+
+    # keep the tree within the node budget of the agent
+    if getattr(ag, 'max_nodes', None) is not None:
+        ag.n_nodes += sum(rollout.expanded for rollout in selected)
+        if ag.n_nodes > ag.max_nodes:
+            with profile_phase(getattr(ag, 'profiler', None), 'pruning'):
+                prune_tree(ag, root, int(ag.prune_ratio * ag.max_nodes))
+
+
+def mcts_procedure(ag, tree_policy, env, done, memory=None, k=10, root=None, term_cond=None, ts_mode="sample",
+                   out_path="memory_reward", parallel_rollouts=1, rollouts=None):
+    """
+    Compute the entire MCTS procedure wrt to the selected tree policy.
+    Funciton tree_policy is a function taking an agent + a list of ChanceNodes as argument
+    and returning the one chosen by the tree policy.
+
+    Args:
+        ag: the agent
+        tree_policy: the action selection policy
+        env: the gym environment
+        done: whether the current state is terminal
+        root: the root of the tree, reuse the tree if not None, otherwise create a new tree
+        term_cond: termination condition, if not None, the procedure will terminate when term_cond() is True
+        ts_mode: the mode for tree search, can be 'sample', 'best'
+        parallel_rollouts: number of rollouts selected concurrently in each round (leaf parallelisation).
+            The transitions and leaf evaluations of a round run together and are backpropagated once the round ends.
+        rollouts: number of rollouts to run, default is ag.rollouts
+    """
+    # ts_mode = 'avg'
+    reward_his = []
+    node_ids = itertools.count()
+    root = init_root(ag, env, done, root, node_ids)
+
+    if rollouts is None:
+        rollouts = ag.rollouts
+
+    executor = ThreadPoolExecutor(max_workers=parallel_rollouts) if parallel_rollouts > 1 else None
+    n_rollouts = 0
+    early_stop = getattr(ag, 'early_stop', None)
+    ag.early_stopped = False
+    try:
+        with tqdm(total=rollouts, desc="Rolling out", leave=False) as pbar:
+            while n_rollouts < rollouts:
+                if term_cond is not None and term_cond():
+                    break
+                if early_stop is not None and root_is_decided(root, rollouts - n_rollouts, criterion=early_stop,
+                                                              z=ag.early_stop_z, min_visits=ag.early_stop_min_visits):
+                    ag.early_stopped = True
+                    break
+                n_round = min(parallel_rollouts, rollouts - n_rollouts)
+                run_rollouts(ag, tree_policy, env, root, n_round, node_ids, memory=memory, k=k,
+                             reward_his=reward_his, executor=executor)
+                n_rollouts += n_round
+                pbar.update(n_round)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    # number of rollouts actually run, lower than the budget if term_cond stopped the search
+    ag.completed_rollouts = n_rollouts
 
     # save the memory-based reward
     # use to compute state value variance.
@@ -190,40 +648,143 @@ def mcts_procedure(ag, tree_policy, env, done, memory=None, k=10, root=None, ter
     # with open(save_path, 'wb') as f:
     #     pickle.dump(reward_his, f)
 
+    if ag.early_stopped:
+        # the search stopped because this child cannot be overtaken, choosing by ts_mode could pick another one
+        best = decided_child(root, criterion=early_stop)
+        if best is not None:
+            return best.action, root, reward_his
     return max(root.children, key=lambda n: chance_node_value(n, mode=ts_mode)).action, root, reward_his
 
 
+def sequential_halving_procedure(ag, tree_policy, env, done, memory=None, k=10, root=None, term_cond=None,
+                                 parallel_rollouts=1, rollouts=None, m=4, c_visit=50., c_scale=1.):
+    """
+    MCTS procedure with Gumbel sampling and sequential halving at the root (Danihelka et al., 2022).
+    m root actions are sampled without replacement from the prior with the Gumbel-top-k trick. The rollout budget is
+    split into ceil(log2(m)) phases, each phase visits the remaining actions equally then keeps the best half
+    according to g + log(prior) + sigma(q), where g is the Gumbel noise of the action and sigma a monotone
+    transformation of its normalised value. The last remaining action is returned. Below the root, the rollouts
+    follow tree_policy.
+
+    Args:
+        ag: the agent
+        tree_policy: the action selection policy below the root
+        env: the gym environment
+        done: whether the current state is terminal
+        root: the root of the tree, reuse the tree if not None, otherwise create a new tree
+        term_cond: termination condition, if not None, the procedure will terminate when term_cond() is True
+        parallel_rollouts: number of rollouts run concurrently in each round
+        rollouts: number of rollouts to run, default is ag.rollouts
+        m: number of sampled root actions
+        c_visit, c_scale: constants of sigma(q) = (c_visit + max visits) * c_scale * q
+    """
+    reward_his = []
+    node_ids = itertools.count()
+    root = init_root(ag, env, done, root, node_ids)
+    # every possible action of the root can be sampled
+    root.widen(len(root.possible_actions), pool=getattr(ag, 'node_pool', None))
+
+    if rollouts is None:
+        rollouts = ag.rollouts
+
+    # Gumbel-top-m sampling of the root actions
+    gumbels = {child: -math.log(random.expovariate(1.)) for child in root.children}
+    logits = {child: gumbels[child] + math.log(max(child.prob, 1e-12)) for child in root.children}
+    candidates = sorted(root.children, key=lambda n: logits[n], reverse=True)[:m]
+
+    def score(node):
+        visited = [child for child in root.children if child.n_returns > 1]
+        if node.n_returns <= 1 or len(visited) == 0:
+            return logits[node]
+        values = [chance_node_value(child, mode="sample") for child in visited]
+        low, high = min(values), max(values)
+        q = (chance_node_value(node, mode="sample") - low) / (high - low) if high > low else 0.5
+        max_visits = max(child.n_returns - 1 for child in root.children)
+        return logits[node] + (c_visit + max_visits) * c_scale * q
+
+    if len(candidates) == 0:
+        if len(root.children) > 0:
+            # m < 1, no action is sampled: search without sequential halving
+            return mcts_procedure(ag, tree_policy, env, done, memory=memory, k=k, root=root, term_cond=term_cond,
+                                  parallel_rollouts=parallel_rollouts, rollouts=rollouts)
+        # the root has no possible action (e.g. the policy returned no prediction), there is nothing to search
+        ag.completed_rollouts = 0
+        ag.early_stopped = False
+        return prior_action(ag, root), root, reward_his
+
+    n_phases = max(1, math.ceil(math.log2(len(candidates))))
+    executor = ThreadPoolExecutor(max_workers=parallel_rollouts) if parallel_rollouts > 1 else None
+    n_rollouts = 0
+    try:
+        with tqdm(total=rollouts, desc="Rolling out", leave=False) as pbar:
+            for phase in range(n_phases):
+                if len(candidates) == 1 or n_rollouts >= rollouts:
+                    break
+                if phase == n_phases - 1:
+                    # the last phase uses what is left of the budget
+                    visits = max(1, (rollouts - n_rollouts) // len(candidates))
+                else:
+                    visits = max(1, rollouts // (n_phases * len(candidates)))
+                schedule = [child for _ in range(visits) for child in candidates][:rollouts - n_rollouts]
+                for start in range(0, len(schedule), parallel_rollouts):
+                    if term_cond is not None and term_cond():
+                        break
+                    root_children = schedule[start:start + parallel_rollouts]
+                    run_rollouts(ag, tree_policy, env, root, len(root_children), node_ids, memory=memory, k=k,
+                                 reward_his=reward_his, executor=executor, root_children=root_children)
+                    n_rollouts += len(root_children)
+                    pbar.update(len(root_children))
+                candidates = sorted(candidates, key=score, reverse=True)[:math.ceil(len(candidates) / 2)]
+                if term_cond is not None and term_cond():
+                    break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    ag.completed_rollouts = n_rollouts
+    ag.early_stopped = False
+
+    return max(candidates, key=score).action, root, reward_his
+
+
 class DecisionNode:
     """
     Decision node class, labelled by a state
 
     Args:
         default_policy: default policy, used to prioritize and filter possible actions
+        top_k: number of candidate actions requested from the default policy, default is the policy's own
+        progressive: if True, the children are not created at once but added by widen(), in decreasing prior order
+        lazy: if True, the default policy is not called here, the priors are set later by set_priors()
     """
 
-    def __init__(self, parent, state, possible_actions=[], is_terminal=False, default_policy=None, id=None):
+    def __init__(self, parent, state, possible_actions=[], is_terminal=False, default_policy=None, id=None,
+                 fingerprint=None, top_k=None, progressive=False, lazy=False):
         self.id = id
         self.parent = parent
         self.state = state
+        # canonical fingerprint of the state, only set if the environment provides one
+        self.fingerprint = fingerprint
         self.is_terminal = is_terminal
         if self.parent is None:  # Root node
             self.depth = 0
         else:  # Non root node
             self.depth = parent.depth + 1
+        self.progressive = progressive
+        self.children = []
+        self.has_priors = False
+        self.possible_actions = []
+        self.action_scores = []
         if default_policy is None:
-            self.possible_actions = possible_actions
-            random.shuffle(self.possible_actions)
+            random.shuffle(possible_actions)
             # if no default policy is provided, assume selection probability is uniform
-            self.action_scores = [1.0 / len(self.possible_actions)] * len(self.possible_actions)
-        else:
+            self.set_priors(possible_actions, [1.0 / len(possible_actions)] * len(possible_actions))
+        elif not lazy:
             # get possible actions from default policy
-            top_k_predict, top_k_scores = default_policy.get_top_k_tokens(self.state)
-            self.possible_actions = top_k_predict
-            self.action_scores = top_k_scores
-
-        # populate its children
-        self.children = [ChanceNode(self, (act, score))
-                         for act, score in zip(self.possible_actions, self.action_scores)]
+            if top_k is None:
+                top_k_predict, top_k_scores = default_policy.get_top_k_tokens(self.state)
+            else:
+                top_k_predict, top_k_scores = default_policy.get_top_k_tokens(self.state, top_k=top_k)
+            self.set_priors(top_k_predict, top_k_scores)
 
         self.explored_children = 0
         # this decision node should be visited at least once, otherwise p-uct makes no sense for this node
@@ -235,6 +796,26 @@ class DecisionNode:
     def is_fully_expanded(self):
         return all([child.expanded() for child in self.children])
 
+    def set_priors(self, possible_actions, action_scores, pool=None):
+        """
+        Set the possible actions of the node and their prior probabilities, and populate its children
+        """
+        self.possible_actions = possible_actions
+        self.action_scores = action_scores
+        self.has_priors = True
+        if not self.progressive:
+            self.widen(len(self.possible_actions), pool=pool)
+
+    def widen(self, n_children, pool=None):
+        """
+        Add the next possible actions as children until the node has n_children children,
+        the ChanceNode objects are taken from pool if given
+        """
+        new_node = self.chance_node_class if pool is None else partial(pool.chance_node, self.chance_node_class)
+        n_children = min(n_children, len(self.possible_actions))
+        for i in range(len(self.children), n_children):
+            self.children.append(new_node(self, (self.possible_actions[i], self.action_scores[i])))
+
 
 class ChanceNode:
     """
@@ -248,12 +829,120 @@ class ChanceNode:
         self.depth = parent.depth
         self.children = []
         self.prob = action_and_score[1]  # the probability that this action should be token, provided by default policy
-        self.sampled_returns = [0]
-        self.memory_sampled_returns = []
+        # running statistics of the sampled returns, which start with a single 0 return
+        self.n_returns = 1
+        self.sum_returns = 0.
+        self.max_return = 0.
+        self.last_return = 0.
+        # Welford's online mean and sum of squared deviations of the returns
+        self.mean_return = 0.
+        self.m2_returns = 0.
+        # number of in-flight rollouts going through this node, see select_leaves
+        self.virtual_loss = 0
+        # transition computed ahead of the first selection of this node, see run_transitions
+        self.prefetched = None
 
     def expanded(self):
         return len(self.children) > 0
 
+    def add_return(self, value):
+        """
+        Update the running statistics with a new sampled return
+        """
+        self.n_returns += 1
+        self.sum_returns += value
+        self.max_return = max(self.max_return, value)
+        self.last_return = value
+        delta = value - self.mean_return
+        self.mean_return += delta / self.n_returns
+        self.m2_returns += delta * (value - self.mean_return)
+
+    def merge_returns(self, n_returns, sum_returns, max_return, last_return, m2_returns):
+        """
+        Merge the statistics of returns sampled by another search, using the pairwise update of the variance
+
+        Args:
+            n_returns: number of returns to merge
+            sum_returns: sum of the returns to merge
+            max_return: maximum of the returns to merge
+            last_return: last of the returns to merge
+            m2_returns: sum of squared deviations of the returns to merge from their mean
+        """
+        n = self.n_returns + n_returns
+        delta = sum_returns / n_returns - self.mean_return
+        self.mean_return += delta * n_returns / n
+        self.m2_returns += m2_returns + delta ** 2 * self.n_returns * n_returns / n
+        self.n_returns = n
+        self.sum_returns += sum_returns
+        self.max_return = max(self.max_return, max_return)
+        self.last_return = last_return
+
+    @property
+    def return_variance(self):
+        """
+        Unbiased variance of the sampled returns
+        """
+        if self.n_returns < 2:
+            return 0.
+        return self.m2_returns / (self.n_returns - 1)
+
+
+# class of the children of a DecisionNode, overridden by the nodes of dyna_gym.agents.array_tree
+DecisionNode.chance_node_class = ChanceNode
+
+
+class NodePool:
+    """
+    Free list of DecisionNode and ChanceNode objects.
+    The nodes released by pruning or by dropping a tree are reinitialised for the next nodes instead of allocating
+    new objects, so that long runs do not keep growing the heap of the process.
+
+    Args:
+        max_size: maximum number of free nodes of each kind kept in the pool
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.decision_nodes = []
+        self.chance_nodes = []
+
+    def decision_node(self, node_class, *args, **kwargs):
+        return self.reuse(self.decision_nodes, node_class, *args, **kwargs)
+
+    def chance_node(self, node_class, *args, **kwargs):
+        return self.reuse(self.chance_nodes, node_class, *args, **kwargs)
+
+    @staticmethod
+    def reuse(free_nodes, node_class, *args, **kwargs):
+        """
+        Reinitialise a free node of class node_class, or create one if the pool has none
+        """
+        if len(free_nodes) == 0 or type(free_nodes[-1]) is not node_class:
+            return node_class(*args, **kwargs)
+        node = free_nodes.pop()
+        node.__init__(*args, **kwargs)
+        return node
+
+    def release(self, nodes):
+        """
+        Put DecisionNodes, which must not be part of a tree anymore, and their ChanceNodes back in the pool.
+        Their references to states and other nodes are cleared so that these can be garbage-collected.
+        """
+        for node in nodes:
+            for chance_node in node.children:
+                chance_node.parent = None
+                chance_node.children = []
+                chance_node.prefetched = None
+                if len(self.chance_nodes) < self.max_size:
+                    self.chance_nodes.append(chance_node)
+            node.parent = None
+            node.state = None
+            node.fingerprint = None
+            node.children = []
+            node.info = {}
+            if len(self.decision_nodes) < self.max_size:
+                self.decision_nodes.append(node)
+
 
 class MCTS(object):
     """
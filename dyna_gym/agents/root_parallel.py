@@ -0,0 +1,141 @@
+"""
+Root-parallel MCTS
+
+The UCT agent can run several independent searches from the same root in separate worker processes, each with its
+own random seed and its own replica of the models. Only the statistics of the ChanceNodes of the root are sent back,
+they are merged into a single root from which the action is chosen. The workers never share a tree, so no locking
+is needed, and averaging independent searches reduces the variance of the root values.
+
+The worker processes are started once with a copy of the agent and the environment, and are reused for every call.
+"""
+import random
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from dyna_gym.agents import mcts
+
+# agent and environment of a worker process, set by init_worker
+_worker_agent = None
+_worker_env = None
+
+
+def init_worker(agent, env):
+    global _worker_agent, _worker_env
+    _worker_agent = agent
+    _worker_env = env
+    # the workers run plain sequential searches
+    _worker_agent.num_workers = 1
+    _worker_agent.reuse_tree = False
+
+
+def worker_search(state, done, rollouts, seed):
+    """
+    Run one search in a worker process and return the statistics of the root
+
+    Args:
+        state: the state of the root
+        done: whether the state is terminal
+        rollouts: number of rollouts of this worker
+        seed: random seed of this worker
+    """
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    torch.manual_seed(seed)
+
+    ag, env = _worker_agent, _worker_env
+    ag.reset()
+    ag.global_reward_his = []
+    ag.rollouts = rollouts
+    env.reset(state)
+    n_transitions = getattr(env, 'n_transitions', 0)
+    n_llm_calls = getattr(env, 'n_llm_calls', 0)
+    ag.act(env, done)
+    return {
+        'children': [(c.action, c.prob, c.n_returns, c.sum_returns, c.max_return, c.last_return, c.m2_returns)
+                     for c in ag.root.children],
+        'visits': ag.root.visits,
+        'rollouts': ag.completed_rollouts,
+        'early_stopped': getattr(ag, 'early_stopped', False),
+        'reward_his': ag.global_reward_his,
+        'transitions': getattr(env, 'n_transitions', 0) - n_transitions,
+        'llm_calls': getattr(env, 'n_llm_calls', 0) - n_llm_calls,
+    }
+
+
+def split_rollouts(rollouts, num_workers):
+    """
+    Split a rollout budget as evenly as possible among the workers
+    """
+    return [rollouts // num_workers + (1 if i < rollouts % num_workers else 0) for i in range(num_workers)]
+
+
+def merge_root(root, results):
+    """
+    Merge the root statistics of the workers into the ChanceNodes of root
+
+    Args:
+        root: a DecisionNode labelled by the state the workers searched from
+        results: outputs of worker_search
+    """
+    root.widen(len(root.possible_actions))
+    children = {child.action: child for child in root.children}
+    for result in results:
+        root.visits += result['visits'] - 1
+        for action, prob, n_returns, sum_returns, max_return, last_return, m2_returns in result['children']:
+            if action not in children:
+                children[action] = root.chance_node_class(root, (action, prob))
+                root.children.append(children[action])
+            # the returns of each worker start with a 0 that is already counted in the merged node, leave it out
+            n = n_returns - 1
+            if n == 0:
+                continue
+            mean = sum_returns / n
+            m2 = m2_returns - mean * sum_returns / n_returns
+            children[action].merge_returns(n, sum_returns, max_return, last_return, m2)
+    return root
+
+
+class RootParallelSearch:
+    """
+    Pool of worker processes running root-parallel searches for an agent
+
+    Args:
+        agent: the agent, copied to each worker
+        env: the environment, copied to each worker
+        num_workers: number of worker processes
+    """
+
+    def __init__(self, agent, env, num_workers):
+        self.num_workers = num_workers
+        # spawn, so that the workers can use CUDA
+        self.pool = mp.get_context('spawn').Pool(num_workers, initializer=init_worker, initargs=(agent, env))
+
+    def search(self, ag, env, done, rollouts):
+        """
+        Run num_workers searches from env.state and merge them into a new root
+
+        Returns:
+            the merged root and the memory-based rewards of all the workers
+        """
+        seeds = [random.randrange(2 ** 63) for _ in range(self.num_workers)]
+        args = [(env.state, done, n, seed)
+                for n, seed in zip(split_rollouts(rollouts, self.num_workers), seeds) if n > 0]
+        results = self.pool.starmap(worker_search, args)
+
+        root = mcts.new_decision_node(ag, None, env.state, done)
+        mcts.evaluate_priors(ag, [root])
+        root = merge_root(root, results)
+        # account the calls made by the workers on the environment of the agent
+        base_env = getattr(env, 'unwrapped', env)
+        for counter, key in [('n_transitions', 'transitions'), ('n_llm_calls', 'llm_calls')]:
+            if hasattr(base_env, counter):
+                setattr(base_env, counter, getattr(base_env, counter) + sum(result[key] for result in results))
+        ag.completed_rollouts = sum(result['rollouts'] for result in results)
+        ag.early_stopped = any(result['early_stopped'] for result in results)
+        return root, [reward for result in results for reward in result['reward_his']]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
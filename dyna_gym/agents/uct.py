@@ -9,7 +9,11 @@ env.equality_operator(s1, s2)
 """
 
 import dyna_gym.agents.mcts as mcts
+from dyna_gym.agents import array_tree, root_parallel
+from dyna_gym.agents.budget import SearchBudget
 from dyna_gym.utils.utils import combinations
+from dyna_gym.utils.profiling import tree_size
+from dyna_gym.utils import tree_snapshot
 from math import sqrt, log
 from gym import spaces
 
@@ -37,6 +41,24 @@ class UCT(object):
             k=10,
             lambda_coeff=0.,
             value_func=None,
+            parallel_rollouts=1,
+            virtual_loss=1.,
+            tree_backend='object',
+            time_budget=None,
+            max_transitions=None,
+            max_llm_calls=None,
+            pw_alpha=None,
+            pw_c=1.,
+            num_workers=1,
+            profiler=None,
+            early_stop=None,
+            early_stop_z=2.,
+            early_stop_min_visits=5,
+            gumbel_m=4,
+            max_nodes=None,
+            prune_ratio=0.8,
+            scheduler=None,
+            expand_siblings=False,
     ):
         """
         Args:
@@ -51,7 +73,43 @@ class UCT(object):
             default_policy: an optional default policy that returns a most-likely sequence and top-k most-likely next tokens
             ts_mode: the mode for tree search, can be 'sample', 'best'
             reuse_tree: whether to reuse the tree from the previous step if the algorithm is called multiple times
-            alg: exact UCT algorithm to use, can be 'uct', 'p_uct', 'var_p_uct'
+            alg: exact UCT algorithm to use, can be 'uct', 'p_uct', 'var_p_uct', or 'gumbel' to sample gumbel_m root
+                actions from the prior and allocate the rollouts among them by sequential halving, see
+                mcts.sequential_halving_procedure, the nodes below the root are selected with p_uct
+            parallel_rollouts: number of rollouts selected concurrently before their transitions are evaluated
+                together, 1 runs the rollouts one after another
+            virtual_loss: value penalty applied to a chance node for each in-flight rollout going through it
+            tree_backend: 'object' for a tree of DecisionNode/ChanceNode objects, 'array' for a tree whose
+                children statistics are stored in NumPy arrays and scored with one vectorized expression, which is
+                faster on wide nodes, see dyna_gym.agents.array_tree
+            time_budget: wall-clock budget of a call to act in seconds, None for no limit. When the budget runs out,
+                the search stops and the best action found so far is returned
+            max_transitions: maximum number of env.transition calls of a call to act, None for no limit
+            max_llm_calls: maximum number of LLM calls (user simulator and assessment) of a call to act, None for no
+                limit. Like the other limits, it is checked between rounds of parallel_rollouts rollouts
+            pw_alpha: exponent of progressive widening, None to disable it. A decision node visited n times has
+                ceil(pw_c * n^pw_alpha) children, taken in decreasing prior order among the width most-likely actions
+            pw_c: constant of progressive widening
+            num_workers: number of independent searches run in parallel processes from the same root (root
+                parallelisation), the statistics of the root ChanceNodes are merged before choosing the action.
+                1 runs the search in the current process
+            profiler: an optional dyna_gym.utils.profiling.SearchProfiler recording the duration of the phases of
+                each search and the size of the tree
+            early_stop: optional criterion ending a search once the action at the root is settled, see
+                mcts.root_is_decided. 'visits' stops when the most visited child cannot be overtaken with the remaining
+                rollouts, 'lcb' when the confidence bounds of the best child and the others are separated. The action
+                of that child is returned, see mcts.decided_child
+            early_stop_z: width of the confidence bounds of the 'lcb' criterion, in standard errors
+            early_stop_min_visits: number of returns a child needs before being compared by the 'lcb' criterion
+            gumbel_m: number of root actions sampled by the 'gumbel' alg
+            max_nodes: optional budget of DecisionNodes of the tree. When a search exceeds it, the least visited
+                subtrees are cut (mcts.prune_tree) and the nodes are recycled through a node pool
+            prune_ratio: fraction of max_nodes kept by pruning
+            scheduler: an optional budget.RolloutScheduler deciding the number of rollouts of each call to act from a
+                conversation-level budget, instead of using rollouts for every call
+            expand_siblings: whether the first expansion below a DecisionNode also computes the transitions of its
+                other unexpanded ChanceNodes, in one env.transition_batch call if the environment provides it. The
+                transitions are kept on the ChanceNodes until a rollout selects them, see mcts.run_transitions
         """
         if type(action_space) == spaces.discrete.Discrete:
             self.action_space = list(combinations(action_space))
@@ -75,29 +133,172 @@ class UCT(object):
 
         self.global_reward_his = []
 
+        self.alg = alg
+        self.gumbel_m = gumbel_m
+        if tree_backend not in ['object', 'array']:
+            raise Exception(f'unknown tree backend {tree_backend}')
+        self.tree_backend = tree_backend
+        self.decision_node_class = array_tree.ArrayDecisionNode if tree_backend == 'array' else mcts.DecisionNode
+        self.set_tree_policy()
+        if alg == 'var_p_uct':
+            self.ucb_base = ucb_base
+
+        self.lambda_coeff = lambda_coeff
+        self.value_func = value_func
+
+        self.parallel_rollouts = parallel_rollouts
+        self.virtual_loss = virtual_loss
+
+        if early_stop not in [None, 'visits', 'lcb']:
+            raise Exception(f'unknown early stop criterion {early_stop}')
+        self.early_stop = early_stop
+        self.early_stop_z = early_stop_z
+        self.early_stop_min_visits = early_stop_min_visits
+        self.early_stopped = False
+        self.scheduler = scheduler
+        self.max_nodes = max_nodes
+        self.prune_ratio = prune_ratio
+        self.n_nodes = 0
+        self.node_pool = mcts.NodePool(max_nodes) if max_nodes is not None else None
+        self.num_workers = num_workers
+        # worker processes, started at the first call to act
+        self.root_parallel = None
+
+        self.pw_alpha = pw_alpha
+        self.pw_c = pw_c
+
+        self.expand_siblings = expand_siblings
+
+        self.budget = SearchBudget(time_budget=time_budget, max_transitions=max_transitions,
+                                   max_llm_calls=max_llm_calls)
+        # statistics of the last call to act
+        self.search_info = {}
+        # whether the last call to reroot kept a subtree, reported in the search_info of the next call to act
+        self.reroot_hit = None
+        self.profiler = profiler
+
+        self.reset()
+
+    def set_tree_policy(self):
         act_selection_criteria = {
             'uct': self.ucb,
             'p_uct': self.p_ucb,
-            'var_p_uct': self.var_p_ucb
+            'var_p_uct': self.var_p_ucb,
+            # sequential halving at the root, p-uct below
+            'gumbel': self.p_ucb,
         }
-        if alg in ['uct', 'p_uct', 'var_p_uct']:
-            self.tree_policy = lambda children: max(children, key=act_selection_criteria[alg])
-
-            if alg == 'var_p_uct':
-                self.ucb_base = ucb_base
+        if self.alg not in act_selection_criteria:
+            raise Exception(f'unknown uct alg {self.alg}')
+        criterion = act_selection_criteria[self.alg]
+        if self.tree_backend == 'array':
+            self.tree_policy = lambda children: array_tree.select_child(self, children, criterion)
         else:
-            raise Exception(f'unknown uct alg {alg}')
+            self.tree_policy = lambda children: max(children, key=criterion)
 
-        self.lambda_coeff = lambda_coeff
-        self.value_func = value_func
+    def __getstate__(self):
+        # the agent is copied to the worker processes without its tree, its workers and its (unpicklable) tree policy
+        state = self.__dict__.copy()
+        for name in ['tree_policy', 'root', 'transposition_table', 'root_parallel', 'node_pool']:
+            state.pop(name, None)
+        # the turns are recorded by the profiler and the scheduler of the main process only
+        state['profiler'] = None
+        state['scheduler'] = None
+        return state
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.root_parallel = None
+        self.node_pool = mcts.NodePool(self.max_nodes) if self.max_nodes is not None else None
+        self.set_tree_policy()
         self.reset()
 
-    def reset(self):
-        self.root = None
+    def close(self):
+        """
+        Stop the worker processes of root parallelisation
+        """
+        if self.root_parallel is not None:
+            self.root_parallel.close()
+            self.root_parallel = None
+
+    def reset(self, keep_tree=False):
+        """
+        Clear the agent for the next call, the tree is kept if keep_tree is True so that it can be reused
+        """
+        if not keep_tree:
+            self.release_tree()
+            self.root = None
+            self.transposition_table = {}
         self.rolled_out_trajectories = []
         self.rolled_out_rewards = []
 
+    def release_tree(self, keep=None):
+        """
+        Put the nodes of the current tree back in the node pool, except those of the subtree of keep
+        """
+        if self.node_pool is None or not isinstance(getattr(self, 'root', None), mcts.DecisionNode):
+            return
+        kept = set() if keep is None else {id(node) for node in mcts.reachable_nodes(keep)}
+        self.node_pool.release([node for node in mcts.reachable_nodes(self.root) if id(node) not in kept])
+
+    def reroot(self, act, state_p, equality_operator):
+        """
+        Move the root of the tree to the DecisionNode reached by taking act and observing state_p, keeping the
+        statistics of its subtree. The tree is dropped if no such node was expanded. A root already labelled by
+        state_p (e.g. a tree loaded by load_tree) is kept as it is, whatever act.
+
+        Returns:
+            True if the tree could be reused
+        """
+        if self.root is not None and equality_operator(self.root.state, state_p):
+            self.reroot_hit = True
+            return True
+        new_root = None
+        if self.root is not None:
+            for chance_node in self.root.children:
+                if chance_node.action == act:
+                    new_root = next((decision_node for decision_node in chance_node.children
+                                     if equality_operator(decision_node.state, state_p)), None)
+                    break
+        self.release_tree(keep=new_root)
+        if new_root is not None:
+            # detach the subtree so that the rest of the tree can be garbage collected
+            new_root.parent = None
+        # only keep the nodes of the subtree in the transposition table
+        self.set_root(new_root)
+        self.reroot_hit = new_root is not None
+        return self.reroot_hit
+
+    def set_root(self, root):
+        """
+        Use root as the tree of the agent and index its nodes in the transposition table
+        """
+        self.transposition_table = {}
+        if root is not None:
+            for decision_node in mcts.reachable_nodes(root):
+                if decision_node.fingerprint is not None:
+                    self.transposition_table[decision_node.fingerprint.key] = decision_node
+        self.root = root
+
+    def save_tree(self, path, compress=True):
+        """
+        Write a binary snapshot of the current tree to path, see dyna_gym.utils.tree_snapshot
+        """
+        if not isinstance(self.root, mcts.DecisionNode):
+            raise Exception("There is no tree to save, call act first")
+        tree_snapshot.save_tree(self.root, path, compress=compress)
+
+    def load_tree(self, path):
+        """
+        Replace the current tree with a snapshot written by save_tree. With reuse_tree, the next call to act continues
+        the search from the loaded tree, whose root must then be labelled by the current state of the environment.
+        A call to reroot with that state keeps the loaded tree, see reroot.
+        """
+        self.release_tree()
+        root = tree_snapshot.load_tree(path)
+        if self.tree_backend == 'array':
+            root = array_tree.to_array_tree(root)
+        self.set_root(root)
+
     def display(self):
         """
         Display infos about the attributes.
@@ -110,22 +311,38 @@ class UCT(object):
         print('UCB constant       :', self.ucb_constant)
         print('Is model dynamic   :', self.is_model_dynamic)
         print('Expansion Width    :', self.width)
+        print('Widening exponent  :', self.pw_alpha)
+        print('Parallel rollouts  :', self.parallel_rollouts)
+        print('Workers            :', self.num_workers)
+        print('Time budget        :', self.budget.time_budget)
         print()
 
+    def value(self, node):
+        """
+        Value of a chance node, lowered by the virtual loss of the in-flight rollouts going through it
+        """
+        return mcts.chance_node_value(node) - self.virtual_loss * node.virtual_loss
+
+    def n_returns(self, node):
+        """
+        Number of returns of a chance node, counting the in-flight rollouts going through it
+        """
+        return node.n_returns + node.virtual_loss
+
     def ucb(self, node):
         """
         Upper Confidence Bound of a chance node
         """
         print("[IN HERE]: ", mcts.chance_node_value(node))
-        return mcts.chance_node_value(node) \
-            + self.ucb_constant * sqrt(log(node.parent.visits)) / (1 + len(node.sampled_returns))
+        return self.value(node) \
+            + self.ucb_constant * sqrt(log(node.parent.visits)) / (1 + self.n_returns(node))
 
     def p_ucb(self, node):
         """
         Upper Confidence Bound of a chance node, weighted by prior probability
         """
-        temp = mcts.chance_node_value(node) \
-            + self.ucb_constant * node.prob * sqrt(log(node.parent.visits)) / (1 + len(node.sampled_returns))
+        temp = self.value(node) \
+            + self.ucb_constant * node.prob * sqrt(log(node.parent.visits)) / (1 + self.n_returns(node))
         # print("[IN HERE]: ", temp)
         # print('--------------------------------')
         return temp
@@ -136,13 +353,65 @@ class UCT(object):
         Upper Confidence Bound of a chance node, the ucb exploration weight is a variable
         """
         ucb_parameter = log((node.parent.visits + self.ucb_base + 1) / self.ucb_base) + self.ucb_constant
-        return mcts.chance_node_value(node) \
-            + ucb_parameter * node.prob * sqrt(log(node.parent.visits)) / (1 + len(node.sampled_returns))
+        return self.value(node) \
+            + ucb_parameter * node.prob * sqrt(log(node.parent.visits)) / (1 + self.n_returns(node))
 
     def act(self, env, done, term_cond=None):
-        root = self.root if self.reuse_tree else None
-        opt_act, self.root, reward_his = mcts.mcts_procedure(self, self.tree_policy, env, done, memory=self.memory, k = self.k,
-                                                 root=root, term_cond=term_cond)
+        if self.profiler is not None:
+            self.profiler.start_turn()
+        if self.budget.is_bounded():
+            # anytime search: stop on the first of term_cond and the search budget
+            self.budget.start(env)
+            user_term_cond = term_cond
+            term_cond = lambda: (user_term_cond is not None and user_term_cond()) or self.budget()
+
+        target = self.rollouts
+        if self.scheduler is not None:
+            # the root is created first so that the uncertainty of its priors can size the search
+            self.scheduler.detect_conversation(env.state)
+            if not self.reuse_tree or self.root is None:
+                self.root = mcts.new_decision_node(self, None, env.state, done)
+                mcts.evaluate_priors(self, [self.root])
+            target = self.scheduler.allocate(self.root)
+
+        if self.num_workers > 1:
+            # root parallelisation, the merged root has no subtree so it cannot be reused
+            rollouts = target
+            if self.root_parallel is None:
+                self.root_parallel = root_parallel.RootParallelSearch(self, env, self.num_workers)
+            self.root, reward_his = self.root_parallel.search(self, env, done, rollouts)
+            opt_act = max(self.root.children, key=lambda n: mcts.chance_node_value(n, mode="sample")).action
+        else:
+            root = self.root if self.reuse_tree or self.scheduler is not None else None
+            rollouts = target
+            if root is not None and self.scheduler is None:
+                # the rollouts already backpropagated through the reused root count towards the budget. The scheduler
+                # allocates and charges only the rollouts run by this turn, its target is not reduced
+                rollouts = max(target - (root.visits - 1), 0)
+            if self.alg == 'gumbel':
+                opt_act, self.root, reward_his = mcts.sequential_halving_procedure(
+                    self, self.tree_policy, env, done, memory=self.memory, k=self.k, root=root, term_cond=term_cond,
+                    parallel_rollouts=self.parallel_rollouts, rollouts=rollouts, m=self.gumbel_m)
+            else:
+                opt_act, self.root, reward_his = mcts.mcts_procedure(self, self.tree_policy, env, done, memory=self.memory, k = self.k,
+                                                         root=root, term_cond=term_cond,
+                                                         parallel_rollouts=self.parallel_rollouts, rollouts=rollouts)
+
+        self.search_info = {'rollouts': self.completed_rollouts, 'rollout_budget': rollouts}
+        if self.reroot_hit is not None:
+            self.search_info['reroot_hit'] = self.reroot_hit
+            self.reroot_hit = None
+        if self.scheduler is not None:
+            self.scheduler.record(self.completed_rollouts)
+            self.search_info['conversation_rollouts_left'] = self.scheduler.remaining
+        if self.early_stop is not None:
+            self.search_info['early_stopped'] = self.early_stopped
+            self.search_info['rollouts_saved'] = rollouts - self.completed_rollouts if self.early_stopped else 0
+        if self.budget.is_bounded():
+            self.search_info.update(self.budget.summary())
+        if self.profiler is not None:
+            size = tree_size(self.root)
+            self.profiler.end_turn(**self.search_info, **size)
         # save the memory-based reward for visualization purpose
         self.global_reward_his.extend(reward_his)
         self.opt_act = opt_act
@@ -6,7 +6,7 @@ import torch
 
 from dyna_gym.default_policy.default_policy import DefaultPolicy
 from dyna_gym.envs.utils import simulate_conversation
-from dataset.data_utils import convert_example_to_feature_for_goal_prediction
+from dyna_gym.models.policy_scorer import PolicyScorer
 
 
 class OfflinePolicy(DefaultPolicy):
@@ -29,6 +29,9 @@ class OfflinePolicy(DefaultPolicy):
             device=None,
             terminated_act=None,
             generation_args: dict = {},
+            transition_cache=None,
+            knowledge_cache=None,
+            dataset='durecdial',
     ):
         super().__init__(env, horizon)
         self.generation_model = generation_model
@@ -45,6 +48,15 @@ class OfflinePolicy(DefaultPolicy):
         self.know_generation_model = know_generation_model
         self.know_tokenizer = know_tokenizer
         self.terminated_act = terminated_act
+        # one forward pass of the policy model per batch of states
+        self.scorer = PolicyScorer(policy_model, policy_tokenizer, max_sequence_length, goal2id, padding=padding,
+                                   pad_to_multiple_of=pad_to_multiple_of, device=device)
+        # optional dyna_gym.utils.cache.TransitionCache shared with the environment
+        self.transition_cache = transition_cache
+        # optional dyna_gym.utils.cache.TransitionCache memoizing the generated knowledge by input sequence
+        self.knowledge_cache = knowledge_cache
+        # dataset of the conversations, the simulated turns are cached under the same keys as the transitions
+        self.dataset = dataset
 
     def get_top_k_tokens(self, state, top_k=10):
         """
@@ -54,37 +66,16 @@ class OfflinePolicy(DefaultPolicy):
         @param top_k: number of predictions.
         @return: top_k indices and top_k probabilities
         """
-        input_features = defaultdict(list)
-        # convert state to input features
-        input_ids, _ = convert_example_to_feature_for_goal_prediction(self.policy_tokenizer, state,
-                                                                      self.max_sequence_length,
-                                                                      self.goal2id)
+        return self.get_top_k_tokens_batch([state], top_k=top_k)[0]
 
-        input_features['input_ids'] = input_ids
-
-        # padding the input features
-        input_features = self.policy_tokenizer.pad(
-            input_features, padding=self.padding, pad_to_multiple_of=self.pad_to_multiple_of,
-            max_length=self.max_sequence_length
-        )
-        # convert features to torch tensors
-        for k, v in input_features.items():
-            if not isinstance(v, torch.Tensor):
-                input_features[k] = torch.as_tensor(v, device=self.device).unsqueeze(0)
-
-        # compute policy with offline policy model.
-        logits = self.policy_model(input_features)
-
-        # convert logits to probabilities
-        all_probs = torch.softmax(logits, dim=-1)
-
-        # compute top-k predictions
-        topk_probs, topk_indices = torch.topk(all_probs, top_k, sorted=True)
-        topk_probs = topk_probs.tolist()
-        topk_indices = topk_indices.tolist()
-        # tmp = topk_indices[0]
-        # tmp = [0.5 for x in tmp]
-        return topk_indices[0], topk_probs[0]
+    def get_top_k_tokens_batch(self, states, top_k=10):
+        """
+        method that get top-k predictions for a batch of states with a single forward pass of the policy model
+        @param states: a list of states of the env
+        @param top_k: number of predictions.
+        @return: a list containing the top_k indices and top_k probabilities of each state
+        """
+        return self.scorer.top_k(states, top_k)
 
     def get_predicted_sequence(self, state, horizon: int = 5):
         """
@@ -107,5 +98,9 @@ class OfflinePolicy(DefaultPolicy):
                                                        pad_to_multiple_of=self.pad_to_multiple_of,
                                                        goal2id=self.goal2id,
                                                        terminated_action=self.terminated_act,
-                                                       device=self.device)
+                                                       device=self.device,
+                                                       transition_cache=self.transition_cache,
+                                                       knowledge_cache=self.knowledge_cache,
+                                                       llm_call_counter=getattr(self.env, 'count_llm_calls', None),
+                                                       dataset=self.dataset)
         return generated_conversation
@@ -1,3 +1,4 @@
+import heapq
 import os
 from collections import defaultdict
 
@@ -6,6 +7,7 @@ import torch
 
 from dyna_gym.default_policy.default_policy import DefaultPolicy
 from dyna_gym.envs.utils import simulate_conversation
+from dyna_gym.utils.feature_utils import pad_features
 # from dataset.data_utils import convert_example_to_feature_for_goal_prediction
 from baselines.rtcp.utils import convert_example_to_feature_for_rtcp_goal_topic_prediction
 
@@ -30,7 +32,10 @@ class RTCPOfflinePolicy(DefaultPolicy):
             device=None,
             terminated_act=None,
             generation_args: dict = {},
-            topic2id = None
+            topic2id = None,
+            transition_cache=None,
+            knowledge_cache=None,
+            dataset='durecdial',
     ):
         super().__init__(env, horizon)
         self.generation_model = generation_model
@@ -48,6 +53,12 @@ class RTCPOfflinePolicy(DefaultPolicy):
         self.device = device
         self.terminated_act = terminated_act
         self.topic2id = topic2id
+        # optional dyna_gym.utils.cache.TransitionCache shared with the environment
+        self.transition_cache = transition_cache
+        # optional dyna_gym.utils.cache.TransitionCache memoizing the generated knowledge by input sequence
+        self.knowledge_cache = knowledge_cache
+        # dataset of the conversations, the simulated turns are cached under the same keys as the transitions
+        self.dataset = dataset
 
     def get_top_k_tokens(self, state, top_k=3):
         """
@@ -57,42 +68,41 @@ class RTCPOfflinePolicy(DefaultPolicy):
         @param top_k: number of predictions.
         @return: top_k indices and top_k probabilities
         """
-        context_input_features = defaultdict(list)
-        path_input_features = defaultdict(list)
+        return self.get_top_k_tokens_batch([state], top_k=top_k)[0]
 
-        # convert state to input features
-        context_ids, path_ids, _, _ = convert_example_to_feature_for_rtcp_goal_topic_prediction(
-            tokenizer=self.policy_tokenizer,
-            instance=state,
-            max_sequence_length=self.max_sequence_length
-        )
-
-        context_input_features['input_ids'] = context_ids
-        path_input_features['input_ids'] = path_ids
+    @torch.no_grad()
+    def get_top_k_tokens_batch(self, states, top_k=3):
+        """
+        method that get top-k predictions for a batch of states with a single forward pass of the policy model
+        @param states: a list of states of the env
+        @param top_k: number of predictions.
+        @return: a list containing the top_k indices and top_k probabilities of each state
+        """
+        context_features = []
+        path_features = []
+        for state in states:
+            # convert state to input features
+            context_ids, path_ids, _, _ = convert_example_to_feature_for_rtcp_goal_topic_prediction(
+                tokenizer=self.policy_tokenizer,
+                instance=state,
+                max_sequence_length=self.max_sequence_length
+            )
+            context_features.append({'input_ids': context_ids})
+            path_features.append({'input_ids': path_ids})
 
         # padding the context features
-        context_input_features = self.policy_tokenizer.pad(
-            context_input_features, padding=self.padding, pad_to_multiple_of=self.pad_to_multiple_of,
-            max_length=self.max_sequence_length
-        )
-        # convert features to torch tensors
-        for k, v in context_input_features.items():
-            if not isinstance(v, torch.Tensor):
-                context_input_features[k] = torch.as_tensor(v, device=self.device).unsqueeze(0)
+        context_input_features = pad_features(self.policy_tokenizer, context_features, self.max_sequence_length,
+                                              padding=self.padding, pad_to_multiple_of=self.pad_to_multiple_of,
+                                              device=self.device)
 
         # padding the path features
-        path_input_features = self.policy_tokenizer.pad(
-            path_input_features, padding=self.padding, pad_to_multiple_of=self.pad_to_multiple_of,
-            max_length=self.max_sequence_length
-        )
-        # convert features to torch tensors
-        for k, v in path_input_features.items():
-            if not isinstance(v, torch.Tensor):
-                path_input_features[k] = torch.as_tensor(v, device=self.device).unsqueeze(0)
+        path_input_features = pad_features(self.policy_tokenizer, path_features, self.max_sequence_length,
+                                           padding=self.padding, pad_to_multiple_of=self.pad_to_multiple_of,
+                                           device=self.device)
 
         # label goal, topic. Just using for computational convenience.
-        labels_goal = torch.LongTensor([0]).to(self.device)
-        labels_topic = torch.LongTensor([0]).to(self.device)
+        labels_goal = torch.LongTensor([0] * len(states)).to(self.device)
+        labels_topic = torch.LongTensor([0] * len(states)).to(self.device)
 
         batch = {
             "context": context_input_features,
@@ -109,17 +119,16 @@ class RTCPOfflinePolicy(DefaultPolicy):
         all_goal_probs = torch.softmax(goal_logits, dim=-1)
         all_topic_probs = torch.softmax(topic_logits, dim=-1)
 
-        # combining goal and topic probabilities
-        all_probs = all_goal_probs.unsqueeze(-1).repeat(1, 1, all_topic_probs.size(-1)) * all_topic_probs.unsqueeze(
-            1).repeat(1, all_goal_probs.size(-1), 1)
-        all_probs = all_probs.view(all_probs.size(0), -1)
+        # the top-k (goal, topic) pairs are made of top-k goals and top-k topics, so the joint distribution over the
+        # goal2id product space is not materialised
+        top_goal_probs, top_goals = torch.topk(all_goal_probs, min(top_k, all_goal_probs.size(-1)), sorted=True)
+        top_topic_probs, top_topics = torch.topk(all_topic_probs, min(top_k, all_topic_probs.size(-1)), sorted=True)
 
         # compute top-k predictions
-        topk_probs, topk_indices = torch.topk(all_probs, top_k, sorted=True)
-        topk_probs = topk_probs.tolist()
-        topk_indices = topk_indices.tolist()
-
-        return topk_indices[0], topk_probs[0]
+        n_topics = all_topic_probs.size(-1)
+        return [factorised_top_k(goal_probs, goals, topic_probs, topics, n_topics, top_k)
+                for goal_probs, goals, topic_probs, topics in zip(top_goal_probs.tolist(), top_goals.tolist(),
+                                                                  top_topic_probs.tolist(), top_topics.tolist())]
 
     def get_predicted_sequence(self, state, horizon: int = 5):
         """
@@ -145,6 +154,39 @@ class RTCPOfflinePolicy(DefaultPolicy):
                                                        terminated_action=self.terminated_act,
                                                        device=self.device,
                                                        use_rtcp_policy=True,
-                                                       topic2id=self.topic2id[1]
+                                                       topic2id=self.topic2id[1],
+                                                       transition_cache=self.transition_cache,
+                                                       knowledge_cache=self.knowledge_cache,
+                                                       llm_call_counter=getattr(self.env, 'count_llm_calls', None),
+                                                       dataset=self.dataset
                                                        )
         return generated_conversation
+
+
+def factorised_top_k(goal_probs, goals, topic_probs, topics, n_topics, top_k):
+    """
+    function that computes the top-k (goal, topic) pairs of a factorised distribution p(goal) * p(topic) by
+    heap-merging the outer product of the top goals and the top topics, in O(k log k)
+    @param goal_probs: probabilities of the top goals, in decreasing order
+    @param goals: indices of the top goals
+    @param topic_probs: probabilities of the top topics, in decreasing order
+    @param topics: indices of the top topics
+    @param n_topics: the number of topics, the pair (goal, topic) has the index goal * n_topics + topic in goal2id
+    @param top_k: number of predictions
+    @return: the top_k indices and top_k probabilities, in decreasing order of probability
+    """
+    # the pairs are popped in decreasing order of probability, as with torch.topk the order of equal probabilities
+    # is unspecified
+    heap = [(-goal_probs[0] * topic_probs[0], goals[0] * n_topics + topics[0], 0, 0)]
+    seen = {(0, 0)}
+    topk_indices, topk_probs = [], []
+    while len(heap) > 0 and len(topk_indices) < top_k:
+        neg_prob, index, i, j = heapq.heappop(heap)
+        topk_indices.append(index)
+        topk_probs.append(-neg_prob)
+        # the next candidates are the successors of the pair along each factor
+        for ni, nj in ((i + 1, j), (i, j + 1)):
+            if ni < len(goals) and nj < len(topics) and (ni, nj) not in seen:
+                seen.add((ni, nj))
+                heapq.heappush(heap, (-goal_probs[ni] * topic_probs[nj], goals[ni] * n_topics + topics[nj], ni, nj))
+    return topk_indices, topk_probs
@@ -1,9 +1,13 @@
+import threading
 from collections import OrderedDict
-import copy
+from concurrent.futures import ThreadPoolExecutor
 import gym
 import torch
-from dyna_gym.envs.utils import predict_action, generate_sys_response_with_plm, generate_knowledge_with_plm, \
-    get_user_resp, update_state
+from dyna_gym.envs.utils import predict_action, generate_sys_response_with_plm_batch, \
+    generate_knowledge_with_plm_batch, get_user_resp, update_state, compute_state_fingerprint, transition_cache_key
+from dyna_gym.envs.dialogue_state import DialogueState
+from dyna_gym.utils.cache import MISSING
+from dyna_gym.utils.profiling import profile_phase
 
 
 class DialogueEnv(gym.Env):
@@ -20,7 +24,8 @@ class DialogueEnv(gym.Env):
     def __init__(self, generation_model, generation_tokenizer, know_generation_model, know_tokenizer, memory,
                  terminal_act, horizon=5, max_sequence_length=512, max_gen_length=50, pad_to_multiple_of=True,
                  padding='max_length', device=None,
-                 reward_func=None, goal2id=None, use_rtcp_policy=False):
+                 reward_func=None, goal2id=None, use_rtcp_policy=False, transition_cache=None,
+                 knowledge_cache=None, dataset='durecdial'):
         """
 
         @param generation_model:
@@ -37,6 +42,13 @@ class DialogueEnv(gym.Env):
         @param device:
         @param reward_func:
         @param goal2id:
+        @param transition_cache: an optional dyna_gym.utils.cache.TransitionCache memoizing the knowledge, the system
+        responses and the user responses of the transitions
+        @param knowledge_cache: an optional dyna_gym.utils.cache.TransitionCache memoizing the generated knowledge by
+        input sequence
+        @param dataset: the dataset of the conversations, selects the input format of the response generation and the
+        prompt of the user simulator. It must be that of the evaluation, so that the simulated replies and the actual
+        ones share their cache entries and a reused tree can be re-rooted at the actual reply
         """
         self.terminal_act = terminal_act
         self.horizon = horizon
@@ -54,9 +66,30 @@ class DialogueEnv(gym.Env):
         self.padding = padding
         self.device = device
         self.use_rtcp_policy = use_rtcp_policy
+        # number of transitions and LLM calls (user simulator and assessment) made so far, used by search budgets.
+        # the counters are updated from the rollout threads, see count_transitions and count_llm_calls
+        self.n_transitions = 0
+        self.n_llm_calls = 0
+        self.counter_lock = threading.Lock()
+        # optional dyna_gym.utils.profiling.SearchProfiler timing the steps of the transitions
+        self.profiler = None
+        self.transition_cache = transition_cache
+        self.knowledge_cache = knowledge_cache
+        self.dataset = dataset
+
+    def __getstate__(self):
+        # locks cannot be pickled, e.g. for root-parallel workers, the copy starts with a new one
+        state = self.__dict__.copy()
+        del state['counter_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.counter_lock = threading.Lock()
 
     def reset(self, state):
-        self.state = state
+        # the states of the environment are persistent, so that the transitions share the unchanged entries
+        self.state = DialogueState.from_dict(state)
         return self.state
 
     def transition(self, state, action, is_model_dynamic=False):
@@ -69,60 +102,151 @@ class DialogueEnv(gym.Env):
         Returns:
             _type_: next state, action, reward and flag which indicates whether we terminate the process.
         """
+        return self.transition_batch(state, [action], is_model_dynamic)[0]
+
+    def transition_batch(self, state, actions, is_model_dynamic=False):
+        """Transitions of several actions taken in the same state.
+        The knowledge and the system responses of all the actions are generated with one batched generate() call
+        each, and the user simulator is called concurrently for all the actions.
+        Args:
+            state (_type_): the current state
+            actions (_type_): the chosen dialogue actions
+            is_model_dynamic (bool, optional): _description_. Defaults to False.
+
+        Returns:
+            _type_: a list with the next state, reward and termination flag of each action.
+        """
         # generate a response (which can be either user or system response)
         # given the current state and the chosen action.
-        action = self.id2goal[action]
+        actions = [self.id2goal[action] for action in actions]
+
+        # the responses are cached under the same keys as those of the evaluation, see eval.base.BaseOnlineEval
+        resps = self.cached_batch(
+            'response', state, [[action, self.dataset] for action in actions],
+            lambda indices: self.generate_responses(state, [actions[i] for i in indices]))
+
+        # generate the corresponding user responses using a simulator, the calls are I/O bound
+        with profile_phase(self.profiler, 'user_simulation'):
+            user_resps = self.cached_batch(
+                'user', state, [[resp, self.dataset] for resp in resps],
+                lambda indices: self.simulate_users(state, [resps[i] for i in indices]))
+
+        results = []
+        for action, resp, user_resp in zip(actions, resps, user_resps):
+            simulated_conversation = [
+                {'role': 'system', 'content': resp, 'goal': action},
+                {'role': 'user', 'content': user_resp}
+            ]
+            if action == self.terminal_act or len(state['dialogue_context']) > self.horizon:
+                # either the text finishes, or the state reaches the maximum length
+                done = True
+            else:
+                done = False
 
-        # print("[ACTION]: ", action)
+            # the intemediate reward during tree construction.
+            # it is 3 if the target item is in the generated response.
+            with profile_phase(self.profiler, 'reward'):
+                reward = self.get_reward(simulated_conversation, self.state['task_background']['target_topic'],
+                                         self.state['task_background']['target_goal'])
+            # reward = 0
+            # update the current state.
+            new_state = update_state(state, action, resp, user_resp)
+            results.append((new_state, reward, done))
+        self.count_transitions(len(actions))
+        return results
 
+    def generate_responses(self, state, actions):
+        """
+        Generate the knowledge and the system responses of several actions with one batched generate() call each
+        """
         # generate relevant knowledge
-        knowledge = generate_knowledge_with_plm(generation_model=self.know_generation_model,
-                                                tokenizer=self.know_tokenizer,
-                                                action=action,
-                                                state=state,
-                                                max_sequence_length=self.max_sequence_length,
-                                                max_gen_length=self.max_gen_length,
-                                                pad_to_multiple_of=self.pad_to_multiple_of,
-                                                padding=self.padding,
-                                                device=self.device)
-
-        # generate system response
-        resp = generate_sys_response_with_plm(generation_model=self.generation_model,
-                                              tokenizer=self.generation_tokenizer,
-                                              action=action,
-                                              knowledge=knowledge,
-                                              state=state,
-                                              max_sequence_length=self.max_sequence_length,
-                                              max_gen_length=self.max_gen_length,
-                                              pad_to_multiple_of=self.pad_to_multiple_of,
-                                              padding=self.padding,
-                                              device=self.device)
-
-        # generate the corresponding user response using a simulator
-        user_resp = get_user_resp(copy.deepcopy(state), resp)
-        simulated_conversation = [
-            {'role': 'system', 'content': resp, 'goal': action},
-            {'role': 'user', 'content': user_resp}
-        ]
-        if action == self.terminal_act or len(state['dialogue_context']) > self.horizon:
-            # either the text finishes, or the state reaches the maximum length
-            done = True
-        else:
-            done = False
-
-        # the intemediate reward during tree construction.
-        # it is 3 if the target item is in the generated response.
-        reward = self.get_reward(simulated_conversation, self.state['task_background']['target_topic'],
-                                 self.state['task_background']['target_goal'])
-        # reward = 0
-        # update the current state.
-        new_state = update_state(state, action, resp, user_resp)
-        return new_state, reward, done
+        with profile_phase(self.profiler, 'knowledge_generation'):
+            knowledges = self.cached_batch(
+                'knowledge', state, [[action] for action in actions],
+                lambda indices: generate_knowledge_with_plm_batch(generation_model=self.know_generation_model,
+                                                                  tokenizer=self.know_tokenizer,
+                                                                  actions=[actions[i] for i in indices],
+                                                                  state=state,
+                                                                  max_sequence_length=self.max_sequence_length,
+                                                                  max_gen_length=self.max_gen_length,
+                                                                  pad_to_multiple_of=self.pad_to_multiple_of,
+                                                                  padding=self.padding,
+                                                                  device=self.device,
+                                                                  knowledge_cache=self.knowledge_cache))
+
+        # generate system responses
+        with profile_phase(self.profiler, 'response_generation'):
+            return generate_sys_response_with_plm_batch(generation_model=self.generation_model,
+                                                        tokenizer=self.generation_tokenizer,
+                                                        actions=actions,
+                                                        knowledges=knowledges,
+                                                        state=state,
+                                                        max_sequence_length=self.max_sequence_length,
+                                                        max_gen_length=self.max_gen_length,
+                                                        pad_to_multiple_of=self.pad_to_multiple_of,
+                                                        padding=self.padding,
+                                                        device=self.device,
+                                                        dataset=self.dataset)
+
+    def simulate_users(self, state, resps):
+        """
+        Simulate the user responses to several system responses, concurrently
+        """
+        self.count_llm_calls(len(resps))
+        if len(resps) == 1:
+            return [get_user_resp(state, resps[0], dataset=self.dataset)]
+        with ThreadPoolExecutor(max_workers=len(resps)) as executor:
+            return list(executor.map(lambda resp: get_user_resp(state, resp, dataset=self.dataset), resps))
+
+    def count_transitions(self, n=1):
+        """
+        Record n transitions, thread-safe
+        """
+        with self.counter_lock:
+            self.n_transitions += n
+
+    def count_llm_calls(self, n=1):
+        """
+        Record n LLM calls, thread-safe. The user simulator calls of the transitions are counted by simulate_users,
+        those of the simulations of the default policy and the LLM-based assessments are reported by the search
+        """
+        with self.counter_lock:
+            self.n_llm_calls += n
+
+    def cached_batch(self, kind, state, args, compute):
+        """
+        Outputs of a step of the transitions for a batch of inputs, only the inputs missing from the transition cache
+        are computed, in one call of compute
+        @param kind: the step, see dyna_gym.envs.utils.transition_cache_key
+        @param state: the current state
+        @param args: the other inputs of the step, for each element of the batch
+        @param compute: a function computing the outputs of the step for a list of indices of the batch
+        @return: the list of outputs
+        """
+        if self.transition_cache is None:
+            return compute(list(range(len(args))))
+        keys = [transition_cache_key(kind, state, *arg) for arg in args]
+        outputs = [self.transition_cache.get(key, kind=kind, default=MISSING) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is MISSING]
+        if len(missing) > 0:
+            for i, output in zip(missing, compute(missing)):
+                outputs[i] = output
+                self.transition_cache.put(keys[i], output, kind=kind)
+        return outputs
 
     def step(self, action):
         self.state, reward, done = self.transition(self.state, action)
         return self.state, reward, done, {}
 
+    def state_fingerprint(self, state, parent_fingerprint=None):
+        """
+        Canonical fingerprint of a state, computed incrementally from the fingerprint of its parent state if given.
+        Used as the key of the transposition table of the tree search.
+        """
+        return compute_state_fingerprint(state, parent_fingerprint)
+
     def equality_operator(self, s1, s2):
         # s1 and s2 are dictionaries
-        return s1 == s2
+        # two states are equal if they hold the same conversation, the model inputs written into the states
+        # during a transition (pred_goal, pred_topic, pred_know) are ignored
+        return self.state_fingerprint(s1).key == self.state_fingerprint(s2).key
@@ -0,0 +1,119 @@
+"""
+Persistent dialogue states
+
+A DialogueState is an immutable dictionary with the same keys as the plain dialogue states built by the evaluation
+code. The growing entries (dialogue_context, pre_goals, pre_topics) are stored as tuples, and a new state is created
+by extending or overriding entries of an existing one: the other entries, in particular the task background and the
+demonstration, are shared with the previous state instead of copied. Since a state is never modified, copy.deepcopy
+returns the state itself, and states can be hashed.
+"""
+
+# entries of a dialogue state that grow with the conversation
+SEQUENCE_KEYS = ['dialogue_context', 'pre_goals', 'pre_topics']
+
+
+def _immutable(self, *args, **kwargs):
+    raise Exception("DialogueState is immutable, use set or append_turn to create a new state")
+
+
+class DialogueState(dict):
+    """
+    Immutable dialogue state with structural sharing
+
+    Args:
+        state: a dictionary, its sequence entries are converted to tuples
+    """
+    __slots__ = ('_hash',)
+
+    def __init__(self, state=(), **kwargs):
+        state = dict(state, **kwargs)
+        for key in SEQUENCE_KEYS:
+            if key in state and not isinstance(state[key], tuple):
+                state[key] = tuple(state[key])
+        super().__init__(state)
+        self._hash = None
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Convert a plain dialogue state, a DialogueState is returned as is
+        """
+        if isinstance(state, DialogueState):
+            return state
+        return cls(state)
+
+    def to_dict(self):
+        """
+        Mutable copy of the state, with lists for the sequence entries
+        """
+        state = dict(self)
+        for key in SEQUENCE_KEYS:
+            if key in state:
+                state[key] = list(state[key])
+        return state
+
+    def set(self, **fields):
+        """
+        New state with the given entries overridden, the other entries are shared
+        """
+        return DialogueState(self, **fields)
+
+    def append_turn(self, action, sys_response, user_response):
+        """
+        New state extended with one turn of the conversation
+
+        Args:
+            action: the system action, a goal or a (goal, topic) pair
+            sys_response: the system response
+            user_response: the user response
+        """
+        fields = {'dialogue_context': self['dialogue_context'] + ({"role": "assistant", "content": sys_response},
+                                                                  {"role": "user", "content": user_response})}
+        if isinstance(action, tuple):
+            goal, topic = action
+            fields['pre_goals'] = self['pre_goals'] + (goal,)
+            fields['pre_topics'] = self['pre_topics'] + (topic,)
+        else:
+            fields['pre_goals'] = self['pre_goals'] + (action,)
+        return self.set(**fields)
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = __ior__ = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return DialogueState, (dict(self),)
+
+    def __eq__(self, other):
+        if isinstance(other, dict) and not isinstance(other, DialogueState):
+            other = DialogueState(other)
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # equal states have equal conversations, the other entries are only compared by __eq__
+        if self._hash is None:
+            self._hash = hash((tuple((utt['role'], utt['content']) for utt in self.get('dialogue_context', ())),
+                               self.get('pre_goals', ()), self.get('pre_topics', ())))
+        return self._hash
+
+    def __repr__(self):
+        return f"DialogueState({dict.__repr__(self)})"
+
+
+def with_fields(state, **fields):
+    """
+    Assign entries of a dialogue state. A DialogueState is not modified, a new state is returned; a plain dictionary
+    is updated in place and returned.
+    """
+    if isinstance(state, DialogueState):
+        return state.set(**fields)
+    state.update(fields)
+    return state
@@ -1,6 +1,8 @@
 import random
-from collections import defaultdict
+from collections import namedtuple
 import copy
+import hashlib
+import json
 import math
 import time
 
@@ -16,6 +18,10 @@ from dataset.data_utils import convert_list_to_str, convert_dict_to_str, convert
 
 from baselines.rtcp.utils import predict_action_rtcp
 from retrieval.utils import concatenate_sentences
+from dyna_gym.envs.dialogue_state import DialogueState, with_fields
+from dyna_gym.utils.feature_utils import pad_features
+from dyna_gym.models.policy_scorer import get_policy_scorer
+from dyna_gym.utils.cache import MISSING
 
 from tenacity import (
     retry,
@@ -166,15 +172,9 @@ def get_user_resp(state, sys_response, dataset='inspired'):
     # the first instruction prompt
     # messages.append({"role": "system", "content": seeker_instruction_1})
     messages.append({"role": "system", "content": seeker_instruction_2})
-    new_state = copy.deepcopy(state)
-    # current conversation
-    for utt in new_state['dialogue_context']:
-        # switch role
-        if utt['role'] == 'user':
-            utt['role'] = 'assistant'
-        else:
-            utt['role'] = 'user'
-        messages.append(utt)
+    # current conversation, with switched roles. new messages are created so that the state is left unchanged
+    for utt in state['dialogue_context']:
+        messages.append({'role': 'assistant' if utt['role'] == 'user' else 'user', 'content': utt['content']})
 
     # the new generate response.
     messages.append(
@@ -208,7 +208,11 @@ def update_state(state, action, sys_response, user_response):
         state (_type_): the current state of the conversation.
         action (_type_): the chosen goal.
         response (_type_): the generated user response.
+    Returns:
+        the new state. a DialogueState is extended without copying, a plain dictionary is deep-copied.
     """
+    if isinstance(state, DialogueState):
+        return state.append_turn(action, sys_response, user_response)
     # update state
     new_state = copy.deepcopy(state)
     new_state['dialogue_context'].append(
@@ -226,6 +230,125 @@ def update_state(state, action, sys_response, user_response):
     return new_state
 
 
+StateFingerprint = namedtuple('StateFingerprint', ['key', 'background', 'context', 'n_turns', 'goals', 'n_goals',
+                                                   'topics', 'n_topics'])
+
+
+def _chain_hash(digest, *parts):
+    """
+    function that extends a hash chain with a new element
+    @param digest: the current digest of the chain
+    @param parts: text strings describing the new element
+    @return: the new digest
+    """
+    h = hashlib.blake2b(digest, digest_size=16)
+    for part in parts:
+        h.update(b'\x1f')
+        h.update(str(part).encode('utf-8'))
+    return h.digest()
+
+
+def compute_state_fingerprint(state, prev_fingerprint=None):
+    """
+    function that computes a canonical fingerprint of a dialogue state.
+    the fingerprint hashes the task background, the dialogue turns and the previous goals and topics, so that
+    identical conversations reached by different paths share the same key. The turns, goals and topics are hashed
+    as chains, therefore the fingerprint of a state can be computed incrementally from the fingerprint of a
+    previous state of the same conversation by hashing only the new elements.
+    @param state: the dialogue state
+    @param prev_fingerprint: the fingerprint of a previous state that the given state extends (optional)
+    @return: a StateFingerprint, its key identifies the state
+    """
+    if prev_fingerprint is None:
+        background = _chain_hash(b'', json.dumps(state['task_background'], sort_keys=True))
+        prev_fingerprint = StateFingerprint(None, background, background, 0, background, 0, background, 0)
+
+    context = prev_fingerprint.context
+    for utt in state['dialogue_context'][prev_fingerprint.n_turns:]:
+        context = _chain_hash(context, utt['role'], utt['content'])
+    goals = prev_fingerprint.goals
+    for goal in state['pre_goals'][prev_fingerprint.n_goals:]:
+        goals = _chain_hash(goals, goal)
+    topics = prev_fingerprint.topics
+    for topic in state['pre_topics'][prev_fingerprint.n_topics:]:
+        topics = _chain_hash(topics, topic)
+
+    key = _chain_hash(prev_fingerprint.background, context.hex(), goals.hex(), topics.hex()).hex()
+    return StateFingerprint(key, prev_fingerprint.background, context, len(state['dialogue_context']), goals,
+                            len(state['pre_goals']), topics, len(state['pre_topics']))
+
+
+# fields of the state read by a step besides those hashed by compute_state_fingerprint. The prompt of the user
+# simulator includes the demonstration, which is sampled for each target item when the target set is created
+STEP_STATE_FIELDS = {
+    'user': ['demonstration'],
+}
+
+
+def transition_cache_key(kind, state, *args):
+    """
+    function that computes the key of a step of a transition in a dyna_gym.utils.cache.TransitionCache
+    @param kind: the step, e.g. 'knowledge', 'response' or 'user'
+    @param state: the dialogue state the step is computed from
+    @param args: the other inputs of the step (JSON-serialisable)
+    @return: a string key
+    """
+    fields = [state.get(field) for field in STEP_STATE_FIELDS.get(kind, [])]
+    parts = json.dumps([kind, compute_state_fingerprint(state).key, list(args), fields], sort_keys=True)
+    return hashlib.sha1(parts.encode('utf-8')).hexdigest()
+
+
+def cache_namespaces(know_generation_model=None, generation_model=None, max_sequence_length=None,
+                     max_gen_length=None, padding='max_length', user_simulator=MODEL):
+    """
+    function that computes the namespaces of the kinds of steps memoized by a TransitionCache, i.e. the identity of
+    the models and settings each kind is computed with, see dyna_gym.utils.cache.TransitionCache
+    @param know_generation_model: the identity of the knowledge generation model, e.g. its checkpoint and tokenizer
+    @param generation_model: the identity of the response generation model
+    @param max_sequence_length: the maximum number of tokens in the inputs of the generation models
+    @param max_gen_length: the maximum number of generated tokens
+    @param padding: the padding of the inputs of the generation models
+    @param user_simulator: the LLM simulating the user
+    @return: a dictionary mapping each kind of step to its namespace
+    """
+    generation = [max_sequence_length, max_gen_length, padding]
+    return {
+        'knowledge': [know_generation_model] + generation,
+        # the input sequence and max_gen_length are part of the key already
+        'knowledge_input': [know_generation_model, padding],
+        # the response is generated from the generated knowledge
+        'response': [know_generation_model, generation_model] + generation,
+        'user': user_simulator,
+    }
+
+
+def cached_step(cache, kind, state, args, compute):
+    """
+    function that memoizes a deterministic step of a transition
+    @param cache: a TransitionCache, or None to always compute the step
+    @param kind: the step, see transition_cache_key
+    @param state: the dialogue state the step is computed from
+    @param args: the other inputs of the step
+    @param compute: a function without arguments computing the step
+    @return: the output of the step
+    """
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(transition_cache_key(kind, state, *args), compute, kind=kind)
+
+
+def knowledge_cache_key(input_ids, max_gen_length):
+    """
+    function that computes the key of a generated knowledge utterance in a knowledge cache
+    @param input_ids: the input sequence of the knowledge generation model, see
+    convert_example_to_feature_for_knowledge_generation
+    @param max_gen_length: the maximum number of tokens in the generated knowledge
+    @return: a string key
+    """
+    parts = json.dumps([list(input_ids), max_gen_length])
+    return hashlib.sha1(parts.encode('utf-8')).hexdigest()
+
+
 def check_terminated_condition(action, terminated_action):
     """
     function check if the target item appears in the system response.
@@ -236,43 +359,24 @@ def check_terminated_condition(action, terminated_action):
     return action == terminated_action
 
 
-def generate_knowledge_with_plm(generation_model, tokenizer, action, state, max_sequence_length, max_gen_length=50,
-                                pad_to_multiple_of=True, padding='max_length', device=None):
+def generate_with_plm(generation_model, tokenizer, batch_input_ids, max_sequence_length, max_gen_length=50,
+                      pad_to_multiple_of=True, padding='max_length', device=None):
     """
-    function that generates a knowledge utterance with a finetuned pretrained language model
+    function that generates one output sequence for each input sequence of a batch with a single generate() call
     @param generation_model: the finetuned huggingface pretrained PLM
     @param tokenizer: a huggingface tokenizer.
-    @param action: the predicted action
-    @param state:  the current state of the env
+    @param batch_input_ids: a list of input sequences (lists of token ids)
     @param max_sequence_length: the maximum number of tokens in the input sequence.
     @param max_gen_length: the maximum number of tokens in the generated response.
     @param pad_to_multiple_of: True if we pad to multiple instances.
     @param padding: type of padding default = 'max length"
     @param device: device to allocate tensors
-    @return: a generated knowledge utterance.
+    @return: a list of generated texts, one for each input sequence
     """
-    # convert state to input feature
-    input_features = defaultdict(list)
-
-    # assign the predicted goal to the input state
-    state['pred_goal'] = action[0]
-    # assign the predicted topic to the input state
-    state['pred_topic'] = action[1]
-
-    # convert state to input features
-    input_ids, _ = convert_example_to_feature_for_knowledge_generation(tokenizer=tokenizer, instance=state,
-                                                                       max_sequence_length=max_sequence_length,
-                                                                       is_test=True)
-    input_features['input_ids'] = input_ids
     # padding the input features
-    input_features = tokenizer.pad(
-        input_features, padding=padding, pad_to_multiple_of=pad_to_multiple_of,
-        max_length=max_sequence_length
-    )
-    # convert features to torch tensors
-    for k, v in input_features.items():
-        if not isinstance(v, torch.Tensor):
-            input_features[k] = torch.as_tensor(v, device=device).unsqueeze(0)
+    input_features = pad_features(tokenizer, [{'input_ids': input_ids} for input_ids in batch_input_ids],
+                                  max_sequence_length, padding=padding, pad_to_multiple_of=pad_to_multiple_of,
+                                  device=device)
 
     # forward the input features through the model
     gen_seqs = generation_model.generate(
@@ -290,8 +394,114 @@ def generate_knowledge_with_plm(generation_model, tokenizer, action, state, max_
     decoded_preds = [decoded_pred.replace('<pad>', '').replace('<s>', '').replace('</s>', '') for decoded_pred in
                      decoded_preds]
     decoded_preds = [pred.strip() for pred in decoded_preds]
+    return decoded_preds
+
+
+def generate_knowledge_with_plm(generation_model, tokenizer, action, state, max_sequence_length, max_gen_length=50,
+                                pad_to_multiple_of=True, padding='max_length', device=None, knowledge_cache=None):
+    """
+    function that generates a knowledge utterance with a finetuned pretrained language model
+    @param generation_model: the finetuned huggingface pretrained PLM
+    @param tokenizer: a huggingface tokenizer.
+    @param action: the predicted action
+    @param state:  the current state of the env
+    @param max_sequence_length: the maximum number of tokens in the input sequence.
+    @param max_gen_length: the maximum number of tokens in the generated response.
+    @param pad_to_multiple_of: True if we pad to multiple instances.
+    @param padding: type of padding default = 'max length"
+    @param device: device to allocate tensors
+    @param knowledge_cache: an optional TransitionCache memoizing the knowledge by input sequence
+    @return: a generated knowledge utterance.
+    """
+    return generate_knowledge_with_plm_batch(generation_model, tokenizer, [action], state, max_sequence_length,
+                                             max_gen_length=max_gen_length, pad_to_multiple_of=pad_to_multiple_of,
+                                             padding=padding, device=device, knowledge_cache=knowledge_cache)[0]
 
-    return decoded_preds[0]
+
+def generate_knowledge_with_plm_batch(generation_model, tokenizer, actions, state, max_sequence_length,
+                                      max_gen_length=50, pad_to_multiple_of=True, padding='max_length', device=None,
+                                      knowledge_cache=None):
+    """
+    function that generates the knowledge utterances of several actions taken in the same state with a single
+    generate() call
+    @param generation_model: the finetuned huggingface pretrained PLM
+    @param tokenizer: a huggingface tokenizer.
+    @param actions: a list of predicted actions
+    @param state:  the current state of the env
+    @param max_sequence_length: the maximum number of tokens in the input sequence.
+    @param max_gen_length: the maximum number of tokens in the generated response.
+    @param pad_to_multiple_of: True if we pad to multiple instances.
+    @param padding: type of padding default = 'max length"
+    @param device: device to allocate tensors
+    @param knowledge_cache: an optional TransitionCache memoizing the knowledge by input sequence, only the inputs
+    missing from the cache are passed to the model
+    @return: a list of generated knowledge utterances, one for each action.
+    """
+    batch_input_ids = []
+    for action in actions:
+        # assign the predicted goal and topic to the input state
+        state = with_fields(state, pred_goal=action[0], pred_topic=action[1])
+
+        # convert state to input features
+        input_ids, _ = convert_example_to_feature_for_knowledge_generation(tokenizer=tokenizer, instance=state,
+                                                                           max_sequence_length=max_sequence_length,
+                                                                           is_test=True)
+        batch_input_ids.append(input_ids)
+    if knowledge_cache is None:
+        return generate_with_plm(generation_model, tokenizer, batch_input_ids, max_sequence_length,
+                                 max_gen_length=max_gen_length, pad_to_multiple_of=pad_to_multiple_of,
+                                 padding=padding, device=device)
+
+    # the knowledge only depends on the input sequence, which ignores the previous goals and topics of the state and
+    # the beginning of long conversations, so states differing in those share their knowledge
+    keys = [knowledge_cache_key(input_ids, max_gen_length) for input_ids in batch_input_ids]
+    knowledges = [knowledge_cache.get(key, kind='knowledge_input', default=MISSING) for key in keys]
+    missing = [i for i, knowledge in enumerate(knowledges) if knowledge is MISSING]
+    # identical inputs within the batch are generated once
+    first = {}
+    for i in missing:
+        first.setdefault(keys[i], i)
+    missing_keys = list(first)
+    if len(missing_keys) > 0:
+        generated = generate_with_plm(generation_model, tokenizer, [batch_input_ids[first[key]] for key in missing_keys],
+                                      max_sequence_length, max_gen_length=max_gen_length,
+                                      pad_to_multiple_of=pad_to_multiple_of, padding=padding, device=device)
+        generated = dict(zip(missing_keys, generated))
+        for key, knowledge in generated.items():
+            knowledge_cache.put(key, knowledge, kind='knowledge_input')
+        for i in missing:
+            knowledges[i] = generated[keys[i]]
+    return knowledges
+
+
+def precompute_knowledge(generation_model, tokenizer, states, actions, knowledge_cache, max_sequence_length,
+                         max_gen_length=50, batch_size=16, pad_to_multiple_of=True, padding='max_length',
+                         device=None):
+    """
+    function that fills a knowledge cache with the knowledge of every action in every given state.
+    the states reached after these actions are not enumerated, their knowledge is generated when they are expanded.
+    @param generation_model: the finetuned knowledge generation model
+    @param tokenizer: a huggingface tokenizer.
+    @param states: a list of dialogue states, e.g. the initial states of the target items
+    @param actions: a list of (goal, topic) pairs
+    @param knowledge_cache: the TransitionCache to fill
+    @param max_sequence_length: the maximum number of tokens in the input sequence.
+    @param max_gen_length: the maximum number of tokens in the generated knowledge.
+    @param batch_size: number of actions passed to one generate() call
+    @param pad_to_multiple_of: True if we pad to multiple instances.
+    @param padding: type of padding default = 'max length"
+    @param device: device to allocate tensors
+    @return: the number of (state, action) pairs
+    """
+    n_pairs = 0
+    for state in tqdm(states):
+        for start in range(0, len(actions), batch_size):
+            batch_actions = actions[start:start + batch_size]
+            generate_knowledge_with_plm_batch(generation_model, tokenizer, batch_actions, state, max_sequence_length,
+                                              max_gen_length=max_gen_length, pad_to_multiple_of=pad_to_multiple_of,
+                                              padding=padding, device=device, knowledge_cache=knowledge_cache)
+            n_pairs += len(batch_actions)
+    return n_pairs
 
 
 def generate_sys_response_with_plm(generation_model, tokenizer, action, knowledge, state, max_sequence_length,
@@ -311,47 +521,43 @@ def generate_sys_response_with_plm(generation_model, tokenizer, action, knowledg
     @param device: device to allocate tensors
     @return: a generated system response
     """
-    # convert state to input feature
-    input_features = defaultdict(list)
-
-    # assign the predicted action to the input state
-    state['pred_goal'] = action[0]
-    state['pred_topic'] = action[1]
-    state['pred_know'] = knowledge
-
-    # convert state to input features
-    input_ids, _ = convert_example_to_feature_for_response_generation(tokenizer=tokenizer, instance=state,
-                                                                      max_sequence_length=max_sequence_length,
-                                                                      is_test=True, dataset=dataset)
-    input_features['input_ids'] = input_ids
-    # padding the input features
-    input_features = tokenizer.pad(
-        input_features, padding=padding, pad_to_multiple_of=pad_to_multiple_of,
-        max_length=max_sequence_length
-    )
-    # convert features to torch tensors
-    for k, v in input_features.items():
-        if not isinstance(v, torch.Tensor):
-            input_features[k] = torch.as_tensor(v, device=device).unsqueeze(0)
+    return generate_sys_response_with_plm_batch(generation_model, tokenizer, [action], [knowledge], state,
+                                                max_sequence_length, max_gen_length=max_gen_length,
+                                                pad_to_multiple_of=pad_to_multiple_of, padding=padding,
+                                                device=device, dataset=dataset)[0]
 
-    # forward the input features through the model
-    gen_seqs = generation_model.generate(
-        **input_features,
-        max_new_tokens=max_gen_length,
-        no_repeat_ngram_size=3
-    )
-    # remove special tokens
-    gen_resp_ids = []
-    for gen_seq in gen_seqs:
-        gen_seq = [token_id for token_id in gen_seq if token_id != tokenizer.pad_token_id]
-        gen_resp_ids.append(gen_seq)
 
-    decoded_preds = tokenizer.batch_decode(gen_resp_ids, skip_special_tokens=False)
-    decoded_preds = [decoded_pred.replace('<pad>', '').replace('<s>', '').replace('</s>', '') for decoded_pred in
-                     decoded_preds]
-    decoded_preds = [pred.strip() for pred in decoded_preds]
+def generate_sys_response_with_plm_batch(generation_model, tokenizer, actions, knowledges, state, max_sequence_length,
+                                         max_gen_length=50, pad_to_multiple_of=True, padding='max_length',
+                                         device=None, dataset='durecdial'):
+    """
+    function that generates the system responses of several actions taken in the same state with a single
+    generate() call
+    @param generation_model: the finetuned huggingface pretrained PLM
+    @param tokenizer: a huggingface tokenizer.
+    @param actions: a list of predicted actions
+    @param knowledges: the generated knowledge of each action
+    @param state:  the current state of the env
+    @param max_sequence_length: the maximum number of tokens in the input sequence.
+    @param max_gen_length: the maximum number of tokens in the generated response.
+    @param pad_to_multiple_of: True if we pad to multiple instances.
+    @param padding: type of padding default = 'max length"
+    @param device: device to allocate tensors
+    @return: a list of generated system responses, one for each action
+    """
+    batch_input_ids = []
+    for action, knowledge in zip(actions, knowledges):
+        # assign the predicted action to the input state
+        state = with_fields(state, pred_goal=action[0], pred_topic=action[1], pred_know=knowledge)
 
-    return decoded_preds[0]
+        # convert state to input features
+        input_ids, _ = convert_example_to_feature_for_response_generation(tokenizer=tokenizer, instance=state,
+                                                                          max_sequence_length=max_sequence_length,
+                                                                          is_test=True, dataset=dataset)
+        batch_input_ids.append(input_ids)
+    return generate_with_plm(generation_model, tokenizer, batch_input_ids, max_sequence_length,
+                             max_gen_length=max_gen_length, pad_to_multiple_of=pad_to_multiple_of, padding=padding,
+                             device=device)
 
 
 def predict_action(policy_model, tokenizer, state, max_sequence_length, goal2id=None, pad_to_multiple_of=True,
@@ -368,28 +574,8 @@ def predict_action(policy_model, tokenizer, state, max_sequence_length, goal2id=
     @param device: device to allocate tensors
     @return: a predicted action
     """
-    input_features = defaultdict(list)
-    # convert state to input features
-    input_ids, _ = convert_example_to_feature_for_goal_prediction(tokenizer, state, max_sequence_length,
-                                                                  goal2id)
-
-    input_features['input_ids'] = input_ids
-    # padding the input features
-    input_features = tokenizer.pad(
-        input_features, padding=padding, pad_to_multiple_of=pad_to_multiple_of,
-        max_length=max_sequence_length
-    )
-    # convert features to torch tensors
-    for k, v in input_features.items():
-        if not isinstance(v, torch.Tensor):
-            input_features[k] = torch.as_tensor(v, device=device).unsqueeze(0)
-
-    # compute policy with offline policy model.
-    logits = policy_model(input_features)
-    pred_action_id = logits.argmax(-1).detach().cpu().numpy().tolist()[0]
-    id2goal = {v: k for k, v in goal2id.items()}
-    action = id2goal[pred_action_id]
-    return action
+    return get_policy_scorer(policy_model, tokenizer, max_sequence_length, goal2id, padding=padding,
+                             pad_to_multiple_of=pad_to_multiple_of, device=device).argmax([state])[0]
 
 
 def predict_action_prior(policy_model, tokenizer, state, max_sequence_length, goal2id=None, pad_to_multiple_of=True,
@@ -406,31 +592,12 @@ def predict_action_prior(policy_model, tokenizer, state, max_sequence_length, go
     @param device: device to allocate tensors
     @return: a predicted action
     """
-    input_features = defaultdict(list)
-    # convert state to input features
-    input_ids, _ = convert_example_to_feature_for_goal_prediction(tokenizer, state, max_sequence_length,
-                                                                  goal2id)
-
-    input_features['input_ids'] = input_ids
-    # padding the input features
-    input_features = tokenizer.pad(
-        input_features, padding=padding, pad_to_multiple_of=pad_to_multiple_of,
-        max_length=max_sequence_length
-    )
-    # convert features to torch tensors
-    for k, v in input_features.items():
-        if not isinstance(v, torch.Tensor):
-            input_features[k] = torch.as_tensor(v, device=device).unsqueeze(0)
-
-    # compute policy with offline policy model.
-    logits = policy_model(input_features)
-
-    # compute probability distribution
-    all_probs = torch.softmax(logits, dim=-1)
+    # probability distribution over the actions
+    all_probs = get_policy_scorer(policy_model, tokenizer, max_sequence_length, goal2id, padding=padding,
+                                  pad_to_multiple_of=pad_to_multiple_of, device=device).score([state])
 
     # convert to np.array
-    all_probs = all_probs.detach().cpu().numpy()
-    return all_probs[0]
+    return all_probs.float().cpu().numpy()[0]
 
 
 def predict_topk_action(policy_model, tokenizer, state, max_sequence_length, goal2id=None, pad_to_multiple_of=True,
@@ -449,53 +616,18 @@ def predict_topk_action(policy_model, tokenizer, state, max_sequence_length, goa
     @param epsilon: a small probability used for exploration.
     @return: a predicted action
     """
-    input_features = defaultdict(list)
-    # convert state to input features
-    input_ids, _ = convert_example_to_feature_for_goal_prediction(tokenizer, state, max_sequence_length,
-                                                                  goal2id)
-
-    input_features['input_ids'] = input_ids
-    # padding the input features
-    input_features = tokenizer.pad(
-        input_features, padding=padding, pad_to_multiple_of=pad_to_multiple_of,
-        max_length=max_sequence_length
-    )
-    # convert features to torch tensors
-    for k, v in input_features.items():
-        if not isinstance(v, torch.Tensor):
-            input_features[k] = torch.as_tensor(v, device=device).unsqueeze(0)
-
-    # compute policy with offline policy model.
-    logits = policy_model(input_features)
-
-    # convert logits to probabilities
-    all_probs = torch.softmax(logits, dim=-1)
-
-    # compute top-k predictions
-    topk_probs, topk_indices = torch.topk(all_probs, top_k, sorted=True)
-    topk_probs = topk_probs.tolist()[0]
-    topk_indices = topk_indices.tolist()[0]
-
-    # epsilon greedy algorithm
-    p = np.random.random()
-    if p < epsilon:
-        # a random action from top-k predictions.
-        idx = np.random.choice(top_k)
-    else:
-        # action with the highest probability
-        idx = topk_indices[0]
-    # # randomly sample an action to from top_k predictions.
-    # idx = random.choice(topk_indices)
-    id2goal = {v: k for k, v in goal2id.items()}
-    action = id2goal[idx]
-    return action
+    # epsilon greedy algorithm over the top-k predictions
+    return get_policy_scorer(policy_model, tokenizer, max_sequence_length, goal2id, padding=padding,
+                             pad_to_multiple_of=pad_to_multiple_of, device=device).epsilon_greedy(
+        [state], top_k=top_k, epsilon=epsilon)[0]
 
 
 def simulate_conversation(generation_model, generation_tokenizer, know_generation_model, know_tokenizer, policy_model,
                           policy_tokenizer, state, horizon=5,
                           max_sequence_length=512, max_gen_length=50, padding='max_length',
                           pad_to_multiple_of=True, goal2id=None, terminated_action=None, device=None,
-                          greedy_search=True, top_k=3, epsilon=0.1, use_rtcp_policy=False, topic2id=None):
+                          greedy_search=True, top_k=3, epsilon=0.1, use_rtcp_policy=False, topic2id=None,
+                          transition_cache=None, knowledge_cache=None, llm_call_counter=None, dataset='durecdial'):
     """
     function that simulates a conversation between an user and a system starting from a given input state.
     @param generation_model: a response generation used to produce a system response
@@ -515,11 +647,17 @@ def simulate_conversation(generation_model, generation_tokenizer, know_generatio
     @param greedy_search: True if we use greedy search
     @param top_k: get top_k predictions
     @param epsilon: a small probability used for exploration
+    @param transition_cache: an optional TransitionCache memoizing the knowledge, the responses and the user replies
+    @param knowledge_cache: an optional TransitionCache memoizing the knowledge by input sequence
+    @param llm_call_counter: an optional function called with the number of user simulator calls made, e.g.
+    DialogueEnv.count_llm_calls so that the simulations count towards the LLM budget of the search
+    @param dataset: the dataset of the conversation, used for the response generation and the user simulator
     @return: the last generated system response.
     """
     is_terminal = False
     i = 0
-    start_state = copy.deepcopy(state)
+    # persistent state, the simulated turns extend it without copying the conversation
+    start_state = DialogueState.from_dict(state)
     simulated_conversation = []
     # loop for horizon rounds
     while (not is_terminal) and i < horizon:
@@ -561,35 +699,40 @@ def simulate_conversation(generation_model, generation_tokenizer, know_generatio
                                          epsilon=epsilon)
 
         # generate relevant knowledge
-        knowledge = generate_knowledge_with_plm(generation_model=know_generation_model,
-                                                tokenizer=know_tokenizer,
-                                                action=action,
-                                                state=start_state,
-                                                max_sequence_length=max_sequence_length,
-                                                max_gen_length=max_gen_length,
-                                                pad_to_multiple_of=pad_to_multiple_of,
-                                                padding=padding,
-                                                device=device)
+        knowledge = cached_step(transition_cache, 'knowledge', start_state, [action],
+                                lambda: generate_knowledge_with_plm(generation_model=know_generation_model,
+                                                                    tokenizer=know_tokenizer,
+                                                                    action=action,
+                                                                    state=start_state,
+                                                                    max_sequence_length=max_sequence_length,
+                                                                    max_gen_length=max_gen_length,
+                                                                    pad_to_multiple_of=pad_to_multiple_of,
+                                                                    padding=padding,
+                                                                    device=device,
+                                                                    knowledge_cache=knowledge_cache))
 
         # generate the system response using chatgpt
         # later it will be replaced by the generated response by BART.
         # system_resp = get_user_resp(start_state, action)
-        system_resp = generate_sys_response_with_plm(generation_model=generation_model,
-                                                     tokenizer=generation_tokenizer,
-                                                     action=action,
-                                                     knowledge=knowledge,
-                                                     state=start_state,
-                                                     max_sequence_length=max_sequence_length,
-                                                     max_gen_length=max_gen_length,
-                                                     pad_to_multiple_of=pad_to_multiple_of,
-                                                     padding=padding,
-                                                     device=device)
+        system_resp = cached_step(transition_cache, 'response', start_state, [action, dataset],
+                                  lambda: generate_sys_response_with_plm(generation_model=generation_model,
+                                                                         tokenizer=generation_tokenizer,
+                                                                         action=action,
+                                                                         knowledge=knowledge,
+                                                                         state=start_state,
+                                                                         max_sequence_length=max_sequence_length,
+                                                                         max_gen_length=max_gen_length,
+                                                                         pad_to_multiple_of=pad_to_multiple_of,
+                                                                         padding=padding,
+                                                                         device=device,
+                                                                         dataset=dataset))
         # check the terminated condition
         if check_terminated_condition(action, terminated_action):
             is_terminal = True
 
         # simulate user response.
-        user_resp = get_user_resp(start_state, system_resp)
+        user_resp = cached_step(transition_cache, 'user', start_state, [system_resp, dataset],
+                                lambda: simulate_user(start_state, system_resp, llm_call_counter, dataset=dataset))
 
         # update state
         start_state = update_state(start_state, action, system_resp, user_resp)
@@ -606,6 +749,20 @@ def simulate_conversation(generation_model, generation_tokenizer, know_generatio
     return simulated_conversation
 
 
+def simulate_user(state, system_resp, llm_call_counter=None, dataset='inspired'):
+    """
+    function that simulates the user response to a system response, counting the call
+    @param state: the current state
+    @param system_resp: the system response
+    @param llm_call_counter: an optional function called with the number of LLM calls made
+    @param dataset: the dataset of the conversation, see get_user_resp
+    @return: the user response
+    """
+    if llm_call_counter is not None:
+        llm_call_counter(1)
+    return get_user_resp(state, system_resp, dataset=dataset)
+
+
 # define a reward function based the generated conversation
 def reward_func(conversations, target_topic, target_goal, delta=1, temperature=1):
     """
@@ -774,11 +931,13 @@ def random_seed(seed):
     np.random.seed(seed)
 
 
-def construct_initial_state(target_item, system_initial_resp="Hi !, How do I help you ?", dataset='durecdial'):
+def construct_initial_state(target_item, system_initial_resp="Hi !, How do I help you ?", dataset='durecdial',
+                            transition_cache=None):
     """
     function that constructs the initial state for each conversation
     @param target_item: the targeted item
     @param system_initial_resp: default system response
+    @param transition_cache: an optional TransitionCache memoizing the initial user response
     @return: the constructed state.
     """
     seed = random.randint(0, 10000)
@@ -809,7 +968,9 @@ def construct_initial_state(target_item, system_initial_resp="Hi !, How do I hel
         "pre_goals": [],
         "pre_topics": []
     }
-    user_initial_response = get_user_resp(state, sys_response=system_initial_resp, dataset=dataset)
+    user_initial_response = cached_step(transition_cache, 'user', state, [system_initial_resp, dataset],
+                                        lambda: get_user_resp(state, sys_response=system_initial_resp,
+                                                              dataset=dataset))
     state['dialogue_context'].append({'role': 'user', 'content': user_initial_response})
     return state
 
@@ -869,7 +1030,8 @@ def self_simulation(num_simulations, target_set, generation_model, generation_to
                 device=device,
                 greedy_search=greedy_search,
                 top_k=top_k,
-                epsilon=epsilon
+                epsilon=epsilon,
+                dataset=dataset
             )
 
             # compute LLM-based assessment
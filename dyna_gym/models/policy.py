@@ -1,3 +1,6 @@
+import copy
+import threading
+
 import torch
 import torch.nn as nn
 
@@ -28,3 +31,83 @@ class PolicyModel(nn.Module):
         hidden = torch.relu(self.proj_layer(cls_token))
         logits = self.out_layer(hidden)
         return logits
+
+
+class PolicyInferenceRunner:
+    """
+    Inference wrapper of a policy model, called like the model itself
+
+    The runner works on a copy of the model, which it puts in eval mode (no dropout), the model given by the caller is
+    left unchanged. Every call runs under torch.inference_mode, so no autograd graph is built. The weights can be cast to half precision, or quantized to int8 for CPU inference, and the forward can be
+    compiled with torch.compile. Floating point outputs are returned in float32.
+
+    Args:
+        model: the policy model, e.g. a PolicyModel, already on its device
+        dtype: None to keep the weights as they are, 'bf16' or 'fp16' to cast them, 'int8' to quantize the linear
+            layers dynamically (CPU only)
+        compile: whether to compile the forward with torch.compile, on the first call
+    """
+
+    DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+    def __init__(self, model, dtype=None, compile=False):
+        if dtype is not None and dtype not in self.DTYPES and dtype != 'int8':
+            raise Exception(f"Unknown policy dtype: {dtype}")
+        # eval(), the cast and the quantization modify the module in place. A PolicyScorer cached on the model (see
+        # policy_scorer.get_policy_scorer) is not copied, it refers to the original model
+        scorer = vars(model).get('_policy_scorer')
+        model = copy.deepcopy(model, {id(scorer): None} if scorer is not None else None)
+        model.eval()
+        if dtype == 'int8':
+            if any(p.is_cuda for p in model.parameters()):
+                raise Exception("int8 policy weights are only supported on CPU")
+            model = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        elif dtype is not None:
+            model = model.to(self.DTYPES[dtype])
+        self.model = model
+        self.dtype = dtype
+        self.compile = compile
+        self.forward = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # the compiled forward and the lock cannot be pickled, e.g. for root-parallel workers
+        state = self.__dict__.copy()
+        state['forward'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_forward(self):
+        if self.forward is None:
+            with self.lock:
+                if self.forward is None:
+                    self.forward = torch.compile(self.model) if self.compile else self.model
+        return self.forward
+
+    def __call__(self, *args, **kwargs):
+        with torch.inference_mode():
+            outputs = self.get_forward()(*args, **kwargs)
+        return to_float(outputs)
+
+    def __getattr__(self, name):
+        # other attributes and methods (n_goals, select_action, ...) are those of the model
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+
+def to_float(outputs):
+    """
+    Cast the floating point tensors of the outputs of a model to float32
+    """
+    if isinstance(outputs, torch.Tensor):
+        return outputs.float() if outputs.is_floating_point() else outputs
+    if isinstance(outputs, dict):
+        return {k: to_float(v) for k, v in outputs.items()}
+    if isinstance(outputs, (list, tuple)):
+        return type(outputs)(to_float(v) for v in outputs)
+    return outputs
@@ -0,0 +1,121 @@
+"""
+Batched scoring of dialogue states with the goal prediction policy
+
+A PolicyScorer converts a list of states to input features, pads them into one batch and runs a single forward pass
+of the policy model. The greedy, top-k and epsilon-greedy predictions used by the search, the simulations and the
+evaluation are all derived from the resulting probabilities.
+"""
+import numpy as np
+import torch
+
+from dataset.data_utils import convert_example_to_feature_for_goal_prediction
+from dyna_gym.utils.feature_utils import pad_features
+
+
+class PolicyScorer:
+    """
+    Action probabilities of a policy model for batches of states
+
+    Args:
+        policy_model: the offline policy model, or a PolicyInferenceRunner wrapping it
+        tokenizer: the huggingface tokenizer of the policy model
+        max_sequence_length: the maximum number of tokens in the input sequences
+        goal2id: a dictionary that maps the actions to indices
+        padding: the padding of the inputs, see dyna_gym.utils.feature_utils.pad_features
+        pad_to_multiple_of: see dyna_gym.utils.feature_utils.pad_features
+        device: device to allocate tensors
+    """
+
+    def __init__(self, policy_model, tokenizer, max_sequence_length, goal2id, padding='max_length',
+                 pad_to_multiple_of=True, device=None):
+        self.policy_model = policy_model
+        self.tokenizer = tokenizer
+        self.max_sequence_length = max_sequence_length
+        self.goal2id = goal2id
+        self.id2goal = {v: k for k, v in goal2id.items()}
+        self.padding = padding
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.device = device
+
+    @torch.no_grad()
+    def score(self, states):
+        """
+        Probabilities of the actions in each state, with one forward pass of the policy model
+
+        Args:
+            states: a list of dialogue states
+
+        Returns:
+            a tensor of shape (len(states), number of actions)
+        """
+        batch_features = []
+        for state in states:
+            # convert state to input features
+            input_ids, _ = convert_example_to_feature_for_goal_prediction(self.tokenizer, state,
+                                                                          self.max_sequence_length, self.goal2id)
+            batch_features.append({'input_ids': input_ids})
+
+        # padding the input features
+        input_features = pad_features(self.tokenizer, batch_features, self.max_sequence_length, padding=self.padding,
+                                      pad_to_multiple_of=self.pad_to_multiple_of, device=self.device)
+
+        # compute policy with offline policy model.
+        logits = self.policy_model(input_features)
+        return torch.softmax(logits, dim=-1)
+
+    def matches(self, tokenizer, max_sequence_length, goal2id, padding, pad_to_multiple_of, device):
+        """
+        Whether the scorer was built with the given arguments
+        """
+        return tokenizer is self.tokenizer and goal2id is self.goal2id \
+            and (max_sequence_length, padding, pad_to_multiple_of, str(device)) \
+            == (self.max_sequence_length, self.padding, self.pad_to_multiple_of, str(self.device))
+
+    def argmax(self, states):
+        """
+        Most likely action of each state
+        """
+        pred_action_ids = self.score(states).argmax(-1).tolist()
+        return [self.id2goal[pred_action_id] for pred_action_id in pred_action_ids]
+
+    def top_k(self, states, top_k):
+        """
+        Top-k action indices and probabilities of each state, in decreasing order of probability
+
+        Returns:
+            a list of (indices, probabilities) pairs of lists
+        """
+        topk_probs, topk_indices = torch.topk(self.score(states), top_k, sorted=True)
+        return list(zip(topk_indices.tolist(), topk_probs.tolist()))
+
+    def epsilon_greedy(self, states, top_k=3, epsilon=0.1):
+        """
+        Epsilon-greedy action of each state: with probability epsilon, an action drawn uniformly from the top-k
+        predictions, otherwise the most likely action
+        """
+        actions = []
+        for topk_indices, _ in self.top_k(states, top_k):
+            if np.random.random() < epsilon:
+                # a random action from top-k predictions.
+                idx = topk_indices[np.random.choice(len(topk_indices))]
+            else:
+                # action with the highest probability
+                idx = topk_indices[0]
+            actions.append(self.id2goal[idx])
+        return actions
+
+
+def get_policy_scorer(policy_model, tokenizer, max_sequence_length, goal2id, padding='max_length',
+                      pad_to_multiple_of=True, device=None):
+    """
+    PolicyScorer of the given arguments, so that the per-model state (e.g. id2goal) is built once. The last scorer is
+    kept on the policy object itself: it lives as long as the model and is rebuilt when the other arguments change.
+    """
+    scorer = vars(policy_model).get('_policy_scorer')
+    if scorer is None or not scorer.matches(tokenizer, max_sequence_length, goal2id, padding, pad_to_multiple_of,
+                                            device):
+        scorer = PolicyScorer(policy_model, tokenizer, max_sequence_length, goal2id, padding=padding,
+                              pad_to_multiple_of=pad_to_multiple_of, device=device)
+        # set through object.__setattr__ so that nn.Module and PolicyInferenceRunner store it as a plain attribute
+        object.__setattr__(policy_model, '_policy_scorer', scorer)
+    return scorer
@@ -23,6 +23,7 @@ def uct_for_dialogue_planning_pipeline(
         terminal_act: str = 'Say goodbye',
         max_sequence_length=512,
         max_gen_length=50,
+        padding='max_length',
         reward_func: Callable = None,
         uct_args: dict = {},
         model_generation_args: dict = {},
@@ -30,7 +31,11 @@ def uct_for_dialogue_planning_pipeline(
         device=None,
         should_plot_tree: bool = False,
         use_rtcp_policy: bool = False,
-        topic2id = None
+        topic2id = None,
+        num_workers: int = 1,
+        transition_cache=None,
+        knowledge_cache=None,
+        dataset='durecdial'
 ) -> Callable:
     """
     function that implements the pipeline for MCTS dialogue planning
@@ -44,13 +49,21 @@ def uct_for_dialogue_planning_pipeline(
     @param terminal_act: the terminated action
     @param max_sequence_length: the maximum number of tokens in the input sequence
     @param max_gen_length: the maximum number of tokens in the generated output
+    @param padding: the padding of the model inputs, 'max_length' or 'bucket', see dyna_gym.utils.feature_utils
     @param reward_func: the reward function
     @param uct_args: parameters for UCT criteria.
     @param model_generation_args: params for generation model.
     @param goal2id: a dictionary that map goals to indices.
     @param device: the device which we run the models.
     @param should_plot_tree:
-    @return: a function.
+    @param num_workers: the number of processes running independent searches from the same root (root parallelisation).
+    @param transition_cache: an optional dyna_gym.utils.cache.TransitionCache shared by the environment and the
+    simulations of the default policy.
+    @param knowledge_cache: an optional dyna_gym.utils.cache.TransitionCache memoizing the generated knowledge by input
+    sequence, shared by the environment and the simulations of the default policy.
+    @param dataset: the dataset of the conversations, it must be that of the evaluation so that the actual user
+    replies can be matched with the simulated ones when the tree is reused.
+    @return: a function, its agent attribute is the UCT agent, which must be closed after the last call.
     """
     reward_func_ = reward_func
     env = gym.make(
@@ -67,6 +80,10 @@ def uct_for_dialogue_planning_pipeline(
         device=device,
         max_sequence_length=max_sequence_length,
         max_gen_length=max_gen_length,
+        padding=padding,
+        transition_cache=transition_cache,
+        knowledge_cache=knowledge_cache,
+        dataset=dataset,
     )
 
     # we do not use rtcp as the default policy
@@ -82,10 +99,14 @@ def uct_for_dialogue_planning_pipeline(
             policy_tokenizer=policy_tokenizer,
             max_sequence_length=max_sequence_length,
             max_gen_length=max_gen_length,
+            padding=padding,
             generation_args=model_generation_args,
             goal2id=goal2id,
             terminated_act=terminal_act,
-            device=device
+            device=device,
+            transition_cache=transition_cache,
+            knowledge_cache=knowledge_cache,
+            dataset=dataset
         )
     # if we use rtcp as default policy
     else:
@@ -100,24 +121,36 @@ def uct_for_dialogue_planning_pipeline(
             policy_tokenizer=policy_tokenizer,
             max_sequence_length=max_sequence_length,
             max_gen_length=max_gen_length,
+            padding=padding,
             generation_args=model_generation_args,
             goal2id=goal2id,
             terminated_act=terminal_act,
             device=device,
-            topic2id=topic2id
+            topic2id=topic2id,
+            transition_cache=transition_cache,
+            knowledge_cache=knowledge_cache,
+            dataset=dataset
         )
 
     agent = uct.UCT(
         default_policy=default_policy,
         memory=memory,
+        num_workers=num_workers,
         **uct_args
     )
 
+    # the transitions are timed by the profiler of the agent, if any
+    env.unwrapped.profiler = agent.profiler
+
     id2goal = {v: k for k, v in goal2id.items()}
 
     # Run
     def generate(initial_state):
         env.reset(initial_state)
+        if agent.reuse_tree:
+            # re-root the tree at the state reached by the committed action and the actual user reply
+            # the tree is dropped if that state was not expanded (e.g. at the start of a new conversation)
+            agent.reroot(agent.opt_act, initial_state, env.equality_operator)
         # do all rollouts in one step
         env.step(agent.act(env, done=False))
         # print tree
@@ -133,9 +166,11 @@ def uct_for_dialogue_planning_pipeline(
         # print("[Optimal Action]: ", id2goal[agent.opt_act] )
 
         optimal_action = id2goal[agent.opt_act]
-        # clear for the next generation call
-        agent.reset()
+        # clear for the next generation call, the tree is kept if it is reused in the next turn
+        agent.reset(keep_tree=agent.reuse_tree)
 
         return optimal_action, agent.global_reward_his
 
+    # the agent is exposed so that the caller can stop its worker processes, see UCT.close
+    generate.agent = agent
     return generate
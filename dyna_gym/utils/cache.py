@@ -0,0 +1,153 @@
+"""
+Memoization of the deterministic steps of the dialogue transitions
+
+The knowledge and response generators decode greedily and the user simulator is prompted with temperature 0, so the
+outputs of these steps only depend on their inputs. A TransitionCache keeps them in an in-memory LRU, optionally
+backed by an sqlite file so that they are reused across runs. The keys are strings built by the caller, see
+dyna_gym.envs.utils.transition_cache_key; the values must be JSON-serialisable, None included.
+
+The inputs of a step do not say which models computed it, so the cache takes a namespace for each kind of step,
+e.g. the checkpoint of the generation model, which is mixed into the keys of that kind. A file shared by runs with
+different models or generation settings then never returns the outputs of another configuration.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+
+# default value of TransitionCache.get telling a miss apart from a cached None
+MISSING = object()
+
+
+class TransitionCache:
+    """
+    LRU cache with an optional on-disk store
+
+    Args:
+        max_size: maximum number of entries kept in memory
+        path: optional path of an sqlite file storing every entry, entries evicted from memory are read back from it
+        commit_every: number of writes to the sqlite file between two commits, the remaining writes are committed by
+            flush() and close(). Uncommitted entries are visible to this cache but not to other processes
+        namespaces: optional dictionary mapping a kind of step to the JSON-serialisable identity of what computes
+            it, see dyna_gym.envs.utils.cache_namespaces. The keys of the kinds without a namespace are used as is
+    """
+
+    def __init__(self, max_size=100000, path=None, commit_every=100, namespaces=None):
+        self.max_size = max_size
+        self.path = path
+        self.commit_every = commit_every
+        self.prefixes = {}
+        for kind, namespace in (namespaces or {}).items():
+            digest = hashlib.sha1(json.dumps(namespace, sort_keys=True).encode('utf-8')).hexdigest()
+            self.prefixes[kind] = digest[:16] + ':'
+        self.n_uncommitted = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def __getstate__(self):
+        # the lock and the sqlite connection cannot be pickled, the copy opens its own and reads the pending writes
+        # once they are committed
+        self.flush()
+        state = self.__dict__.copy()
+        del state['lock']
+        state['connection'] = None
+        state['n_uncommitted'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)')
+        return self.connection
+
+    def get(self, key, kind='default', default=None):
+        """
+        Cached value of key, or default
+
+        Args:
+            key: the key
+            kind: name under which the hit or the miss is counted, e.g. the step of the transition
+            default: value returned on a miss, MISSING to tell a miss apart from a cached None
+        """
+        key = self.prefixes.get(kind, '') + key
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits[kind] += 1
+                return self.entries[key]
+            if self.path is not None:
+                row = self.connect().execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    value = json.loads(row[0])
+                    self.insert(key, value)
+                    self.hits[kind] += 1
+                    return value
+            self.misses[kind] += 1
+            return default
+
+    def put(self, key, value, kind='default'):
+        key = self.prefixes.get(kind, '') + key
+        with self.lock:
+            self.insert(key, value)
+            if self.path is not None:
+                self.connect().execute('INSERT OR REPLACE INTO cache VALUES (?, ?)', (key, json.dumps(value)))
+                self.n_uncommitted += 1
+                # one commit per batch of writes, a commit syncs the file
+                if self.n_uncommitted >= self.commit_every:
+                    self.commit()
+
+    def commit(self):
+        # the lock must be held
+        if self.connection is not None and self.n_uncommitted > 0:
+            self.connection.commit()
+        self.n_uncommitted = 0
+
+    def flush(self):
+        """
+        Commit the pending writes to the sqlite file
+        """
+        with self.lock:
+            self.commit()
+
+    def insert(self, key, value):
+        # the lock must be held
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute, kind='default'):
+        """
+        Cached value of key, computed with compute() and stored on a miss
+        """
+        value = self.get(key, kind=kind, default=MISSING)
+        if value is MISSING:
+            value = compute()
+            self.put(key, value, kind=kind)
+        return value
+
+    def stats(self):
+        """
+        Number of hits and misses of each kind and overall
+        """
+        kinds = sorted(set(self.hits) | set(self.misses))
+        stats = {kind: {'hits': self.hits[kind], 'misses': self.misses[kind]} for kind in kinds}
+        hits, misses = sum(self.hits.values()), sum(self.misses.values())
+        stats['total'] = {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.}
+        stats['size'] = len(self.entries)
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
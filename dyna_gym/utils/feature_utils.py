@@ -0,0 +1,62 @@
+"""
+Padding of the model inputs built during the search
+
+With padding='max_length' every input is padded to max_sequence_length, so a short early-dialogue context costs as
+much as a full one. With padding='bucket' a batch is padded to its longest sequence rounded up to a multiple of the
+bucket size (and capped at max_sequence_length): the number of distinct input shapes stays small, which keeps the
+kernels reusable, while short inputs are run at a fraction of the cost. The padded positions are masked by the
+attention mask returned by the tokenizer, so BART and BERT models give the same outputs as with max_length padding.
+"""
+import math
+
+import torch
+
+# default bucket size of padding='bucket'
+BUCKET_SIZE = 64
+
+
+def bucket_length(length, max_length, bucket_size=BUCKET_SIZE):
+    """
+    Padded length of a batch whose longest sequence has the given length
+
+    Args:
+        length: length of the longest sequence of the batch
+        max_length: maximum padded length
+        bucket_size: the padded length is a multiple of bucket_size, unless capped by max_length
+    """
+    return min(max(bucket_size, int(math.ceil(length / bucket_size)) * bucket_size), max_length)
+
+
+def pad_features(tokenizer, batch_features, max_sequence_length, padding='max_length', pad_to_multiple_of=True,
+                 device=None):
+    """
+    Pad a batch of input features and convert them to tensors
+
+    Args:
+        tokenizer: a huggingface tokenizer
+        batch_features: a list of dictionaries holding the input_ids of each sequence
+        max_sequence_length: the maximum number of tokens in the input sequences
+        padding: 'bucket' to pad to the longest sequence rounded up to a bucket, otherwise any padding strategy of
+            tokenizer.pad, e.g. 'max_length'
+        pad_to_multiple_of: passed to tokenizer.pad; with padding='bucket', an integer larger than 1 overrides the
+            default bucket size
+        device: device to allocate tensors
+
+    Returns:
+        a dictionary of tensors of shape (batch size, padded length), with the input ids and the attention mask
+    """
+    if padding == 'bucket':
+        bucket_size = BUCKET_SIZE
+        if not isinstance(pad_to_multiple_of, bool) and isinstance(pad_to_multiple_of, int) and pad_to_multiple_of > 1:
+            bucket_size = pad_to_multiple_of
+        longest = max(len(features['input_ids']) for features in batch_features)
+        input_features = tokenizer.pad(batch_features, padding='max_length', return_attention_mask=True,
+                                       max_length=bucket_length(longest, max_sequence_length, bucket_size))
+    else:
+        input_features = tokenizer.pad(batch_features, padding=padding, pad_to_multiple_of=pad_to_multiple_of,
+                                       return_attention_mask=True, max_length=max_sequence_length)
+    # convert features to torch tensors
+    for k, v in input_features.items():
+        if not isinstance(v, torch.Tensor):
+            input_features[k] = torch.as_tensor(v, device=device)
+    return input_features
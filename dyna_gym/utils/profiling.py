@@ -0,0 +1,132 @@
+"""
+Profiling of the tree search
+
+A SearchProfiler records, for each call to the agent (a turn), the time spent and the number of calls in each phase of
+the search (selection, transitions, knowledge/response generation, user simulation, memory retrieval,
+backpropagation, ...) together with the size of the tree. The records are kept in memory and can be appended to a
+JSONL file.
+
+Phases may run concurrently (see parallel_rollouts), in which case their durations add up to more than the
+wall-clock time of the turn.
+"""
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class SearchProfiler:
+    """
+    Per-turn profiler of the tree search
+
+    Args:
+        out_path: optional path of a JSONL file, one record is appended to it at the end of each turn
+    """
+
+    def __init__(self, out_path=None):
+        self.out_path = out_path
+        self.records = []
+        self.lock = threading.Lock()
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.start_time = None
+
+    def __getstate__(self):
+        # locks cannot be pickled, the copy starts with a new one
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def start_turn(self):
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.start_time = time.perf_counter()
+
+    def add(self, name, duration, count=1):
+        """
+        Record count calls of a phase lasting duration seconds in total
+        """
+        with self.lock:
+            self.durations[name] += duration
+            self.counts[name] += count
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager timing one call of a phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def end_turn(self, **info):
+        """
+        Close the record of the current turn
+
+        Args:
+            info: additional fields of the record, e.g. the number of rollouts and the size of the tree
+
+        Returns:
+            the record of the turn
+        """
+        record = {
+            'turn': len(self.records),
+            'time': time.perf_counter() - self.start_time,
+            'phases': {name: {'time': self.durations[name], 'calls': self.counts[name]} for name in self.durations},
+        }
+        record.update(info)
+        self.records.append(record)
+        if self.out_path is not None:
+            with open(self.out_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return record
+
+    def summary(self):
+        """
+        Total time and number of calls of each phase over all the recorded turns
+        """
+        phases = defaultdict(lambda: {'time': 0., 'calls': 0})
+        for record in self.records:
+            for name, stats in record['phases'].items():
+                phases[name]['time'] += stats['time']
+                phases[name]['calls'] += stats['calls']
+        return {
+            'turns': len(self.records),
+            'time': sum(record['time'] for record in self.records),
+            'phases': dict(phases),
+        }
+
+
+def profile_phase(profiler, name):
+    """
+    Time a phase with profiler, or do nothing if profiler is None
+    """
+    if profiler is None:
+        return nullcontext()
+    return profiler.phase(name)
+
+
+def tree_size(root):
+    """
+    Number of decision nodes and chance nodes of a tree, the nodes shared by several parents are counted once
+    """
+    n_decision, n_chance = 0, 0
+    seen = set()
+    stack = [root]
+    while len(stack) > 0:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        n_decision += 1
+        for chance_node in node.children:
+            n_chance += 1
+            stack.extend(chance_node.children)
+    return {'decision_nodes': n_decision, 'chance_nodes': n_chance}
@@ -1,3 +1,5 @@
+import heapq
+import json
 import random
 
 import networkx as nx
@@ -21,30 +23,78 @@ def update_root(ag, act, state_p):
         raise Exception("root update fails, can't find the next state, action pair in tree.")
 
 
+def iter_tree(root: DecisionNode, max_depth=None):
+    """
+    Iterative pre-order traversal of the tree rooted at root
+    @param root: the root DecisionNode
+    @param max_depth: if given, the DecisionNodes deeper than max_depth and their ChanceNodes are not visited
+    @return: a generator of (node, depth) pairs, DecisionNodes and ChanceNodes alike. A ChanceNode has the depth of its
+    parent DecisionNode
+    """
+    stack = [(root, 0)]
+    while len(stack) > 0:
+        node, depth = stack.pop()
+        yield node, depth
+        if isinstance(node, DecisionNode):
+            stack.extend((chance_node, depth) for chance_node in reversed(node.children))
+        elif max_depth is None or depth < max_depth:
+            stack.extend((decision_node, depth + 1) for decision_node in reversed(node.children))
+
+
 def pre_order_traverse(
         decision_node: DecisionNode,
         decision_node_fn=lambda n, d: None,
         chance_node_fn=lambda n, d: None,
         depth=0):
     """
-    Postorder traversal of the tree rooted at state
+    Preorder traversal of the tree rooted at state
     Apply fn once visited
     """
-    decision_node_fn(decision_node, depth)
-
-    for chance_node in decision_node.children:
-        chance_node_fn(chance_node, depth)
-        for next_decision_node in chance_node.children:
-            pre_order_traverse(next_decision_node, decision_node_fn, chance_node_fn, depth + 1)
+    for node, node_depth in iter_tree(decision_node):
+        if isinstance(node, DecisionNode):
+            decision_node_fn(node, depth + node_depth)
+        else:
+            chance_node_fn(node, depth + node_depth)
 
 
 def get_all_decision_nodes(root: DecisionNode):
     """
     Get all decision nodes in the tree
     """
-    decision_nodes = []
-    pre_order_traverse(root, decision_node_fn=lambda n, d: decision_nodes.append(n))
-    return decision_nodes
+    return [node for node, _ in iter_tree(root) if isinstance(node, DecisionNode)]
+
+
+def export_tree(root: DecisionNode, filename, max_depth=None, top_n=None):
+    """
+    Stream the tree rooted at root to a JSONL file, one line per DecisionNode, without building the tree in memory.
+    Each line holds the node, its parent and the statistics of the ChanceNode (the edge) leading to it.
+    @param root: the root DecisionNode
+    @param filename: path of the output file
+    @param max_depth: if given, only the DecisionNodes up to this depth are exported
+    @param top_n: if given, only the top_n most visited ChanceNodes of each DecisionNode are followed
+    @return: the number of exported DecisionNodes
+    """
+    n_nodes = 0
+    # (decision node, depth, index of the parent line, chance node leading to it)
+    stack = [(root, 0, None, None)]
+    with open(filename, 'w') as f:
+        while len(stack) > 0:
+            node, depth, parent, edge = stack.pop()
+            line = {'node': n_nodes, 'parent': parent, 'depth': depth, 'visits': node.visits,
+                    'is_terminal': node.is_terminal}
+            if edge is not None:
+                line.update({'action': repr(edge.action), 'prob': edge.prob, 'n': edge.n_returns,
+                             'mean': edge.mean_return, 'max': edge.max_return})
+            f.write(json.dumps(line) + '\n')
+            if max_depth is None or depth < max_depth:
+                children = node.children
+                if top_n is not None:
+                    children = heapq.nlargest(top_n, children, key=lambda c: c.n_returns)
+                for chance_node in reversed(children):
+                    for child in reversed(chance_node.children):
+                        stack.append((child, depth + 1, n_nodes, chance_node))
+            n_nodes += 1
+    return n_nodes
 
 
 def print_tree(root: DecisionNode, tokenizer):
@@ -54,14 +104,16 @@ def print_tree(root: DecisionNode, tokenizer):
         print("\t" * depth,
               repr(node.action),
               'prob', node.prob,
-              'returns', node.sampled_returns)
+              'n', node.n_returns,
+              'mean', node.mean_return,
+              'max', node.max_return)
 
     pre_order_traverse(root, chance_node_fn=printer)
 
 
-def plot_tree(root: DecisionNode, tokenizer, filename):
+def plot_tree(root: DecisionNode, tokenizer, filename, max_depth=None):
     """
-    Plot the tree rooted at root
+    Plot the tree rooted at root, down to max_depth if given
     """
     # plot the tree
     G = nx.DiGraph()
@@ -74,11 +126,13 @@ def plot_tree(root: DecisionNode, tokenizer, filename):
 
             G.add_node(child_id)
 
-            avg_return = np.mean(node.sampled_returns)
+            avg_return = node.sum_returns / node.n_returns
             edge_label = f'{repr(node.action)}\np={node.prob:.2f}\nR={avg_return:.2f}'
             G.add_edge(parent_id, child_id, label=edge_label)
 
-    pre_order_traverse(root, chance_node_fn=add_node)
+    for node, depth in iter_tree(root, max_depth=max_depth):
+        if isinstance(node, ChanceNode) and (max_depth is None or depth < max_depth):
+            add_node(node, depth)
 
     plt.figure(figsize=(15, 15))
 
@@ -179,59 +233,46 @@ def hierarchy_pos(G, root=None, width=1., vert_gap=0.2, vert_loc=0, leaf_vs_root
         else:
             root = random.choice(list(G.nodes))
 
-    def _hierarchy_pos(G, root, leftmost, width, leafdx=0.2, vert_gap=0.2, vert_loc=0,
-                       xcenter=0.5, rootpos=None,
-                       leafpos=None, parent=None):
-        '''
-        see hierarchy_pos docstring for most arguments
-
-        pos: a dict saying where all nodes go if they have been assigned
-        parent: parent of this branch. - only affects it if non-directed
-
-        '''
-
-        if rootpos is None:
-            rootpos = {root: (xcenter, vert_loc)}
-        else:
-            rootpos[root] = (xcenter, vert_loc)
-        if leafpos is None:
-            leafpos = {}
-        children = list(G.neighbors(root))
-        leaf_count = 0
-        if not isinstance(G, nx.DiGraph) and parent is not None:
-            children.remove(parent)
-        if len(children) != 0:
-            rootdx = width / len(children)
-            nextx = xcenter - width / 2 - rootdx / 2
-            for child in children:
-                nextx += rootdx
-                rootpos, leafpos, newleaves = _hierarchy_pos(G, child, leftmost + leaf_count * leafdx,
-                                                             width=rootdx, leafdx=leafdx,
-                                                             vert_gap=vert_gap, vert_loc=vert_loc - vert_gap,
-                                                             xcenter=nextx, rootpos=rootpos, leafpos=leafpos,
-                                                             parent=root)
-                leaf_count += newleaves
-
-            leftmostchild = min((x for x, y in [leafpos[child] for child in children]))
-            rightmostchild = max((x for x, y in [leafpos[child] for child in children]))
-            leafpos[root] = ((leftmostchild + rightmostchild) / 2, vert_loc)
-        else:
-            leaf_count = 1
-            leafpos[root] = (leftmost, vert_loc)
-        #        pos[root] = (leftmost + (leaf_count-1)*dx/2., vert_loc)
-        #        print(leaf_count)
-        return rootpos, leafpos, leaf_count
-
     xcenter = width / 2.
     if isinstance(G, nx.DiGraph):
         leafcount = len([node for node in nx.descendants(G, root) if G.out_degree(node) == 0])
     elif isinstance(G, nx.Graph):
         leafcount = len([node for node in nx.node_connected_component(G, root) if G.degree(node) == 1 and node != root])
-    rootpos, leafpos, leaf_count = _hierarchy_pos(G, root, 0, width,
-                                                  leafdx=width * 1. / leafcount,
-                                                  vert_gap=vert_gap,
-                                                  vert_loc=vert_loc,
-                                                  xcenter=xcenter)
+    leafdx = width * 1. / leafcount
+
+    # iterative depth-first layout, so that deep trees do not hit the recursion limit
+    # rootpos: top down, each node splits its horizontal space equally among its children
+    # leafpos: bottom up, the leaves are spaced by leafdx in visiting order and a node is centered above its children
+    rootpos, leafpos, children_of = {}, {}, {}
+    leaf_count = 0
+    # (node, parent, width, xcenter, vert_loc, whether the children of node have been laid out)
+    stack = [(root, None, width, xcenter, vert_loc, False)]
+    while len(stack) > 0:
+        node, parent, node_width, node_x, node_y, done = stack.pop()
+        if done:
+            children = children_of.pop(node)
+            leftmostchild = min(leafpos[child][0] for child in children)
+            rightmostchild = max(leafpos[child][0] for child in children)
+            leafpos[node] = ((leftmostchild + rightmostchild) / 2, node_y)
+            continue
+        rootpos[node] = (node_x, node_y)
+        children = list(G.neighbors(node))
+        if not isinstance(G, nx.DiGraph) and parent is not None:
+            children.remove(parent)
+        if len(children) == 0:
+            leafpos[node] = (leaf_count * leafdx, node_y)
+            leaf_count += 1
+            continue
+        children_of[node] = children
+        stack.append((node, parent, node_width, node_x, node_y, True))
+        rootdx = node_width / len(children)
+        nextx = node_x - node_width / 2 - rootdx / 2
+        child_args = []
+        for child in children:
+            nextx += rootdx
+            child_args.append((child, node, rootdx, nextx, node_y - vert_gap, False))
+        stack.extend(reversed(child_args))
+
     pos = {}
     for node in rootpos:
         pos[node] = (
@@ -0,0 +1,169 @@
+"""
+Binary snapshots of search trees
+
+A tree of DecisionNodes and ChanceNodes is stored as
+- NumPy arrays holding the statistics of the nodes and the parent/child links (the links are stored as an edge list,
+  so trees whose DecisionNodes are shared by several ChanceNodes are restored as they were),
+- a table of the distinct states, each node refers to its state by index. The table is pickled as one object, so
+  the entries shared between states (e.g. the demonstration) are stored once,
+and the whole snapshot is optionally compressed with zlib.
+
+The snapshot can be written mid-conversation and loaded later to analyse the tree or to warm-start a search.
+"""
+import pickle
+import zlib
+
+import numpy as np
+
+from dyna_gym.agents.mcts import DecisionNode, ChanceNode, reachable_nodes
+
+MAGIC = b'DGTREE1'
+
+# numeric attributes of the nodes, stored as arrays
+DECISION_ARRAYS = {
+    'depth': np.int64,
+    'visits': np.int64,
+    'is_terminal': np.bool_,
+    'has_priors': np.bool_,
+    'progressive': np.bool_,
+    'explored_children': np.int64,
+}
+CHANCE_ARRAYS = {
+    'depth': np.int64,
+    'prob': np.float64,
+    'n_returns': np.int64,
+    'sum_returns': np.float64,
+    'max_return': np.float64,
+    'last_return': np.float64,
+    'mean_return': np.float64,
+    'm2_returns': np.float64,
+    'virtual_loss': np.int64,
+}
+
+
+def state_key(state, fingerprint):
+    """
+    Key identifying equal states in the state table
+    """
+    if fingerprint is not None:
+        return fingerprint.key
+    return pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def tree_to_snapshot(root):
+    """
+    Convert the tree rooted at root into a dictionary of arrays and tables, the root is the DecisionNode 0
+    """
+    decision_nodes = reachable_nodes(root)
+    decision_index = {id(node): i for i, node in enumerate(decision_nodes)}
+
+    states, state_index, decision_states = [], {}, []
+    for node in decision_nodes:
+        key = state_key(node.state, node.fingerprint)
+        if key not in state_index:
+            state_index[key] = len(states)
+            states.append(node.state)
+        decision_states.append(state_index[key])
+
+    chance_nodes, chance_parent, edges = [], [], []
+    for i, node in enumerate(decision_nodes):
+        for chance_node in node.children:
+            for child in chance_node.children:
+                edges.append((len(chance_nodes), decision_index[id(child)]))
+            chance_nodes.append(chance_node)
+            chance_parent.append(i)
+
+    # first parent of each DecisionNode, the other parents only appear in the edge list
+    decision_parent = np.full(len(decision_nodes), -1, dtype=np.int64)
+    chance_index = {id(node): i for i, node in enumerate(chance_nodes)}
+    for i, node in enumerate(decision_nodes):
+        if node is not root and id(node.parent) in chance_index:
+            decision_parent[i] = chance_index[id(node.parent)]
+
+    return {
+        'decision': {name: np.array([getattr(node, name) for node in decision_nodes], dtype=dtype)
+                     for name, dtype in DECISION_ARRAYS.items()},
+        'chance': {name: np.array([getattr(node, name) for node in chance_nodes], dtype=dtype)
+                   for name, dtype in CHANCE_ARRAYS.items()},
+        'decision_parent': decision_parent,
+        'decision_state': np.array(decision_states, dtype=np.int64),
+        'chance_parent': np.array(chance_parent, dtype=np.int64),
+        'edges': np.array(edges, dtype=np.int64).reshape(-1, 2),
+        'states': states,
+        'ids': [node.id for node in decision_nodes],
+        'fingerprints': [node.fingerprint for node in decision_nodes],
+        'possible_actions': [node.possible_actions for node in decision_nodes],
+        'action_scores': [node.action_scores for node in decision_nodes],
+        'info': [node.info for node in decision_nodes],
+        'actions': [node.action for node in chance_nodes],
+    }
+
+
+def snapshot_to_tree(snapshot):
+    """
+    Rebuild the nodes of a snapshot, without calling any policy
+
+    Returns:
+        the root DecisionNode
+    """
+    decision, chance = snapshot['decision'], snapshot['chance']
+    decision_nodes = []
+    for i in range(len(snapshot['decision_state'])):
+        node = DecisionNode.__new__(DecisionNode)
+        node.__dict__.update({name: decision[name][i].item() for name in DECISION_ARRAYS})
+        node.id = snapshot['ids'][i]
+        node.parent = None
+        node.state = snapshot['states'][snapshot['decision_state'][i]]
+        node.fingerprint = snapshot['fingerprints'][i]
+        node.possible_actions = snapshot['possible_actions'][i]
+        node.action_scores = snapshot['action_scores'][i]
+        node.info = snapshot['info'][i]
+        node.children = []
+        decision_nodes.append(node)
+
+    chance_nodes = []
+    for j, parent in enumerate(snapshot['chance_parent']):
+        node = ChanceNode.__new__(ChanceNode)
+        node.__dict__.update({name: chance[name][j].item() for name in CHANCE_ARRAYS})
+        node.parent = decision_nodes[parent]
+        node.action = snapshot['actions'][j]
+        node.children = []
+        # prefetched transitions are not saved
+        node.prefetched = None
+        decision_nodes[parent].children.append(node)
+        chance_nodes.append(node)
+
+    for j, i in snapshot['edges']:
+        chance_nodes[j].children.append(decision_nodes[i])
+    for i, j in enumerate(snapshot['decision_parent']):
+        if j >= 0:
+            decision_nodes[i].parent = chance_nodes[j]
+    return decision_nodes[0]
+
+
+def save_tree(root, path, compress=True):
+    """
+    Write a binary snapshot of the tree rooted at root to path
+    """
+    data = pickle.dumps(tree_to_snapshot(root), protocol=pickle.HIGHEST_PROTOCOL)
+    if compress:
+        data = zlib.compress(data)
+    with open(path, 'wb') as f:
+        f.write(MAGIC + (b'z' if compress else b'-') + data)
+
+
+def load_tree(path):
+    """
+    Load a tree written by save_tree
+
+    Returns:
+        the root DecisionNode
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise Exception(f"{path} is not a tree snapshot")
+    flag, data = data[len(MAGIC):len(MAGIC) + 1], data[len(MAGIC) + 1:]
+    if flag == b'z':
+        data = zlib.decompress(data)
+    return snapshot_to_tree(pickle.loads(data))
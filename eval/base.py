@@ -4,7 +4,8 @@ import copy
 import re
 
 from tqdm import tqdm
-from dyna_gym.envs.utils import simulate_conversation, update_state, get_user_resp, get_llm_based_assessment
+from dyna_gym.envs.utils import simulate_conversation, update_state, get_user_resp, get_llm_based_assessment, \
+    cached_step
 from dataset.data_utils import save_generated_conversations, construct_new_experience, save_new_experience
 from collections import defaultdict
 
@@ -25,6 +26,10 @@ class BaseOnlineEval(object):
         self.k = k
         self.dataset = dataset
         self.sr_turns = defaultdict(int)
+        # optional dyna_gym.utils.cache.TransitionCache memoizing the user responses
+        self.transition_cache = None
+        # optional dyna_gym.utils.cache.TransitionCache memoizing the generated knowledge by input sequence
+        self.knowledge_cache = None
 
         # initialize the value for sr@k
         # the inital values are zeros.
@@ -46,7 +51,8 @@ class BaseOnlineEval(object):
         @param system_resp: the generated system response
         @return: the generated user response
         """
-        return get_user_resp(copy.deepcopy(state), system_resp, dataset=self.dataset)
+        return cached_step(self.transition_cache, 'user', state, [system_resp, self.dataset],
+                           lambda: get_user_resp(copy.deepcopy(state), system_resp, dataset=self.dataset))
 
     def init_state(self, target_item, system_initial_resp="Hello ! How do I help you ?"):
         """
@@ -82,7 +88,8 @@ class BaseOnlineEval(object):
             "pre_goals": [],
             "pre_topics": []
         }
-        user_initial_response = get_user_resp(state, sys_response=system_initial_resp, dataset=self.dataset)
+        # cached, so that the initial states can be rebuilt without the user simulator, e.g. to precompute knowledge
+        user_initial_response = self.get_user_resp(state, system_initial_resp)
         # state['dialogue_context'].append(
         #     {'role': 'system', 'content': system_initial_resp, 'act': (goal, topic)})
         state['dialogue_context'].append({'role': 'user', 'content': user_initial_response})
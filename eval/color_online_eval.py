@@ -117,7 +117,8 @@ class ColorBartOnlineEval(BaseOnlineEval):
                                                 max_gen_length=self.max_gen_length,
                                                 pad_to_multiple_of=self.pad_to_multiple_of,
                                                 padding=self.padding,
-                                                device=self.device)
+                                                device=self.device,
+                                                knowledge_cache=self.knowledge_cache)
 
         # assign the knowledge to target topic
         # just for convenience
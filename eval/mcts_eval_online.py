@@ -1,9 +1,9 @@
 import os
 import pickle
-import copy
 
+from dyna_gym.envs.dialogue_state import DialogueState
 from dyna_gym.envs.utils import update_state, predict_action, generate_knowledge_with_plm, \
-    generate_sys_response_with_plm, get_user_resp
+    generate_sys_response_with_plm, get_user_resp, cached_step
 from eval.base import BaseOnlineEval
 from dyna_gym.pipelines.uct_for_dialogue_planning import uct_for_dialogue_planning_pipeline
 
@@ -16,7 +16,8 @@ class MCTSCRSOnlineEval(BaseOnlineEval):
                  policy_model, policy_tokenizer, memory, horizon, reward_func, uct_args, goal2id, device=None,
                  max_sequence_length=512, offline_policy=False, pad_to_multiple_of=True, padding='max_length',
                  max_gen_length=50, model_generation_args=None, should_plot_tree=True, use_rtcp_policy=False,
-                 use_llama2=False, dataset='durecdial', topic2id=None
+                 use_llama2=False, dataset='durecdial', topic2id=None, num_workers=1, transition_cache=None,
+                 knowledge_cache=None
                  ):
         """
         constructor for class MCTSCRSOnlineEval
@@ -38,6 +39,11 @@ class MCTSCRSOnlineEval(BaseOnlineEval):
         @param max_gen_length:
         @param model_generation_args:
         @param should_plot_tree:
+        @param num_workers: the number of processes running independent searches from the same root.
+        @param transition_cache: an optional dyna_gym.utils.cache.TransitionCache memoizing the knowledge, the system
+        responses and the user responses, shared by the search and the evaluation.
+        @param knowledge_cache: an optional dyna_gym.utils.cache.TransitionCache memoizing the generated knowledge by
+        input sequence, shared by the search and the evaluation.
         """
 
         super().__init__(target_set, terminal_act, horizon, use_llm_score, epsilon, n, use_demonstration, k, dataset)
@@ -62,8 +68,11 @@ class MCTSCRSOnlineEval(BaseOnlineEval):
         self.should_plot_tree = should_plot_tree
         self.use_rtcp_policy = use_rtcp_policy
         self.topic2id = topic2id
+        self.num_workers = num_workers
         self.use_llama2 = use_llama2
         self.global_reward_his = []
+        self.transition_cache = transition_cache
+        self.knowledge_cache = knowledge_cache
 
         self.mcts_agent = self.init_agent()
 
@@ -88,27 +97,28 @@ class MCTSCRSOnlineEval(BaseOnlineEval):
             device=self.device,
             max_sequence_length=self.max_sequence_length,
             max_gen_length=self.max_gen_length,
+            padding=self.padding,
             model_generation_args=self.model_generation_args,
             should_plot_tree=True,  # plot the tree after generation,
             use_rtcp_policy=self.use_rtcp_policy,
-            topic2id=self.topic2id
+            topic2id=self.topic2id,
+            num_workers=self.num_workers,
+            transition_cache=self.transition_cache,
+            knowledge_cache=self.knowledge_cache,
+            dataset=self.dataset
         )
 
         return mcts_agent
 
+    def close(self):
+        """
+        method that stops the worker processes of the MCTS agent (root parallelisation) and frees their models
+        """
+        self.mcts_agent.agent.close()
+
     def update(self, state, system_response, system_action, user_response):
-        # update state
-        new_state = copy.deepcopy(state)
-        new_state['dialogue_context'].append(
-            {"role": "assistant", "content": system_response}
-        )
-        new_state['dialogue_context'].append(
-            {"role": "user", "content": user_response}
-        )
-        goal, topic = system_action
-        new_state['pre_goals'].append(goal)
-        new_state['pre_topics'].append(topic)
-        return new_state
+        # update state, the persistent state shares the task background and the demonstration with the previous one
+        return DialogueState.from_dict(state).append_turn(system_action, system_response, user_response)
 
     def check_terminated_condition(self, system_action):
         """
@@ -143,7 +153,9 @@ class MCTSCRSOnlineEval(BaseOnlineEval):
         if not self.use_llama2:
             # text generation with BART
             # generate relevant knowledge
-            knowledge = generate_knowledge_with_plm(generation_model=self.know_generation_model,
+            knowledge = cached_step(
+                self.transition_cache, 'knowledge', state, [action],
+                lambda: generate_knowledge_with_plm(generation_model=self.know_generation_model,
                                                     tokenizer=self.know_generation_tokenizer,
                                                     action=action,
                                                     state=state,
@@ -151,23 +163,26 @@ class MCTSCRSOnlineEval(BaseOnlineEval):
                                                     max_gen_length=self.max_gen_length,
                                                     pad_to_multiple_of=self.pad_to_multiple_of,
                                                     padding=self.padding,
-                                                    device=self.device)
+                                                    device=self.device,
+                                                    knowledge_cache=self.knowledge_cache))
 
             # generate the system response using chatgpt
             # later it will be replaced by the generated response by BART.
             # system_resp = get_user_resp(start_state, action)
-            system_resp = generate_sys_response_with_plm(generation_model=self.generation_model,
-                                                         tokenizer=self.generation_tokenizer,
-                                                         action=action,
-                                                         knowledge=knowledge,
-                                                         state=state,
-                                                         max_sequence_length=self.max_sequence_length,
-                                                         max_gen_length=self.max_gen_length,
-                                                         pad_to_multiple_of=self.pad_to_multiple_of,
-                                                         padding=self.padding,
-                                                         device=self.device,
-                                                         dataset=self.dataset
-                                                         )
+            system_resp = cached_step(
+                self.transition_cache, 'response', state, [action, self.dataset],
+                lambda: generate_sys_response_with_plm(generation_model=self.generation_model,
+                                                       tokenizer=self.generation_tokenizer,
+                                                       action=action,
+                                                       knowledge=knowledge,
+                                                       state=state,
+                                                       max_sequence_length=self.max_sequence_length,
+                                                       max_gen_length=self.max_gen_length,
+                                                       pad_to_multiple_of=self.pad_to_multiple_of,
+                                                       padding=self.padding,
+                                                       device=self.device,
+                                                       dataset=self.dataset
+                                                       ))
 
         else:
             # generating response with llama2
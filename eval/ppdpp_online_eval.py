@@ -92,7 +92,8 @@ class PPDPPBartOnlineEval(BaseOnlineEval):
                                                 max_gen_length=self.max_gen_length,
                                                 pad_to_multiple_of=self.pad_to_multiple_of,
                                                 padding=self.padding,
-                                                device=self.device)
+                                                device=self.device,
+                                                knowledge_cache=self.knowledge_cache)
 
         # generate the system response using chatgpt
         # later it will be replaced by the generated response by BART.
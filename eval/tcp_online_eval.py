@@ -115,7 +115,8 @@ class TCPBartOnlineEval(BaseOnlineEval):
                                                 max_gen_length=self.max_gen_length,
                                                 pad_to_multiple_of=self.pad_to_multiple_of,
                                                 padding=self.padding,
-                                                device=self.device)
+                                                device=self.device,
+                                                knowledge_cache=self.knowledge_cache)
         
         state['knowledge'] = [state['task_background']['target_topic'], "", ""]
 
@@ -276,7 +276,8 @@ class UnimindBartOnlineEval(BaseOnlineEval):
                                                 max_gen_length=self.max_gen_length,
                                                 pad_to_multiple_of=self.pad_to_multiple_of,
                                                 padding=self.padding,
-                                                device=self.device)
+                                                device=self.device,
+                                                knowledge_cache=self.knowledge_cache)
 
         system_resp = generate_sys_response_with_plm(generation_model=self.generation_model,
                                                      tokenizer=self.generation_tokenizer,
@@ -7,14 +7,17 @@ import torch
 from transformers import AutoModel, AutoTokenizer, BartForConditionalGeneration
 from sentence_transformers import SentenceTransformer
 
-from dyna_gym.models.policy import PolicyModel, load_model
+from dyna_gym.models.policy import PolicyModel, PolicyInferenceRunner, load_model
 from baselines.rtcp.policy import PolicyModel as RTCPPolicyModel
 from dataset.durecdial import DuRecdial
 from dataset.inspired import Inspired
 from config.config import special_tokens_dict, DURECDIALGOALS
 from dataset.data_utils import create_target_set, load_binary_file, save_binary_file
 
-from dyna_gym.envs.utils import reward_func, random_seed
+from dyna_gym.envs.utils import reward_func, random_seed, cache_namespaces
+from dyna_gym.utils.profiling import SearchProfiler
+from dyna_gym.agents.budget import RolloutScheduler
+from dyna_gym.utils.cache import TransitionCache
 from eval.mcts_eval_online import MCTSCRSOnlineEval
 from retrieval.utils import construct_mcts_memory, load_memory_from_file, construct_memory_loaded_from_file
 from retrieval.retrieval import Memory
@@ -38,8 +41,55 @@ def parse_args():
     parser.add_argument('--rollouts', type=int, default=20, help="number of rollout in MCT")
     parser.add_argument('--width', type=int, default=3, help="abc")
     parser.add_argument('--gamma', type=float, default=1., help="abc")
+    parser.add_argument('--parallel_rollouts', type=int, default=1,
+                        help="number of rollouts selected concurrently with virtual loss in each round of MCTS")
+    parser.add_argument('--tree_backend', type=str, default='object', choices=['object', 'array'],
+                        help="'array' stores the children statistics of each node in NumPy arrays and scores them with "
+                             "one vectorized expression, which is faster when the nodes have many children")
+    parser.add_argument('--reuse_tree', action='store_true',
+                        help="whether to reuse the subtree of the committed action in the next turn")
+    parser.add_argument('--time_budget', type=float, default=None,
+                        help="wall-clock budget of the search in seconds, the best action so far is used when it runs out")
+    parser.add_argument('--max_transitions', type=int, default=None,
+                        help="maximum number of environment transitions per search")
+    parser.add_argument('--max_llm_calls', type=int, default=None,
+                        help="maximum number of LLM calls (user simulator and assessment) per search")
+    parser.add_argument('--pw_alpha', type=float, default=None,
+                        help="exponent of progressive widening, the number of children of a node grows as visits^alpha")
+    parser.add_argument('--pw_c', type=float, default=1., help="constant of progressive widening")
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help="number of processes running independent searches from the same root")
+    parser.add_argument('--profile_path', type=str, default=None,
+                        help="if given, the per-phase timings of each search are appended to this JSONL file")
+    parser.add_argument('--early_stop', type=str, default=None, choices=['visits', 'lcb'],
+                        help="criterion to end a search once the action at the root is settled")
+    parser.add_argument('--early_stop_z', type=float, default=2.,
+                        help="width of the confidence bounds of the lcb early stop criterion")
+    parser.add_argument('--early_stop_min_visits', type=int, default=5,
+                        help="number of returns an action needs before being compared by the lcb early stop criterion")
 
     parser.add_argument('--alg', type=str, default='uct', help="criterion for the selection step")
+    parser.add_argument('--max_nodes', type=int, default=None,
+                        help="budget of decision nodes of the search tree, the least visited subtrees are pruned beyond it")
+    parser.add_argument('--conversation_rollouts', type=int, default=None,
+                        help="if given, rollout budget of a whole conversation, split across the turns by uncertainty")
+    parser.add_argument('--gumbel_m', type=int, default=4, help="number of root actions sampled by the gumbel alg")
+    parser.add_argument('--transition_cache_size', type=int, default=None,
+                        help="if given, the knowledge, responses and user replies of the transitions are memoized in an LRU of this size")
+    parser.add_argument('--transition_cache_path', type=str, default=None,
+                        help="optional sqlite file persisting the transition cache across runs")
+    parser.add_argument('--knowledge_cache_size', type=int, default=None,
+                        help="if given, the generated knowledge is memoized by input sequence in an LRU of this size")
+    parser.add_argument('--knowledge_cache_path', type=str, default=None,
+                        help="optional sqlite file persisting the knowledge cache, see precompute_knowledge.py")
+    parser.add_argument('--padding', type=str, default='max_length', choices=['max_length', 'bucket'],
+                        help="padding of the model inputs, bucket (opt-in) pads a batch to its longest input rounded up to a multiple of 64")
+    parser.add_argument('--expand_siblings', action='store_true',
+                        help="whether to compute the transitions of all the actions of a node in one batch on its first expansion")
+    parser.add_argument('--policy_dtype', type=str, default=None, choices=['bf16', 'fp16', 'int8'],
+                        help="if given, precision of the policy weights at inference, int8 is for CPU only")
+    parser.add_argument('--compile_policy', action='store_true',
+                        help="whether to compile the forward of the policy model with torch.compile")
     parser.add_argument('--policy_model_path', type=str, help="criterion for the selection step")
     parser.add_argument('--generation_model_path', type=str, help="criterion for the selection step")
     parser.add_argument('--know_generation_model_path', type=str, help="criterion for the selection step")
@@ -103,7 +153,24 @@ if __name__ == '__main__':
         gamma=args.gamma,
         width=args.width,
         alg=args.alg,  # or p_uct
-        k=args.top_k  # num retrieval
+        k=args.top_k,  # num retrieval
+        parallel_rollouts=args.parallel_rollouts,
+        tree_backend=args.tree_backend,
+        reuse_tree=args.reuse_tree,
+        time_budget=args.time_budget,
+        max_transitions=args.max_transitions,
+        max_llm_calls=args.max_llm_calls,
+        pw_alpha=args.pw_alpha,
+        pw_c=args.pw_c,
+        profiler=SearchProfiler(args.profile_path) if args.profile_path is not None else None,
+        early_stop=args.early_stop,
+        early_stop_z=args.early_stop_z,
+        early_stop_min_visits=args.early_stop_min_visits,
+        gumbel_m=args.gumbel_m,
+        max_nodes=args.max_nodes,
+        expand_siblings=args.expand_siblings,
+        scheduler=RolloutScheduler(args.conversation_rollouts, max_turns=args.horizon)
+        if args.conversation_rollouts is not None else None
     )
 
     # will be passed to huggingface model.generate()
@@ -200,6 +267,9 @@ if __name__ == '__main__':
 
     policy_model = load_model(policy_model, os.path.join(policy_model_path, policy_model_name))
     policy_model.to(device)
+    # eval mode and inference mode for every call of the policy during the search, the runner holds its own copy
+    # of the model, rebinding the name frees the original
+    policy_model = PolicyInferenceRunner(policy_model, dtype=args.policy_dtype, compile=args.compile_policy)
 
     # create and load the weights for knowledge generation model
     plm_know_generation_model = args.plm_know_generation_model
@@ -265,6 +335,24 @@ if __name__ == '__main__':
     if args.use_vanilla_mcts:
         memory = None
 
+    # memoization of the knowledge, responses and user replies, shared by the search and the evaluation.
+    # the entries are namespaced by the models and generation settings, so that the sqlite files can be shared by runs
+    namespaces = cache_namespaces(
+        know_generation_model=[plm_know_generation_model, args.know_generation_tokenizer, know_generation_model_path],
+        generation_model=[plm_generation_model, args.generation_tokenizer, generation_model_path],
+        max_sequence_length=args.max_sequence_length,
+        max_gen_length=args.max_gen_length,
+        padding=args.padding
+    )
+    transition_cache = None
+    if args.transition_cache_size is not None or args.transition_cache_path is not None:
+        transition_cache = TransitionCache(max_size=args.transition_cache_size or 100000,
+                                           path=args.transition_cache_path, namespaces=namespaces)
+    knowledge_cache = None
+    if args.knowledge_cache_size is not None or args.knowledge_cache_path is not None:
+        knowledge_cache = TransitionCache(max_size=args.knowledge_cache_size or 100000,
+                                          path=args.knowledge_cache_path, namespaces=namespaces)
+
     terminal_act = "Say goodbye"
     mcts_online_eval = MCTSCRSOnlineEval(
         target_set=target_set,
@@ -289,12 +377,16 @@ if __name__ == '__main__':
         offline_policy=args.offline_policy,
         max_sequence_length=args.max_sequence_length,
         max_gen_length=args.max_gen_length,
+        padding=args.padding,
         model_generation_args=model_generation_args,
         should_plot_tree=True,  # plot the tree after generation,
         use_rtcp_policy=args.use_rtcp_policy,  # if use rtcp as the policy
         use_llama2=args.use_llama2,  # if use llama2 as text generation model
         dataset=args.dataset,  # dataset
-        topic2id=[ori_goal2id, topic2id]  # only work for rtcp policy
+        topic2id=[ori_goal2id, topic2id],  # only work for rtcp policy
+        num_workers=args.num_workers,  # number of root-parallel search processes
+        transition_cache=transition_cache,
+        knowledge_cache=knowledge_cache
     )
 
     model_name = "offline" if args.offline_policy else "mcts"
@@ -329,3 +421,17 @@ if __name__ == '__main__':
     print("Domain specific metrics: ", domain_specific_metrics)
 
     print("State value reward variance: ", np.var(mcts_online_eval.global_reward_his))
+
+    if uct_args['profiler'] is not None:
+        print("Search profile: ", uct_args['profiler'].summary())
+
+    # stop the worker processes of the search, which hold replicas of the models
+    mcts_online_eval.close()
+
+    if transition_cache is not None:
+        print("Transition cache: ", transition_cache.stats())
+        transition_cache.close()
+
+    if knowledge_cache is not None:
+        print("Knowledge cache: ", knowledge_cache.stats())
+        knowledge_cache.close()
@@ -0,0 +1,127 @@
+import argparse
+import copy
+import os
+
+import torch
+from transformers import AutoTokenizer, BartForConditionalGeneration
+
+from dyna_gym.models.policy import load_model
+from dataset.durecdial import DuRecdial
+from dataset.inspired import Inspired
+from config.config import special_tokens_dict
+from dataset.data_utils import create_target_set, load_binary_file, save_binary_file
+
+from dyna_gym.envs.utils import random_seed, construct_initial_state, precompute_knowledge, cache_namespaces
+from dyna_gym.utils.cache import TransitionCache
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Fill a knowledge cache with the knowledge of every action of goal2id in the initial state of "
+                    "every target item. Only the initial states are covered: the states below the root depend on the "
+                    "generated responses and the simulated user replies, so their knowledge is not precomputed and is "
+                    "generated, then cached, during the search of online_evaluation.py with the same "
+                    "--knowledge_cache_path.")
+    parser.add_argument("--seed", type=int, default=42, help="A seed for reproducible training.")
+    # data
+    parser.add_argument("--dataset", type=str, default='durecdial', help="A file containing all data.")
+    parser.add_argument('--num_items', default=10, type=int, help="number of target items if the target set is created")
+    parser.add_argument("--train_data_path", type=str, required=True, help="A file containing all data.")
+    parser.add_argument("--dev_data_path", type=str, required=True, help="A file containing all data.")
+    parser.add_argument("--test_data_path", type=str, required=True, help="A file containing all data.")
+    parser.add_argument('--max_sequence_length', type=int, help="max length of both encoder and decoder input.")
+    parser.add_argument('--max_gen_length', type=int, help="max length of the generated knowledge.")
+    parser.add_argument('--target_set_path', type=str, help="directory of the target set")
+    parser.add_argument('--policy_model_path', type=str, help="directory holding goal2id.pkl")
+    parser.add_argument('--system_initial_resp', type=str, default="Hello ! How do I help you ?",
+                        help="system utterance the simulated user replies to at the start of each conversation")
+    parser.add_argument('--batch_size', type=int, default=16, help="number of actions per generate() call")
+    parser.add_argument('--padding', type=str, default='max_length', choices=['max_length', 'bucket'],
+                        help="padding of the model inputs, see dyna_gym.utils.feature_utils")
+    # caches
+    parser.add_argument('--knowledge_cache_path', type=str, required=True,
+                        help="sqlite file receiving the generated knowledge")
+    parser.add_argument('--transition_cache_path', type=str, default=None,
+                        help="optional sqlite file memoizing the initial user responses, use the file given to "
+                             "online_evaluation.py so that the precomputed initial states are those of the evaluation")
+    # knowledge generation model
+    parser.add_argument('--know_generation_model_path', type=str)
+    parser.add_argument("--plm_know_generation_model", type=str)
+    parser.add_argument("--know_generation_tokenizer", type=str)
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    # parse argments
+    args = parse_args()
+
+    random_seed(args.seed)
+
+    device = torch.device('cuda:0')
+
+    if args.dataset == 'durecdial':
+        dataset = DuRecdial(
+            train_data_path=args.train_data_path,
+            dev_data_path=args.dev_data_path,
+            test_data_path=args.test_data_path
+        )
+    elif args.dataset == 'inspired':
+        dataset = Inspired(
+            train_data_path=args.train_data_path,
+            dev_data_path=args.dev_data_path,
+            test_data_path=args.test_data_path
+        )
+
+    # the (goal, topic) pairs predicted by the policy model
+    goal2id = load_binary_file(os.path.join(args.policy_model_path, "goal2id.pkl"))
+    actions = list(goal2id.keys())
+
+    # create and load the weights for knowledge generation model
+    know_generation_model = BartForConditionalGeneration.from_pretrained(args.plm_know_generation_model)
+    know_generation_tokenizer = AutoTokenizer.from_pretrained(args.know_generation_tokenizer)
+    know_generation_tokenizer.add_special_tokens(special_tokens_dict)
+    know_generation_model.resize_token_embeddings(len(know_generation_tokenizer))
+    know_generation_model = load_model(know_generation_model,
+                                       os.path.join(args.know_generation_model_path, 'know_generation.pth'))
+    know_generation_model.to(device)
+
+    if not os.path.exists(args.target_set_path):
+        os.mkdir(args.target_set_path)
+
+    if os.path.exists(os.path.join(args.target_set_path, "target.pkl")):
+        target_set = load_binary_file(os.path.join(args.target_set_path, "target.pkl"))
+    else:
+        # create the target item set.
+        target_set = create_target_set(dataset.train_convs, dataset.test_instances, num_items=args.num_items)
+        save_binary_file(target_set, os.path.join(args.target_set_path, "target.pkl"))
+
+    # only the initial user responses and the knowledge by input sequence are written here, their namespaces are
+    # those of online_evaluation.py given the same knowledge generation model and padding
+    namespaces = cache_namespaces(
+        know_generation_model=[args.plm_know_generation_model, args.know_generation_tokenizer,
+                               args.know_generation_model_path],
+        padding=args.padding
+    )
+    transition_cache = None
+    if args.transition_cache_path is not None:
+        transition_cache = TransitionCache(path=args.transition_cache_path, namespaces=namespaces)
+    knowledge_cache = TransitionCache(path=args.knowledge_cache_path, namespaces=namespaces)
+
+    # the first system turn of every conversation is planned from its initial state
+    states = [construct_initial_state(copy.deepcopy(target_item), system_initial_resp=args.system_initial_resp,
+                                      dataset=args.dataset, transition_cache=transition_cache)
+              for target_item in target_set]
+
+    with torch.no_grad():
+        n_pairs = precompute_knowledge(know_generation_model, know_generation_tokenizer, states, actions,
+                                       knowledge_cache, args.max_sequence_length, max_gen_length=args.max_gen_length,
+                                       batch_size=args.batch_size, padding=args.padding,
+                                       device=device)
+
+    print("Number of (state, action) pairs: ", n_pairs)
+    print("Knowledge cache: ", knowledge_cache.stats())
+    knowledge_cache.close()
+    if transition_cache is not None:
+        transition_cache.close()
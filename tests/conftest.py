@@ -0,0 +1,66 @@
+import pytest
+
+
+class ToyEnv:
+    """
+    Deterministic environment whose states are the tuples of the actions taken so far, taking the action 2 is rewarded
+    """
+
+    def __init__(self, horizon=4):
+        self.horizon = horizon
+        self.state = ()
+        self.n_transitions = 0
+
+    def reset(self, state):
+        self.state = state
+        return state
+
+    def transition(self, state, action, is_model_dynamic=False):
+        self.n_transitions += 1
+        next_state = state + (action,)
+        return next_state, (1. if action == 2 else 0.), len(next_state) >= self.horizon
+
+    def equality_operator(self, s1, s2):
+        return s1 == s2
+
+
+class ToyPolicy:
+    """
+    Default policy proposing the actions 0 .. n_actions - 1 with decreasing priors
+    """
+
+    def __init__(self, n_actions=3):
+        self.n_actions = n_actions
+
+    def get_top_k_tokens(self, state, top_k=None):
+        weights = [self.n_actions - i for i in range(self.n_actions)]
+        actions = list(range(self.n_actions))[:top_k]
+        return actions, [w / sum(weights) for w in weights][:top_k]
+
+    def get_predicted_sequence(self, state):
+        return []
+
+
+def toy_value(state, memory, k):
+    # a deterministic value of the toy states
+    return (sum((i + 1) * action for i, action in enumerate(state)) % 7) / 7.
+
+
+@pytest.fixture
+def env():
+    return ToyEnv()
+
+
+@pytest.fixture
+def policy():
+    return ToyPolicy()
+
+
+@pytest.fixture
+def memory(monkeypatch):
+    """
+    A memory for the search, the leaves are valued with toy_value instead of a retrieval
+    """
+    mcts = pytest.importorskip('dyna_gym.agents.mcts')
+    monkeypatch.setattr(mcts, 'compute_reward_based_on_memory', toy_value)
+    return object()
@@ -0,0 +1,127 @@
+import math
+import pickle
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('gym')
+
+from dyna_gym.agents import budget
+from dyna_gym.agents.budget import RolloutScheduler, SearchBudget
+
+
+class CountingEnv:
+    def __init__(self, n_transitions=0, n_llm_calls=0):
+        self.n_transitions = n_transitions
+        self.n_llm_calls = n_llm_calls
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.
+
+    def time(self):
+        return self.now
+
+
+def test_unbounded_budget():
+    assert not SearchBudget().is_bounded()
+    assert SearchBudget(max_llm_calls=3).is_bounded()
+
+
+def test_budget_counts_the_calls_made_since_the_start():
+    env = CountingEnv(n_transitions=5, n_llm_calls=2)
+    search_budget = SearchBudget(max_transitions=3, max_llm_calls=4).start(env)
+    assert not search_budget()
+
+    env.n_transitions += 2
+    env.n_llm_calls += 3
+    assert (search_budget.transitions(), search_budget.llm_calls()) == (2, 3)
+    assert not search_budget() and search_budget.exhausted_by is None
+
+    env.n_llm_calls += 1
+    assert search_budget() and search_budget.exhausted_by == 'llm_calls'
+
+    # a new search starts from the current counts
+    search_budget.start(env)
+    assert not search_budget() and search_budget.exhausted_by is None
+    env.n_transitions += 3
+    assert search_budget()
+    assert search_budget.summary()['exhausted_by'] == 'transitions'
+    assert search_budget.summary()['transitions'] == 3
+
+
+def test_time_budget(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(budget, 'time', clock)
+    # an environment without counters is only bounded by time
+    search_budget = SearchBudget(time_budget=2., max_transitions=1).start(object())
+    clock.now += 1.5
+    assert not search_budget()
+    clock.now += 0.5
+    assert search_budget() and search_budget.exhausted_by == 'time'
+    assert search_budget.summary()['elapsed'] == 2.
+
+
+def test_budget_is_copied_without_its_environment():
+    search_budget = SearchBudget(max_transitions=3).start(CountingEnv())
+    copy = pickle.loads(pickle.dumps(search_budget))
+    assert copy.env is None and copy.max_transitions == 3
+
+
+def prior_root(priors):
+    # a root without statistics, its uncertainty is the normalised entropy of its priors
+    return SimpleNamespace(action_scores=priors, children=[])
+
+
+def test_uncertainty_of_the_priors():
+    assert RolloutScheduler.uncertainty(prior_root([1.])) == 0.
+    assert RolloutScheduler.uncertainty(prior_root([0.5, 0.5, 0.])) == pytest.approx(1.)
+    peaked = RolloutScheduler.uncertainty(prior_root([0.9, 0.05, 0.05]))
+    assert 0. < peaked < RolloutScheduler.uncertainty(prior_root([0.4, 0.3, 0.3])) < 1.
+
+
+def test_uncertainty_of_a_root_with_statistics():
+    def child(mean):
+        return SimpleNamespace(n_returns=5, mean_return=mean, return_variance=1.)
+
+    close = SimpleNamespace(action_scores=[0.5, 0.5], children=[child(1.), child(1.)])
+    assert RolloutScheduler.uncertainty(close) == pytest.approx(1.)
+    apart = SimpleNamespace(action_scores=[0.5, 0.5], children=[child(3.), child(1.)])
+    assert RolloutScheduler.uncertainty(apart) == pytest.approx((1. + math.exp(-2.)) / 2)
+
+
+def test_scheduler_splits_the_budget_across_the_turns():
+    scheduler = RolloutScheduler(total_rollouts=100, max_turns=4, min_rollouts=2)
+    # a certain turn gets half of its share, an uncertain one one and a half
+    assert scheduler.allocate(prior_root([1.])) == 12
+    assert scheduler.allocate(prior_root([0.5, 0.5])) == 38
+
+    scheduler.record(38)
+    assert (scheduler.turn, scheduler.remaining) == (1, 62)
+    assert scheduler.allocate(prior_root([1.])) == round(62 / 3 * 0.5)
+    scheduler.record(60)
+    assert scheduler.history[-1] == {'turn': 1, 'rollouts': 60, 'remaining': 2}
+
+    # the last turns get the minimum number of rollouts while the budget allows it
+    assert scheduler.allocate(prior_root([1.])) == 2
+    scheduler.record(2)
+    # an exhausted budget allocates no rollouts
+    assert scheduler.allocate(prior_root([0.5, 0.5])) == 0
+    scheduler.record(0)
+    assert scheduler.remaining == 0 and scheduler.turn == 4
+
+
+def test_scheduler_detects_a_new_conversation():
+    scheduler = RolloutScheduler(total_rollouts=10, max_turns=2)
+    scheduler.detect_conversation({'dialogue_context': ['a']})
+    scheduler.record(6)
+    scheduler.detect_conversation({'dialogue_context': ['a', 'b', 'c']})
+    assert scheduler.remaining == 4 and scheduler.turn == 1
+    # a shorter context starts a new conversation with the whole budget
+    scheduler.detect_conversation({'dialogue_context': ['d']})
+    assert scheduler.remaining == 10 and scheduler.turn == 0
+    # states without a dialogue context are ignored
+    scheduler.record(3)
+    scheduler.detect_conversation(('d',))
+    assert scheduler.remaining == 7
@@ -0,0 +1,98 @@
+import pickle
+
+import pytest
+
+pytest.importorskip('gym')
+
+from dyna_gym.utils.cache import MISSING, TransitionCache
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = TransitionCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    # b is the least recently used entry
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['size'] == 2
+
+
+def test_missing_tells_a_miss_apart_from_a_cached_none():
+    cache = TransitionCache()
+    assert cache.get('a', default=MISSING) is MISSING
+    cache.put('a', None)
+    assert cache.get('a', default=MISSING) is None
+
+    calls = []
+    compute = lambda: calls.append(1)
+    assert cache.get_or_compute('b', compute) is None
+    assert cache.get_or_compute('b', compute) is None
+    assert len(calls) == 1
+
+
+def test_entries_are_read_back_from_the_sqlite_file(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = TransitionCache(max_size=1, path=path, commit_every=2)
+    cache.put('a', {'response': 'hello'})
+    cache.put('b', ['x', None])
+    # a is evicted from memory but kept on disk
+    assert 'a' not in cache.entries
+    assert cache.get('a') == {'response': 'hello'}
+    cache.put('c', 3)
+    cache.close()
+
+    reopened = TransitionCache(path=path)
+    assert reopened.get('a') == {'response': 'hello'} and reopened.get('b') == ['x', None]
+    assert reopened.get('c') == 3
+    reopened.close()
+
+
+def test_pending_writes_are_committed_by_flush(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = TransitionCache(path=path, commit_every=10)
+    cache.put('a', 1)
+    other = TransitionCache(path=path)
+    assert other.get('a') is None
+    cache.flush()
+    assert other.get('a') == 1
+    cache.close()
+    other.close()
+
+
+def test_pickled_cache_reads_the_committed_entries(tmp_path):
+    cache = TransitionCache(path=str(tmp_path / 'cache.sqlite'), commit_every=10)
+    cache.put('a', 1)
+    copy = pickle.loads(pickle.dumps(cache))
+    assert copy.connection is None and copy.get('a') == 1
+    copy.entries.clear()
+    assert copy.get('a') == 1
+    copy.close()
+    cache.close()
+
+
+def test_namespaces_separate_the_kinds_of_steps(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = TransitionCache(path=path, namespaces={'response': ['model-a', 256]})
+    cache.put('key', 'from model a', kind='response')
+    assert cache.get('key', kind='response') == 'from model a'
+    # the kinds without a namespace use the key as is
+    assert cache.get('key', kind='user') is None
+    cache.close()
+
+    other_model = TransitionCache(path=path, namespaces={'response': ['model-b', 256]})
+    assert other_model.get('key', kind='response') is None
+    same_model = TransitionCache(path=path, namespaces={'response': ['model-a', 256]})
+    assert same_model.get('key', kind='response') == 'from model a'
+    other_model.close()
+    same_model.close()
+
+
+def test_stats_count_the_hits_and_misses_of_each_kind():
+    cache = TransitionCache()
+    cache.get_or_compute('a', lambda: 1, kind='user')
+    cache.get_or_compute('a', lambda: 1, kind='user')
+    cache.get('b', kind='response')
+    stats = cache.stats()
+    assert stats['user'] == {'hits': 1, 'misses': 1} and stats['response'] == {'hits': 0, 'misses': 1}
+    assert stats['total'] == {'hits': 1, 'misses': 2, 'hit_rate': pytest.approx(1 / 3)}
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+transformers = pytest.importorskip('transformers')
+
+from config.config import special_tokens_dict, CONTEXT_TOKEN, PATH_TOKEN, TARGET
+from dataset.data_utils import tokenize_with_dialogue, utterance_token_cache
+
+WORDS = ['hello', 'hi', 'how', 'are', 'you', 'i', 'like', 'movies', 'the', 'matrix', 'is', 'a', 'great', 'film', '!',
+         '?', ',', '.', ':', 'recommend', 'goodbye', 'what', 'about', 'music']
+
+PREFIX = f"{PATH_TOKEN}: [GOAL]Greetings[TOPIC]Greetings[SEP] {TARGET}: the matrix {CONTEXT_TOKEN}: "
+
+CONTEXTS = [
+    [],
+    [{'role': 'user', 'content': 'hello , how are you ?'}],
+    [{'role': 'assistant', 'content': 'hi ! what movies do you like ?'}],
+    [{'role': 'user', 'content': 'Hello!'}, {'role': 'assistant', 'content': ' i recommend the matrix .'},
+     {'role': 'user', 'content': 'great film , goodbye '}, {'role': 'assistant', 'content': ''},
+     {'role': 'user', 'content': 'what about music'}],
+]
+
+
+def bert_tokenizer(cls, tmp_path):
+    vocab_file = tmp_path / 'vocab.txt'
+    vocab_file.write_text('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + WORDS + ['##s', '##ing']))
+    return cls(vocab_file=str(vocab_file))
+
+
+def byte_symbols():
+    # the printable characters standing for the 256 bytes in byte-level BPE vocabularies (GPT-2, BART)
+    printable = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + \
+        list(range(ord('®'), ord('ÿ') + 1))
+    symbols, n = [], 0
+    for b in range(256):
+        if b in printable:
+            symbols.append(chr(b))
+        else:
+            symbols.append(chr(256 + n))
+            n += 1
+    return symbols
+
+
+def bart_tokenizer(cls, tmp_path):
+    # byte-level BPE without merges, every byte of the input is a token
+    vocab = {token: i for i, token in enumerate(['<s>', '<pad>', '</s>', '<unk>'] + byte_symbols())}
+    vocab['<mask>'] = len(vocab)
+    vocab_file, merges_file = tmp_path / 'vocab.json', tmp_path / 'merges.txt'
+    vocab_file.write_text(json.dumps(vocab))
+    merges_file.write_text('#version: 0.2\n')
+    return cls(vocab_file=str(vocab_file), merges_file=str(merges_file))
+
+
+TOKENIZERS = [(bert_tokenizer, name) for name in ['BertTokenizer', 'BertTokenizerFast', 'BertTokenizerLegacy']] + \
+             [(bart_tokenizer, name) for name in ['BartTokenizer', 'BartTokenizerFast']]
+
+
+@pytest.mark.parametrize('build, name', TOKENIZERS)
+def test_tokenize_with_dialogue_matches_full_tokenization(build, name, tmp_path):
+    # slow and fast tokenizers, whichever classes the installed transformers version provides
+    if not hasattr(transformers, name):
+        pytest.skip(f'{name} is not provided by transformers {transformers.__version__}')
+    tokenizer = build(getattr(transformers, name), tmp_path)
+    tokenizer.add_special_tokens(special_tokens_dict)
+    utterance_token_cache.clear()
+    roles = {'user': '[USER]', 'assistant': '[SYSTEM]'}
+    for _ in range(2):
+        # the second pass reads the utterances from the cache
+        for context in CONTEXTS:
+            dialogue_str = ''.join(roles[utt['role']] + utt['content'] for utt in context)
+            expected = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(PREFIX + dialogue_str))
+            assert tokenize_with_dialogue(tokenizer, PREFIX, context) == expected
+    assert utterance_token_cache.supports(tokenizer)
+    # the prefixes are not cached
+    assert all(key[1] != PREFIX for key in utterance_token_cache.entries)
@@ -0,0 +1,78 @@
+import copy
+import pickle
+
+import pytest
+
+pytest.importorskip('torch')
+
+from dyna_gym.envs.dialogue_state import DialogueState, with_fields
+
+
+def new_state():
+    return DialogueState({
+        'task_background': {'target_topic': 'music'},
+        'demonstration': {'dialogue': ['a long demonstration']},
+        'dialogue_context': [{'role': 'user', 'content': 'hi'}],
+        'pre_goals': ['greeting'],
+        'pre_topics': ['none'],
+    })
+
+
+def test_state_is_immutable():
+    state = new_state()
+    assert isinstance(state['dialogue_context'], tuple)
+    with pytest.raises(Exception, match='immutable'):
+        state['pre_goals'] = ()
+    for method, args in [('pop', ('pre_goals',)), ('update', ({},)), ('setdefault', ('a', 1)), ('clear', ())]:
+        with pytest.raises(Exception, match='immutable'):
+            getattr(state, method)(*args)
+    with pytest.raises(Exception, match='immutable'):
+        del state['pre_goals']
+
+
+def test_new_states_share_the_other_entries():
+    state = new_state()
+    next_state = state.append_turn(('recommend', 'jazz'), 'how about jazz?', 'sure')
+    assert next_state['pre_goals'] == ('greeting', 'recommend') and next_state['pre_topics'] == ('none', 'jazz')
+    assert next_state['dialogue_context'][-2:] == ({'role': 'assistant', 'content': 'how about jazz?'},
+                                                    {'role': 'user', 'content': 'sure'})
+    assert next_state['demonstration'] is state['demonstration']
+    assert next_state['dialogue_context'][0] is state['dialogue_context'][0]
+    # the previous state is unchanged
+    assert len(state['dialogue_context']) == 1 and state['pre_goals'] == ('greeting',)
+
+    goal_only = state.append_turn('chit-chat', 'hello', 'hey')
+    assert goal_only['pre_goals'] == ('greeting', 'chit-chat') and goal_only['pre_topics'] == ('none',)
+
+
+def test_copies_return_the_state():
+    state = new_state()
+    assert copy.copy(state) is state and copy.deepcopy(state) is state
+    assert copy.deepcopy({'state': state})['state'] is state
+
+
+def test_equality_and_hash():
+    state = new_state()
+    plain = state.to_dict()
+    assert isinstance(plain['dialogue_context'], list)
+    assert state == plain and not state != plain
+    assert DialogueState.from_dict(plain) == state and DialogueState.from_dict(state) is state
+    assert hash(DialogueState(plain)) == hash(state)
+    assert len({state, DialogueState(plain), state.set(pre_topics=('other',))}) == 2
+    assert state != state.set(task_background={'target_topic': 'movies'})
+
+
+def test_pickling():
+    state = new_state()
+    loaded = pickle.loads(pickle.dumps(state))
+    assert isinstance(loaded, DialogueState) and loaded == state and hash(loaded) == hash(state)
+
+
+def test_with_fields():
+    state = new_state()
+    updated = with_fields(state, pre_goals=['greeting', 'ask'])
+    assert updated is not state and updated['pre_goals'] == ('greeting', 'ask')
+    assert state['pre_goals'] == ('greeting',)
+
+    plain = state.to_dict()
+    assert with_fields(plain, pre_goals=['ask']) is plain and plain['pre_goals'] == ['ask']
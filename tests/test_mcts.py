@@ -0,0 +1,198 @@
+import random
+import statistics
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('torch')
+
+from dyna_gym.agents import mcts
+
+
+def new_root(n_actions=3):
+    # without a default policy, the children are created at once with uniform priors
+    return mcts.DecisionNode(None, (), possible_actions=list(range(n_actions)), default_policy=None)
+
+
+def sampled_returns(seed, n):
+    rng = random.Random(seed)
+    return [rng.uniform(-1., 2.) for _ in range(n)]
+
+
+def test_running_statistics_match_the_returns():
+    node = new_root().children[0]
+    returns = sampled_returns(0, 20)
+    for value in returns:
+        node.add_return(value)
+
+    # the statistics start with a single 0 return
+    all_returns = [0.] + returns
+    assert node.n_returns == len(all_returns)
+    assert node.sum_returns == pytest.approx(sum(all_returns))
+    assert node.max_return == max(all_returns)
+    assert node.last_return == returns[-1]
+    assert node.mean_return == pytest.approx(statistics.mean(all_returns))
+    assert node.return_variance == pytest.approx(statistics.variance(all_returns))
+    assert mcts.chance_node_value(node, mode='sample') == pytest.approx(statistics.mean(all_returns))
+
+
+def test_return_variance_of_a_node_without_returns():
+    node = new_root().children[0]
+    assert node.n_returns == 1
+    assert node.return_variance == 0.
+
+
+def test_merge_returns_matches_sequential_updates():
+    returns, other_returns = sampled_returns(1, 7), sampled_returns(2, 11)
+    merged, sequential = new_root().children[0], new_root().children[0]
+    for value in returns:
+        merged.add_return(value)
+    for value in returns + other_returns:
+        sequential.add_return(value)
+
+    mean = statistics.mean(other_returns)
+    m2 = sum((value - mean) ** 2 for value in other_returns)
+    merged.merge_returns(len(other_returns), sum(other_returns), max(other_returns), other_returns[-1], m2)
+
+    assert merged.n_returns == sequential.n_returns
+    assert merged.sum_returns == pytest.approx(sequential.sum_returns)
+    assert merged.max_return == sequential.max_return
+    assert merged.last_return == sequential.last_return
+    assert merged.mean_return == pytest.approx(sequential.mean_return)
+    assert merged.return_variance == pytest.approx(sequential.return_variance)
+
+
+class BatchPolicy:
+    """
+    Default policy recording the batches of states it scores
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def get_top_k_tokens_batch(self, states, top_k=3):
+        self.batches.append(list(states))
+        return [([0, 1, 2][:top_k], [0.5, 0.3, 0.2][:top_k]) for _ in states]
+
+
+def test_priors_are_computed_lazily_in_one_batch():
+    policy = BatchPolicy()
+    agent = SimpleNamespace(action_space=[], default_policy=policy, width=2, pw_alpha=None)
+    a = mcts.new_decision_node(agent, None, ('a',), False)
+    b = mcts.new_decision_node(agent, None, ('b',), False)
+    assert not a.has_priors and a.children == [] and policy.batches == []
+
+    mcts.evaluate_priors(agent, [a, b, a])
+    assert policy.batches == [[('a',), ('b',)]]
+    assert [child.action for child in a.children] == [0, 1, 2]
+    assert [child.prob for child in b.children] == [0.5, 0.3, 0.2]
+
+    # the nodes with priors are not scored again
+    mcts.evaluate_priors(agent, [a, b])
+    assert len(policy.batches) == 1
+
+
+def test_priors_under_progressive_widening_are_limited_to_the_width():
+    agent = SimpleNamespace(action_space=[], default_policy=BatchPolicy(), width=2, pw_alpha=0.5)
+    node = mcts.new_decision_node(agent, None, (), False)
+    mcts.evaluate_priors(agent, [node])
+    assert node.possible_actions == [0, 1]
+    # the children are added by widen
+    assert node.children == []
+    node.widen(1)
+    assert [child.action for child in node.children] == [0]
+
+
+def root_with_returns(returns_by_child, n_actions=None):
+    root = new_root(n_actions or len(returns_by_child))
+    root.children.sort(key=lambda child: child.action)
+    for child, returns in zip(root.children, returns_by_child):
+        for value in returns:
+            child.add_return(value)
+    return root
+
+
+def test_visits_criterion_compares_the_lead_with_the_remaining_rollouts():
+    root = root_with_returns([[0.1] * 8, [0.9] * 3, []])
+    # the most visited child leads by 5 visits
+    assert mcts.root_is_decided(root, 4, criterion='visits')
+    assert not mcts.root_is_decided(root, 5, criterion='visits')
+    # the certified child is the most visited one, not the one of highest value
+    assert mcts.decided_child(root, criterion='visits') is root.children[0]
+
+
+def test_visits_criterion_counts_the_actions_not_added_yet():
+    root = new_root(3)
+    root.children = root.children[:1]
+    for _ in range(3):
+        root.children[0].add_return(1.)
+    assert mcts.root_is_decided(root, 2, criterion='visits')
+    assert not mcts.root_is_decided(root, 3, criterion='visits')
+
+
+def test_lcb_criterion_separates_the_confidence_bounds():
+    separated = root_with_returns([[1., 0.9, 1.1, 1., 0.95, 1.05], [0., 0.1, -0.1, 0., 0.05, -0.05]])
+    assert mcts.root_is_decided(separated, 100, criterion='lcb', z=2., min_visits=5)
+    assert mcts.decided_child(separated, criterion='lcb') is separated.children[0]
+
+    overlapping = root_with_returns([[1., 0., 1., 0., 1., 0.], [0., 1., 0., 1., 0., 0.]])
+    assert not mcts.root_is_decided(overlapping, 100, criterion='lcb', z=2., min_visits=5)
+
+
+def test_lcb_criterion_needs_two_children_with_min_visits():
+    # under progressive widening, the root has no children before its first widening
+    empty = mcts.DecisionNode(None, (), possible_actions=[0, 1], default_policy=None, progressive=True)
+    assert empty.children == []
+    assert not mcts.root_is_decided(empty, 10, criterion='lcb')
+    assert not mcts.root_is_decided(root_with_returns([[1.] * 6, [0.] * 4]), 10, criterion='lcb', min_visits=5)
+    # the child of highest mean has too few returns to be compared
+    assert not mcts.root_is_decided(root_with_returns([[5.] * 2, [1.] * 6, [0.] * 6]), 10, criterion='lcb',
+                                    min_visits=5)
+
+
+def test_a_root_with_a_single_action_is_decided():
+    assert mcts.root_is_decided(new_root(1), 10, criterion='visits')
+    assert mcts.root_is_decided(new_root(1), 10, criterion='lcb')
+
+
+def test_node_pool_reinitialises_released_nodes():
+    pool = mcts.NodePool(max_size=10)
+    agent = SimpleNamespace(action_space=[], default_policy=BatchPolicy(), width=3, pw_alpha=None, node_pool=pool)
+    node = mcts.new_decision_node(agent, None, ('a',), False)
+    mcts.evaluate_priors(agent, [node])
+    chance_nodes = list(node.children)
+    node.children[0].add_return(1.)
+
+    pool.release([node])
+    assert node.state is None and node.children == [] and all(c.parent is None for c in chance_nodes)
+
+    reused = mcts.new_decision_node(agent, None, ('b',), False)
+    assert reused is node and reused.state == ('b',) and not reused.has_priors and reused.visits == 1
+    mcts.evaluate_priors(agent, [reused])
+    assert {id(child) for child in reused.children} == {id(child) for child in chance_nodes}
+    assert all(child.parent is reused and child.n_returns == 1 for child in reused.children)
+
+
+def test_prune_tree_cuts_the_least_visited_subtrees():
+    agent = SimpleNamespace(action_space=[], default_policy=BatchPolicy(), width=3, pw_alpha=None, n_nodes=0,
+                            node_pool=mcts.NodePool())
+    root = mcts.new_decision_node(agent, None, (), False)
+    mcts.evaluate_priors(agent, [root])
+    # a tree of depth 2, the children of the first action are visited the most
+    for chance_node in root.children:
+        for action in range(3):
+            child = mcts.new_decision_node(agent, chance_node, (chance_node.action, action), False)
+            child.visits = 10 - 3 * chance_node.action + action
+            chance_node.children.append(child)
+        chance_node.add_return(1.)
+    stats = [(child.n_returns, child.sum_returns) for child in root.children]
+
+    n_removed = mcts.prune_tree(agent, root, 5)
+    kept = mcts.reachable_nodes(root)
+    assert n_removed == 10 - 5 and len(kept) == 5 == agent.n_nodes
+    # the root and the statistics of its children are kept
+    assert kept[0] is root and [(child.n_returns, child.sum_returns) for child in root.children] == stats
+    assert sorted(node.visits for node in kept if node is not root) == [9, 10, 11, 12]
+    # the cut nodes are released for the next nodes of the search
+    assert len(agent.node_pool.decision_nodes) == 5
+    assert all(node.state is None for node in agent.node_pool.decision_nodes)
@@ -0,0 +1,51 @@
+import random
+import statistics
+
+import pytest
+
+pytest.importorskip('torch')
+
+from dyna_gym.agents import mcts
+from dyna_gym.agents.root_parallel import merge_root, split_rollouts
+
+
+def new_root(n_actions):
+    return mcts.DecisionNode(None, (), possible_actions=list(range(n_actions)), default_policy=None)
+
+
+def worker_result(returns_by_action):
+    """
+    Root statistics reported by a worker whose root children received the given returns, see worker_search
+    """
+    root = new_root(len(returns_by_action))
+    for child in root.children:
+        for value in returns_by_action[child.action]:
+            child.add_return(value)
+            root.visits += 1
+    return {
+        'children': [(c.action, c.prob, c.n_returns, c.sum_returns, c.max_return, c.last_return, c.m2_returns)
+                     for c in root.children],
+        'visits': root.visits,
+    }
+
+
+def test_merge_root_pools_the_returns_of_the_workers():
+    rng = random.Random(0)
+    workers = [{action: [rng.uniform(0., 1.) for _ in range(rng.randint(0, 6))] for action in range(3)}
+               for _ in range(4)]
+    root = merge_root(new_root(3), [worker_result(returns) for returns in workers])
+
+    assert root.visits == 1 + sum(len(returns) for worker in workers for returns in worker.values())
+    for child in root.children:
+        # the initial 0 return of each worker is counted once
+        pooled = [0.] + [value for worker in workers for value in worker[child.action]]
+        assert child.n_returns == len(pooled)
+        assert child.sum_returns == pytest.approx(sum(pooled))
+        assert child.max_return == max(pooled)
+        assert child.mean_return == pytest.approx(statistics.mean(pooled))
+        assert child.return_variance == pytest.approx(statistics.variance(pooled))
+
+
+def test_split_rollouts():
+    assert split_rollouts(10, 3) == [4, 3, 3]
+    assert split_rollouts(2, 4) == [1, 1, 0, 0]
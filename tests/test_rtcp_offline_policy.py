@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+pytest.importorskip('torch')
+
+from dyna_gym.default_policy.rtcp_offline_policy import factorised_top_k
+
+
+def brute_force_top_k(goal_probs, goals, topic_probs, topics, n_topics, top_k):
+    pairs = sorted((-goal_prob * topic_prob, goal * n_topics + topic)
+                   for goal_prob, goal in zip(goal_probs, goals) for topic_prob, topic in zip(topic_probs, topics))
+    return [index for _, index in pairs[:top_k]], [-neg_prob for neg_prob, _ in pairs[:top_k]]
+
+
+def top_factors(rng, n, size, values=None):
+    probs = sorted((rng.choice(values) if values else rng.random() for _ in range(size)), reverse=True)
+    return probs, rng.sample(range(n), size)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_factorised_top_k_matches_the_joint_top_k(seed):
+    rng = random.Random(seed)
+    n_goals, n_topics = 8, 6
+    goal_probs, goals = top_factors(rng, n_goals, rng.randint(1, 5))
+    topic_probs, topics = top_factors(rng, n_topics, rng.randint(1, 5))
+    top_k = rng.randint(1, len(goals) * len(topics) + 2)
+
+    indices, probs = factorised_top_k(goal_probs, goals, topic_probs, topics, n_topics, top_k)
+    expected_indices, expected_probs = brute_force_top_k(goal_probs, goals, topic_probs, topics, n_topics, top_k)
+    assert indices == expected_indices
+    assert probs == pytest.approx(expected_probs)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_factorised_top_k_with_equal_probabilities(seed):
+    rng = random.Random(seed)
+    n_goals, n_topics = 8, 6
+    goal_probs, goals = top_factors(rng, n_goals, rng.randint(1, 5), values=[0.1, 0.3])
+    topic_probs, topics = top_factors(rng, n_topics, rng.randint(1, 5), values=[0.2, 0.5])
+    top_k = rng.randint(1, len(goals) * len(topics))
+
+    indices, probs = factorised_top_k(goal_probs, goals, topic_probs, topics, n_topics, top_k)
+    # the order of equal probabilities is unspecified, but the probabilities are those of the joint top-k
+    assert probs == pytest.approx(brute_force_top_k(goal_probs, goals, topic_probs, topics, n_topics, top_k)[1])
+    joint = {goal * n_topics + topic: goal_prob * topic_prob
+             for goal_prob, goal in zip(goal_probs, goals) for topic_prob, topic in zip(topic_probs, topics)}
+    assert len(set(indices)) == top_k
+    assert [joint[index] for index in indices] == pytest.approx(probs)
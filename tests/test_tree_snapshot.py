@@ -0,0 +1,67 @@
+import pytest
+
+pytest.importorskip('torch')
+
+from dyna_gym.agents import mcts, uct
+from dyna_gym.utils.tree_snapshot import CHANCE_ARRAYS, DECISION_ARRAYS, load_tree, save_tree
+
+
+def searched_agent(env, policy, memory, **kwargs):
+    agent = uct.UCT(default_policy=policy, memory=memory, alg='p_uct', ucb_constant=1., rollouts=30, **kwargs)
+    env.reset(())
+    agent.act(env, False)
+    return agent
+
+
+def node_fields(node):
+    chance_fields = [(child.action, [getattr(child, name) for name in CHANCE_ARRAYS],
+                      [grandchild.id for grandchild in child.children]) for child in node.children]
+    return (node.id, node.state, [getattr(node, name) for name in DECISION_ARRAYS], node.possible_actions,
+            node.action_scores, chance_fields)
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_snapshot_round_trip(env, policy, memory, tmp_path, compress):
+    root = searched_agent(env, policy, memory).root
+    path = tmp_path / 'tree.bin'
+    save_tree(root, path, compress=compress)
+    loaded = load_tree(path)
+
+    nodes, loaded_nodes = mcts.reachable_nodes(root), mcts.reachable_nodes(loaded)
+    assert [node_fields(node) for node in loaded_nodes] == [node_fields(node) for node in nodes]
+    assert loaded.parent is None
+    for node in loaded_nodes[1:]:
+        assert node in node.parent.children and node.parent.parent.children.count(node.parent) == 1
+
+
+def test_snapshot_keeps_the_shared_nodes(tmp_path):
+    root = mcts.DecisionNode(None, (), possible_actions=[0, 1], default_policy=None)
+    shared = mcts.DecisionNode(root.children[0], (0, 1), possible_actions=[0], default_policy=None)
+    for chance_node in root.children:
+        chance_node.children.append(shared)
+    save_tree(root, tmp_path / 'tree.bin')
+
+    loaded = load_tree(tmp_path / 'tree.bin')
+    first, second = loaded.children
+    assert len(mcts.reachable_nodes(loaded)) == 2
+    assert first.children[0] is second.children[0] and first.children[0].parent is first
+
+
+def test_loaded_tree_warm_starts_the_search(env, policy, memory, tmp_path):
+    agent = searched_agent(env, policy, memory)
+    agent.save_tree(tmp_path / 'tree.bin')
+
+    warm = uct.UCT(default_policy=policy, memory=memory, alg='p_uct', ucb_constant=1., rollouts=40, reuse_tree=True)
+    warm.load_tree(tmp_path / 'tree.bin')
+    assert warm.reroot('any action', (), env.equality_operator)
+    env.reset(())
+    warm.act(env, False)
+    # the 30 rollouts of the saved search count towards the 40 rollouts of the call
+    assert warm.search_info['rollouts'] == 10 and warm.root.visits == 41
+
+
+def test_load_tree_rejects_other_files(tmp_path):
+    path = tmp_path / 'tree.bin'
+    path.write_bytes(b'not a tree')
+    with pytest.raises(Exception, match='is not a tree snapshot'):
+        load_tree(path)
@@ -0,0 +1,112 @@
+import pytest
+
+pytest.importorskip('torch')
+
+from dyna_gym.agents import mcts, uct
+from dyna_gym.agents.budget import RolloutScheduler
+
+
+def new_agent(policy, memory, **kwargs):
+    kwargs.setdefault('rollouts', 20)
+    kwargs.setdefault('alg', 'p_uct')
+    return uct.UCT(default_policy=policy, memory=memory, ucb_constant=1., **kwargs)
+
+
+def test_reroot_keeps_the_subtree_of_the_committed_action(env, policy, memory):
+    agent = new_agent(policy, memory, reuse_tree=True)
+    env.reset(())
+    action = agent.act(env, False)
+    state, _, _ = env.transition((), action)
+    chance_node = next(child for child in agent.root.children if child.action == action)
+    subtree = next(node for node in chance_node.children if node.state == state)
+    inherited = subtree.visits
+
+    assert agent.reroot(action, state, env.equality_operator)
+    assert agent.root is subtree and agent.root.parent is None
+    assert agent.search_info.get('reroot_hit') is None
+
+    env.reset(state)
+    agent.act(env, False)
+    # the visits of the reused subtree count towards the rollouts of the call
+    assert agent.search_info['rollouts'] == 20 - (inherited - 1)
+    assert agent.search_info['reroot_hit'] is True
+    assert agent.root.visits == 21
+
+
+def test_reroot_drops_the_tree_of_an_unexpanded_state(env, policy, memory):
+    agent = new_agent(policy, memory, reuse_tree=True)
+    env.reset(())
+    action = agent.act(env, False)
+
+    assert not agent.reroot(action, (5,), env.equality_operator)
+    assert agent.root is None
+    env.reset((5,))
+    agent.act(env, False)
+    assert agent.search_info['rollouts'] == 20 and agent.search_info['reroot_hit'] is False
+
+
+def test_reroot_keeps_a_root_labelled_by_the_state(env, policy, memory):
+    agent = new_agent(policy, memory, reuse_tree=True)
+    env.reset(())
+    agent.act(env, False)
+    root = agent.root
+
+    assert agent.reroot('any action', (), env.equality_operator)
+    assert agent.root is root
+
+
+def test_early_stopped_search_returns_the_most_visited_action(env, policy, memory):
+    agent = new_agent(policy, memory, rollouts=200, early_stop='visits')
+    env.reset(())
+    action = agent.act(env, False)
+    assert agent.early_stopped and agent.search_info['rollouts_saved'] > 0
+    assert action == max(agent.root.children, key=lambda child: child.n_returns).action
+
+
+def test_search_stays_within_the_node_budget(env, policy, memory):
+    env = env.__class__(horizon=6)
+    agent = new_agent(policy, memory, rollouts=100, max_nodes=20)
+    env.reset(())
+    agent.act(env, False)
+    n_nodes = len(mcts.reachable_nodes(agent.root))
+    assert n_nodes <= 20 and agent.n_nodes == n_nodes
+    # every rollout is still counted at the root
+    assert agent.root.visits == 101
+
+
+def test_scheduler_charges_the_rollouts_run_by_each_turn(env, policy, memory):
+    scheduler = RolloutScheduler(total_rollouts=60, max_turns=3)
+    agent = new_agent(policy, memory, reuse_tree=True, scheduler=scheduler)
+    state = env.reset(())
+    for _ in range(2):
+        action = agent.act(env, False)
+        turn = scheduler.history[-1]
+        # the reused visits do not reduce the rollouts allocated to the turn
+        assert agent.search_info['rollouts'] == agent.search_info['rollout_budget'] == turn['rollouts'] > 0
+        assert agent.search_info['conversation_rollouts_left'] == turn['remaining']
+        state, _, _ = env.transition(state, action)
+        agent.reroot(action, state, env.equality_operator)
+        env.reset(state)
+    assert scheduler.remaining == 60 - sum(turn['rollouts'] for turn in scheduler.history)
+
+
+
+def test_progressive_widening_without_action_space(env, policy, memory):
+    agent = new_agent(policy, memory, rollouts=30, pw_alpha=0.5)
+    env.reset(())
+    agent.act(env, False)
+    # the root is widened among all the actions of the policy, with ceil(30 ** 0.5) children at most
+    assert agent.width == 0 and agent.root.possible_actions == [0, 1, 2]
+    assert 1 <= len(agent.root.children) <= 3
+
+
+@pytest.mark.parametrize('options', [{}, {'alg': 'var_p_uct'}, {'alg': 'gumbel'}, {'pw_alpha': 0.5},
+                                     {'parallel_rollouts': 4}])
+def test_array_backend_searches_like_the_object_backend(env, policy, memory, options):
+    def search(tree_backend):
+        agent = new_agent(policy, memory, rollouts=50, tree_backend=tree_backend, **options)
+        env.reset(())
+        action = agent.act(env, False)
+        return action, [(child.action, child.n_returns, child.sum_returns) for child in agent.root.children]
+
+    assert search('array') == search('object')